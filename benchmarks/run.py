@@ -0,0 +1,695 @@
+import argparse
+import copy
+import datetime
+import gc
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+import requests  # noqa: E402
+from influxdb_client import InfluxDBClient  # noqa: E402
+
+from columnar import ColumnarBatch  # noqa: E402
+from data_processor import DataProcessor  # noqa: E402
+from decoder import orjson, ResponseDecoder  # noqa: E402
+from derived_metrics import DerivedMetrics, numpy  # noqa: E402
+from influx_writer import BatchingWriter  # noqa: E402
+from line_protocol import LineProtocolEncoder  # noqa: E402
+from modbus_source import ModbusSource  # noqa: E402
+from recorder import ResponseRecorder, ResponseReplay  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+COLLECTIONS = [
+    "CommonInverterData",
+    "3PInverterData",
+    "MinMaxInverterData",
+    "CumulationInverterData",
+    "MeterRealtimeData",
+    "PowerFlowRealtimeData",
+]
+
+# metrics compared between two result files, and whether higher values are better
+COMPARED_METRICS = {
+    'points_per_s': True,
+    'p50_us': False,
+    'p99_us': False,
+    'alloc_bytes_per_call': False,
+    'retained_mb': False,
+}
+
+
+def load_samples() -> Dict[str, List[Dict]]:
+    samples = {}
+    for collection in COLLECTIONS:
+        with open(os.path.join(ROOT, 'samples', f'{collection}.json'), 'r') as f:
+            samples[collection] = json.load(f)
+    return samples
+
+
+def inverter_info(device_ids: List[str]) -> Dict:
+    return {
+        'Head': {'RequestArguments': {}, 'Status': {'Code': 0}, 'Timestamp': '2023-05-20T10:19:19+00:00'},
+        'Body': {'Data': {
+            device_id: {'DT': 1, 'PVPower': 10000, 'UniqueID': f'3010{int(device_id):05d}', 'StatusCode': 7,
+                        'CustomName': f'Inverter {device_id}', 'ErrorCode': 0, 'Show': 1}
+            for device_id in device_ids
+        }},
+    }
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def measure(call: Callable[[], int], iterations: int, alloc_iterations: int) -> Dict:
+    # per-call latency and the number of points produced
+    latencies = []
+    points = 0
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter_ns()
+        points += call()
+        latencies.append(time.perf_counter_ns() - t0)
+    duration = time.perf_counter() - start
+
+    # peak memory allocated per call, traced separately to keep the timings clean
+    alloc_bytes = 0.0
+    if alloc_iterations and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.start()
+        for _ in range(alloc_iterations):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            call()
+            _, peak = tracemalloc.get_traced_memory()
+            alloc_bytes += peak - before
+        tracemalloc.stop()
+        alloc_bytes /= alloc_iterations
+
+    latencies.sort()
+    return {
+        'calls': iterations,
+        'points': points,
+        'duration_s': round(duration, 4),
+        'points_per_s': round(points / duration, 1) if duration else 0.0,
+        'calls_per_s': round(iterations / duration, 1) if duration else 0.0,
+        'p50_us': round(percentile(latencies, 50) / 1000, 2),
+        'p90_us': round(percentile(latencies, 90) / 1000, 2),
+        'p99_us': round(percentile(latencies, 99) / 1000, 2),
+        'max_us': round(latencies[-1] / 1000, 2) if latencies else 0.0,
+        'alloc_bytes_per_call': round(alloc_bytes, 1),
+    }
+
+
+def cycle(responses: List[Dict]) -> Callable[[], Dict]:
+    # endless round-robin over the sample responses
+    state = {'idx': 0}
+
+    def next_response() -> Dict:
+        response = responses[state['idx'] % len(responses)]
+        state['idx'] += 1
+        return response
+    return next_response
+
+
+# Stub InfluxDB which accepts every write and counts the received lines.
+class StubInfluxDB:
+    def __init__(self):
+        self.lines = 0
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with stub.lock:
+                    stub.requests += 1
+                    stub.bytes += len(body)
+                    stub.lines += body.count(b'\n') + 1 if body else 0
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def wait_for(self, lines: int, timeout: float = 60.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if self.lines >= lines:
+                    return True
+            time.sleep(0.001)
+        return False
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_processor(samples: Dict[str, List[Dict]], iterations: int, alloc_iterations: int) -> Dict[str, Dict]:
+    results = {}
+    encoder_modes = [('dicts', None), ('line_protocol', LineProtocolEncoder({'location': 'bench'}))]
+    for mode, encoder in encoder_modes:
+        for collection, responses in samples.items():
+            processor = DataProcessor(encoder)
+            processor.update_inverters(inverter_info(['1']))
+            next_response = cycle(responses)
+            results[f'process/{mode}/{collection}'] = measure(
+                lambda: len(processor.process(collection, next_response())), iterations, alloc_iterations)
+
+    for count in [1, 10, 100]:
+        processor = DataProcessor()
+        info = inverter_info([str(idx) for idx in range(1, count + 1)])
+
+        def update_inverters() -> int:
+            processor.update_inverters(info)
+            return len(processor.inverter_map)
+        results[f'update_inverters/{count}'] = measure(update_inverters, iterations, alloc_iterations)
+    return results
+
+
+def bench_decode(samples: Dict[str, List[Dict]], iterations: int, alloc_iterations: int) -> Dict[str, Dict]:
+    results = {}
+    backends = ['stdlib', 'orjson'] if orjson is not None else ['stdlib']
+    reference = ResponseDecoder('stdlib')
+    for collection, responses in samples.items():
+        bodies = [json.dumps(response).encode('utf-8') for response in responses]
+        for backend in backends:
+            decoder = ResponseDecoder(backend)
+            # the decoded values must be identical to the standard library
+            for body in bodies:
+                if decoder.decode(body) != reference.decode(body):
+                    raise AssertionError(f"{backend} decodes {collection} differently")
+
+            processor = DataProcessor()
+            processor.update_inverters(inverter_info(['1']))
+            next_body = cycle(bodies)
+            results[f'decode/{backend}/{collection}'] = measure(
+                lambda: len(processor.process(collection, decoder.decode(next_body()))), iterations, alloc_iterations)
+    return results
+
+
+def bench_write(samples: Dict[str, List[Dict]], iterations: int, batch_size: int) -> Dict[str, Dict]:
+    results = {}
+    for mode in ['dicts', 'line_protocol']:
+        processor = DataProcessor(LineProtocolEncoder() if mode == 'line_protocol' else None)
+        processor.update_inverters(inverter_info(['1']))
+        batches = []
+        for idx in range(iterations):
+            collection = COLLECTIONS[idx % len(COLLECTIONS)]
+            responses = samples[collection]
+            batches.append(processor.process(collection, responses[idx % len(responses)]))
+        points = sum(map(len, batches))
+
+        stub = StubInfluxDB()
+        client = InfluxDBClient(url=stub.url, token='bench', org='bench')
+        writer = BatchingWriter(client, 'bench', batch_size=batch_size, flush_interval=0.05)
+        try:
+            # writer.write() latency as seen by the polling loop
+            latencies = []
+            start = time.perf_counter()
+            for batch in batches:
+                t0 = time.perf_counter_ns()
+                writer.write(batch)
+                latencies.append(time.perf_counter_ns() - t0)
+            complete = stub.wait_for(points)
+            duration = time.perf_counter() - start
+        finally:
+            writer.close()
+            client.close()
+            stub.close()
+
+        latencies.sort()
+        results[f'write/{mode}'] = {
+            'calls': len(batches),
+            'points': points,
+            'complete': complete,
+            'duration_s': round(duration, 4),
+            'points_per_s': round(points / duration, 1),
+            'requests': stub.requests,
+            'bytes_per_point': round(stub.bytes / max(1, stub.lines), 1),
+            'p50_us': round(percentile(latencies, 50) / 1000, 2),
+            'p99_us': round(percentile(latencies, 99) / 1000, 2),
+        }
+    return results
+
+
+def fleet_responses(samples: Dict[str, List[Dict]], inverters: int, meters: int, cycle_idx: int) -> List[Tuple[str, Dict]]:
+    # one polling cycle of a plant with the given number of inverters and meters
+    timestamp = (datetime.datetime(2023, 5, 20, 10, 0, 0, tzinfo=datetime.timezone.utc)
+                 + datetime.timedelta(seconds=cycle_idx)).isoformat()
+    responses = []
+    for device_id in range(1, inverters + 1):
+        for collection in ["CommonInverterData", "3PInverterData", "CumulationInverterData"]:
+            response = copy.deepcopy(samples[collection][(cycle_idx + device_id) % len(samples[collection])])
+            response['Head']['Timestamp'] = timestamp
+            response['Head']['RequestArguments']['DeviceId'] = str(device_id)
+            responses.append((collection, response))
+
+    meter_sample = samples['MeterRealtimeData'][cycle_idx % len(samples['MeterRealtimeData'])]
+    meter = copy.deepcopy(meter_sample)
+    meter['Head']['Timestamp'] = timestamp
+    template = next(iter(meter_sample['Body']['Data'].values()))
+    meter['Body']['Data'] = {str(idx): copy.deepcopy(template) for idx in range(meters)}
+    responses.append(("MeterRealtimeData", meter))
+
+    power_flow_sample = samples['PowerFlowRealtimeData'][cycle_idx % len(samples['PowerFlowRealtimeData'])]
+    power_flow = copy.deepcopy(power_flow_sample)
+    power_flow['Head']['Timestamp'] = timestamp
+    template = next(iter(power_flow_sample['Body']['Data']['Inverters'].values()))
+    power_flow['Body']['Data']['Inverters'] = {str(idx): copy.deepcopy(template) for idx in range(1, inverters + 1)}
+    responses.append(("PowerFlowRealtimeData", power_flow))
+    return responses
+
+
+def bench_scaled(samples: Dict[str, List[Dict]], cycles: int, fleets: List[int], meters: int,
+                 batch_size: int) -> Dict[str, Dict]:
+    results = {}
+    for inverters in fleets:
+        # the responses are prepared upfront to measure the pipeline only
+        cycle_responses = [fleet_responses(samples, inverters, meters, idx) for idx in range(cycles)]
+
+        stub = StubInfluxDB()
+        client = InfluxDBClient(url=stub.url, token='bench', org='bench')
+        writer = BatchingWriter(client, 'bench', batch_size=batch_size, flush_interval=0.05,
+                                max_queue_bytes=256 * 1024 * 1024)
+        processor = DataProcessor(LineProtocolEncoder(client.default_tags))
+        processor.update_inverters(inverter_info([str(idx) for idx in range(1, inverters + 1)]))
+        try:
+            latencies = []
+            points = 0
+            start = time.perf_counter()
+            for responses in cycle_responses:
+                t0 = time.perf_counter_ns()
+                for metric, response in responses:
+                    data = processor.process(metric, response)
+                    writer.write(data)
+                    points += len(data)
+                latencies.append(time.perf_counter_ns() - t0)
+            processing = time.perf_counter() - start
+            complete = stub.wait_for(points)
+            duration = time.perf_counter() - start
+        finally:
+            writer.close()
+            client.close()
+            stub.close()
+
+        latencies.sort()
+        results[f'scaled/{inverters}_inverters_{meters}_meters'] = {
+            'cycles': cycles,
+            'requests_per_cycle': len(cycle_responses[0]),
+            'points': points,
+            'complete': complete,
+            'duration_s': round(duration, 4),
+            'points_per_s': round(points / duration, 1),
+            # throughput of the polling loop without waiting for the final flush
+            'loop_points_per_s': round(points / processing, 1),
+            'p50_us': round(percentile(latencies, 50) / 1000, 2),
+            'p99_us': round(percentile(latencies, 99) / 1000, 2),
+            'dropped': writer.dropped,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+    return results
+
+
+def bench_columnar(samples: Dict[str, List[Dict]], interval: float, inverters: int, meters: int) -> Dict[str, Dict]:
+    # a simulated day of polling, the processed samples are kept in memory as dicts or as a columnar batch
+    results = {}
+    cycles = int(86400 / interval)
+    templates = [fleet_responses(samples, inverters, meters, idx) for idx in range(10)]
+    start_time = datetime.datetime(2023, 5, 20, 0, 0, 0, tzinfo=datetime.timezone.utc)
+
+    def day() -> Iterator[List[Tuple[str, Dict]]]:
+        for idx in range(cycles):
+            responses = templates[idx % len(templates)]
+            point_time = start_time + datetime.timedelta(seconds=idx * interval)
+            for metric, response in responses:
+                response['Head']['Timestamp'] = point_time.isoformat()
+                if metric == 'MeterRealtimeData':
+                    for meter in response['Body']['Data'].values():
+                        meter['TimeStamp'] = int(point_time.timestamp())
+            yield responses
+
+    def run_dicts(latencies: List[int]):
+        processor = DataProcessor()
+        processor.update_inverters(inverter_info([str(idx) for idx in range(1, inverters + 1)]))
+        points = []
+        for responses in day():
+            t0 = time.perf_counter_ns()
+            for metric, response in responses:
+                points.extend(processor.process_points(metric, response))
+            latencies.append(time.perf_counter_ns() - t0)
+        return points
+
+    def run_columnar(latencies: List[int]):
+        processor = DataProcessor()
+        processor.update_inverters(inverter_info([str(idx) for idx in range(1, inverters + 1)]))
+        batch = ColumnarBatch()
+        for responses in day():
+            t0 = time.perf_counter_ns()
+            for metric, response in responses:
+                processor.process_columnar(metric, response, batch)
+            latencies.append(time.perf_counter_ns() - t0)
+        return batch
+
+    encoder = LineProtocolEncoder({'location': 'bench'})
+    modes = [
+        ('dicts', run_dicts, len, lambda points: [line for line in map(encoder.encode, points) if line]),
+        ('columnar', run_columnar, len, lambda batch: batch.encode(encoder)),
+    ]
+    for mode, run, count, encode in modes:
+        # processing and encoding times, then the retained memory traced separately
+        latencies: List[int] = []
+        gc.collect()
+        start = time.perf_counter()
+        data = run(latencies)
+        duration = time.perf_counter() - start
+        start = time.perf_counter()
+        lines = encode(data)
+        encode_duration = time.perf_counter() - start
+        points = count(data)
+        del data
+
+        gc.collect()
+        tracemalloc.start()
+        data = run([])
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del data
+
+        latencies.sort()
+        results[f'columnar/24h_{inverters}_inverters_{meters}_meters/{mode}'] = {
+            'cycles': cycles,
+            'points': points,
+            'lines': len(lines),
+            'duration_s': round(duration, 4),
+            'points_per_s': round(points / duration, 1),
+            'encode_points_per_s': round(points / encode_duration, 1),
+            'p50_us': round(percentile(latencies, 50) / 1000, 2),
+            'p99_us': round(percentile(latencies, 99) / 1000, 2),
+            'retained_mb': round(retained / 1024 / 1024, 2),
+            'bytes_per_point': round(retained / points, 1),
+        }
+    return results
+
+
+def start_devserver(script: str, args: List[str]) -> Tuple[subprocess.Popen, int]:
+    # a dev server on a free port, ready when it accepts connections
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'devserver', script), '--port', str(port)] + args,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10.0
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1.0).close()
+            return process, port
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError(f"{script} did not start")
+            time.sleep(0.1)
+
+
+def bench_modbus(iterations: int) -> Dict[str, Dict]:
+    # a sample per call from the dev servers: Solar API request, decoding and processing vs. SunSpec Modbus TCP read
+    results = {}
+    http_server, http_port = start_devserver('server.py', ['--inverters', '1', '--meters', '1'])
+    modbus_server, modbus_port = start_devserver('modbus_server.py', ['--inverters', '1', '--meters', '1'])
+    session = requests.Session()
+    try:
+        base_url = f"http://127.0.0.1:{http_port}/solar_api/v1"
+        decoder = ResponseDecoder()
+        processor = DataProcessor()
+        processor.update_inverters(decoder.decode(session.get(f"{base_url}/GetInverterInfo.cgi").content))
+        source = ModbusSource('127.0.0.1', modbus_port, units={'1': 1}, meters={'0': 200})
+
+        def http(url: str, metric: str) -> Callable[[], int]:
+            return lambda: len(processor.process_points(metric, decoder.decode(session.get(url).content)))
+
+        sources = {
+            'http': {
+                'CommonInverterData': http(f"{base_url}/GetInverterRealtimeData.cgi?Scope=Device&DeviceId=1"
+                                           f"&DataCollection=CommonInverterData", "CommonInverterData"),
+                '3PInverterData': http(f"{base_url}/GetInverterRealtimeData.cgi?Scope=Device&DeviceId=1"
+                                       f"&DataCollection=3PInverterData", "3PInverterData"),
+                'MeterRealtimeData': http(f"{base_url}/GetMeterRealtimeData.cgi?Scope=System", "MeterRealtimeData"),
+            },
+            'modbus': {
+                metric: (lambda metric=metric: len(source.read(metric, '1' if metric != 'MeterRealtimeData' else None)))
+                for metric in ['CommonInverterData', '3PInverterData', 'MeterRealtimeData']
+            },
+        }
+        for name, calls in sources.items():
+            for metric, call in calls.items():
+                # the first call connects and discovers the devices
+                call()
+                result = measure(call, iterations, 0)
+                result['samples_per_s'] = result.pop('calls_per_s')
+                del result['alloc_bytes_per_call']
+                results[f'modbus/{metric}/{name}'] = result
+        source.close()
+    finally:
+        session.close()
+        for process in [http_server, modbus_server]:
+            process.terminate()
+            process.wait()
+    return results
+
+
+def bench_record(samples: Dict[str, List[Dict]], iterations: int) -> Dict[str, Dict]:
+    # cost of recording a raw response in the poll loop, then the replay of the recording through the data processor
+    results = {}
+    bodies = [(metric, json.dumps(response, indent=2).encode('utf-8'))
+              for metric in COLLECTIONS for response in samples[metric]]
+    directory = tempfile.mkdtemp(prefix='bench-record-')
+    try:
+        recorder = ResponseRecorder(directory, max_queue=iterations)
+        body_iter = iter(bodies * (iterations // len(bodies) + 1))
+
+        def record() -> int:
+            metric, body = next(body_iter)
+            recorder.record(metric, 'http://127.0.0.1/solar_api/v1', 200, body)
+            return 1
+
+        result = measure(record, iterations, 0)
+        start = time.perf_counter()
+        recorder.close()
+        result['drain_s'] = round(time.perf_counter() - start, 4)
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        result['compression_ratio'] = round(recorder.raw_bytes / size, 1) if size else 0.0
+        result['dropped'] = recorder.dropped
+        del result['alloc_bytes_per_call']
+        results['record/poll_loop'] = result
+
+        processor = DataProcessor()
+        processor.update_inverters(inverter_info(['1']))
+        replay = ResponseReplay(directory, ResponseDecoder(), speed=0)
+        counts = {'points': 0}
+        latencies = []
+
+        def handle(metric: str, response: Dict):
+            t0 = time.perf_counter_ns()
+            counts['points'] += len(processor.process(metric, response))
+            latencies.append(time.perf_counter_ns() - t0)
+
+        start = time.perf_counter()
+        replay.run(handle)
+        duration = time.perf_counter() - start
+        latencies.sort()
+        results['record/replay_full_speed'] = {
+            'responses': replay.replayed,
+            'points': counts['points'],
+            'duration_s': round(duration, 4),
+            'points_per_s': round(counts['points'] / duration, 1),
+            'responses_per_s': round(replay.replayed / duration, 1),
+            # processing per response, the remainder is reading and decoding the segments
+            'p50_us': round(percentile(latencies, 50) / 1000, 2),
+            'p99_us': round(percentile(latencies, 99) / 1000, 2),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def bench_derived(samples: Dict[str, List[Dict]], windows: List[int]) -> Dict[str, Dict]:
+    # derived metrics of samples every second, the formulas run once per window on its arrays, so the cost per
+    # sample should fall with the window size
+    results = {}
+    if numpy is None:
+        print("derived suite skipped, numpy is not installed")
+        return results
+    processor = DataProcessor()
+    processor.update_inverters(inverter_info(['1']))
+    templates = [point for metric in ['CommonInverterData', '3PInverterData', 'PowerFlowRealtimeData']
+                 for point in processor.process_points(metric, samples[metric][0])]
+    start_ns = 1_684_540_800 * 10 ** 9
+    for window in windows:
+        derived = DerivedMetrics(window=window)
+        # three complete windows
+        points = [{**point, 'time': start_ns + second * 10 ** 9}
+                  for second in range(3 * window) for point in templates]
+        latencies = []
+        emitted = 0
+        start = time.perf_counter()
+        for point in points:
+            t0 = time.perf_counter_ns()
+            emitted += len(derived.process([point])) - 1
+            latencies.append(time.perf_counter_ns() - t0)
+        emitted += len(derived.flush())
+        duration = time.perf_counter() - start
+        latencies.sort()
+        results[f'derived/window_{window}s'] = {
+            'points': len(points),
+            'emitted': emitted,
+            'duration_s': round(duration, 4),
+            'points_per_s': round(len(points) / duration, 1),
+            'p50_us': round(percentile(latencies, 50) / 1000, 2),
+            # the samples which close a window
+            'p99_us': round(percentile(latencies, 99) / 1000, 2),
+            'max_us': round(latencies[-1] / 1000, 2),
+        }
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path: str, current: Dict, threshold: float) -> bool:
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+
+    print(f"\ncomparison with {baseline_path} (commit {baseline['meta'].get('commit')}), threshold {threshold:.0f} %")
+    regressions = 0
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100.0
+            regression = change < -threshold if higher_is_better else change > threshold
+            if regression:
+                regressions += 1
+            if regression or abs(change) > threshold:
+                print(f"{'REGRESSION' if regression else 'improved  '} {name} {metric}: {old} -> {new} ({change:+.1f} %)")
+    print(f"{regressions} regressions")
+    return regressions == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='Fronius Solar API to InfluxDB Bridge benchmarks',
+                                     description='Benchmark the processing and write pipeline with the sample data')
+    parser.add_argument('--suite', choices=['processor', 'decode', 'write', 'scaled', 'columnar', 'modbus', 'record', 'derived', 'all'], default='all')
+    parser.add_argument('--iterations', type=int, default=2000, help='Calls per processor and modbus benchmark')
+    parser.add_argument('--alloc-iterations', type=int, default=200, help='Traced calls for allocation statistics')
+    parser.add_argument('--cycles', type=int, default=50, help='Polling cycles per scaled benchmark')
+    parser.add_argument('--inverters', type=int, nargs='+', default=[1, 10, 100], help='Fleet sizes of the scaled benchmark')
+    parser.add_argument('--meters', type=int, default=3, help='Number of meters of the scaled benchmark')
+    parser.add_argument('--interval', type=float, default=5.0, help='Polling interval of the simulated day of the columnar suite')
+    parser.add_argument('--batch-size', type=int, default=500, help='Writer batch size')
+    parser.add_argument('--windows', type=int, nargs='+', default=[10, 60, 600, 3600],
+                        help='Window sizes in seconds of the derived suite')
+    parser.add_argument('--output', type=str, help='Save the results as JSON')
+    parser.add_argument('--compare', type=str, help='Compare the results with a saved JSON file')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Regression threshold in percent')
+    args = parser.parse_args()
+
+    samples = load_samples()
+    results = {}
+    if args.suite in ['processor', 'all']:
+        results.update(bench_processor(samples, args.iterations, args.alloc_iterations))
+    if args.suite in ['decode', 'all']:
+        results.update(bench_decode(samples, args.iterations, args.alloc_iterations))
+    if args.suite in ['write', 'all']:
+        results.update(bench_write(samples, args.iterations, args.batch_size))
+    if args.suite in ['scaled', 'all']:
+        results.update(bench_scaled(samples, args.cycles, args.inverters, args.meters, args.batch_size))
+    if args.suite in ['columnar', 'all']:
+        results.update(bench_columnar(samples, args.interval, args.inverters[0], args.meters))
+    if args.suite in ['modbus', 'all']:
+        results.update(bench_modbus(args.iterations))
+    if args.suite in ['record', 'all']:
+        results.update(bench_record(samples, args.iterations))
+    if args.suite in ['derived', 'all']:
+        results.update(bench_derived(samples, args.windows))
+
+    for name, result in results.items():
+        print(f"{name:55s} {result['points_per_s']:>12.0f} points/s  "
+              f"p50={result['p50_us']:>9.1f} us  p99={result['p99_us']:>9.1f} us"
+              + (f"  alloc={result['alloc_bytes_per_call']:.0f} B/call" if 'alloc_bytes_per_call' in result else "")
+              + (f"  retained={result['retained_mb']:.1f} MB" if 'retained_mb' in result else ""))
+    print(f"peak RSS: {peak_rss_mb():.1f} MB" if resource else "peak RSS: n/a")
+
+    output = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+            'peak_rss_mb': peak_rss_mb(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare and not compare(args.compare, output, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
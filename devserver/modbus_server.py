@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+import random
+import socketserver
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from modbus_source import (COMMON_MODEL, INVERTER_FLOAT_MODEL, INVERTER_MODEL, METER_FLOAT_MODEL,  # noqa: E402
+                           METER_MODEL, MPPT_MODEL, MPPT_MODULE, ModelLayout)
+
+SUNSPEC_BASE = 40000
+# unit id of the first meter, further meters follow
+METER_UNIT = 200
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+GATEWAY_TARGET_FAILED = 11
+
+
+def load_samples(name: str) -> List[Dict]:
+    with open(os.path.join(ROOT, 'samples', f'{name}.json'), 'r') as f:
+        return json.load(f)
+
+
+# the same serial numbers as the Solar API mock server
+def inverter_serial(device_id: int) -> str:
+    return f'3010{device_id:05d}'
+
+
+def meter_serial(meter_id: int) -> str:
+    return f'01234{meter_id:05d}'
+
+
+def scale_factor(values: List[Optional[float]], kind: str, min_sf: int = -3) -> int:
+    # the smallest power of ten at which all values of a group fit into the register type
+    limit = 0xFFFFFFFF if kind == 'acc32' else 0xFFFE if kind == 'uint16' else 0x7FFF
+    present = [abs(value) for value in values if value is not None]
+    sf = min_sf
+    while present and max(present) / 10 ** sf > limit:
+        sf += 1
+    return sf
+
+
+def encode(layout: ModelLayout, values: Dict[str, object]) -> bytes:
+    # points without a value are encoded as not implemented
+    items = []
+    for name, kind, missing in zip(layout.names, layout.kinds, layout.missing):
+        value = values.get(name)
+        if kind.startswith('string'):
+            value = (value or '').encode('utf-8')
+        elif value is None:
+            value = float('nan') if kind == 'float32' else missing
+        items.append(value)
+    return layout.struct.pack(*items)
+
+
+def scaled_values(layout: ModelLayout, values: Dict[str, Optional[float]], groups: Dict[str, List[str]],
+                  kinds: Dict[str, str]) -> Dict[str, object]:
+    # integer values and a scale factor per group of points for the int+SF models
+    if not layout.scaled:
+        return {name: value for name, value in values.items() if value is not None}
+    result = {}
+    for sf_name, names in groups.items():
+        kind = kinds.get(names[0], 'int16')
+        sf = scale_factor([values.get(name) for name in names], kind)
+        result[sf_name] = sf
+        for name in names:
+            if values.get(name) is not None:
+                result[name] = int(round(values[name] / 10 ** sf))
+    return result
+
+
+def _value(data: Dict, key: str) -> Optional[float]:
+    value = data.get(key)
+    if isinstance(value, dict):
+        value = value.get('Value')
+    return float(value) if value is not None else None
+
+
+def model(model_id: int, payload: bytes) -> bytes:
+    return struct.pack('>HH', model_id, len(payload) // 2) + payload
+
+
+def common_model(manufacturer: str, model_name: str, serial: str) -> bytes:
+    return model(1, encode(COMMON_MODEL, {'Mn': manufacturer, 'Md': model_name, 'Vr': '1.0', 'SN': serial,
+                                          'DA': 1}))
+
+
+def inverter_registers(device_id: int, common: Dict, three_phase: Dict, floats: bool) -> bytes:
+    layout = INVERTER_FLOAT_MODEL if floats else INVERTER_MODEL
+    values = {
+        'A': _value(common, 'IAC'), 'AphA': _value(three_phase, 'IAC_L1'), 'AphB': _value(three_phase, 'IAC_L2'),
+        'AphC': _value(three_phase, 'IAC_L3'),
+        'PhVphA': _value(three_phase, 'UAC_L1') or _value(common, 'UAC'), 'PhVphB': _value(three_phase, 'UAC_L2'),
+        'PhVphC': _value(three_phase, 'UAC_L3'),
+        'W': _value(common, 'PAC'), 'Hz': _value(common, 'FAC'), 'VA': _value(common, 'SAC'),
+        'WH': _value(common, 'TOTAL_ENERGY'), 'DCA': _value(common, 'IDC'), 'DCV': _value(common, 'UDC'),
+        'St': 4,
+    }
+    groups = {'A_SF': ['A', 'AphA', 'AphB', 'AphC'], 'V_SF': ['PhVphA', 'PhVphB', 'PhVphC'], 'W_SF': ['W'],
+              'Hz_SF': ['Hz'], 'VA_SF': ['VA'], 'WH_SF': ['WH'], 'DCA_SF': ['DCA'], 'DCV_SF': ['DCV']}
+    kinds = {'A': 'uint16', 'PhVphA': 'uint16', 'Hz': 'uint16', 'WH': 'acc32', 'DCA': 'uint16', 'DCV': 'uint16'}
+    encoded = scaled_values(layout, values, groups, kinds)
+    encoded['St'] = 4
+
+    # one tracker per reported DC input and the storage module of a GEN24
+    trackers = [(_value(common, 'IDC'), _value(common, 'UDC'))]
+    if _value(common, 'IDC_2') is not None:
+        trackers.append((_value(common, 'IDC_2'), _value(common, 'UDC_2')))
+    header = {'DCA_SF': scale_factor([a for a, _ in trackers], 'uint16'),
+              'DCV_SF': scale_factor([v for _, v in trackers], 'uint16'), 'N': len(trackers) + 1}
+    mppt = encode(MPPT_MODEL, header)
+    for idx, (current, voltage) in enumerate(trackers):
+        mppt += encode(MPPT_MODULE, {'ID': idx + 1, 'IDStr': f'MPPT {idx + 1}',
+                                     'DCA': None if current is None else int(round(current / 10 ** header['DCA_SF'])),
+                                     'DCV': None if voltage is None else int(round(voltage / 10 ** header['DCV_SF']))})
+    mppt += encode(MPPT_MODULE, {'ID': len(trackers) + 1, 'IDStr': f'StCha {len(trackers) + 1}', 'DCA': 0, 'DCV': 0})
+
+    return b''.join([
+        b'SunS',
+        common_model('Fronius', 'Symo GEN24 10.0', inverter_serial(device_id)),
+        model(113 if floats else 103, encode(layout, encoded)),
+        model(160, mppt),
+        struct.pack('>HH', 0xFFFF, 0),
+    ])
+
+
+def meter_registers(meter_id: int, meter: Dict, floats: bool) -> bytes:
+    layout = METER_FLOAT_MODEL if floats else METER_MODEL
+    keys = {
+        'A': 'Current_AC_Sum', 'AphA': 'Current_AC_Phase_1', 'AphB': 'Current_AC_Phase_2',
+        'AphC': 'Current_AC_Phase_3',
+        'PhVphA': 'Voltage_AC_Phase_1', 'PhVphB': 'Voltage_AC_Phase_2', 'PhVphC': 'Voltage_AC_Phase_3',
+        'PPVphAB': 'Voltage_AC_PhaseToPhase_12', 'PPVphBC': 'Voltage_AC_PhaseToPhase_23',
+        'PPVphCA': 'Voltage_AC_PhaseToPhase_31',
+        'Hz': 'Frequency_Phase_Average',
+        'W': 'PowerReal_P_Sum', 'WphA': 'PowerReal_P_Phase_1', 'WphB': 'PowerReal_P_Phase_2',
+        'WphC': 'PowerReal_P_Phase_3',
+        'VA': 'PowerApparent_S_Sum', 'VAphA': 'PowerApparent_S_Phase_1', 'VAphB': 'PowerApparent_S_Phase_2',
+        'VAphC': 'PowerApparent_S_Phase_3',
+        'VAR': 'PowerReactive_Q_Sum', 'VARphA': 'PowerReactive_Q_Phase_1', 'VARphB': 'PowerReactive_Q_Phase_2',
+        'VARphC': 'PowerReactive_Q_Phase_3',
+        'PF': 'PowerFactor_Sum', 'PFphA': 'PowerFactor_Phase_1', 'PFphB': 'PowerFactor_Phase_2',
+        'PFphC': 'PowerFactor_Phase_3',
+        'TotWhExp': 'EnergyReal_WAC_Sum_Produced', 'TotWhImp': 'EnergyReal_WAC_Sum_Consumed',
+    }
+    values = {name: _value(meter, key) for name, key in keys.items()}
+    # SunSpec reports the power factor in percent
+    for name in ['PF', 'PFphA', 'PFphB', 'PFphC']:
+        if values[name] is not None:
+            values[name] *= 100
+    groups = {'A_SF': ['A', 'AphA', 'AphB', 'AphC'],
+              'V_SF': ['PhVphA', 'PhVphB', 'PhVphC', 'PPVphAB', 'PPVphBC', 'PPVphCA'], 'Hz_SF': ['Hz'],
+              'W_SF': ['W', 'WphA', 'WphB', 'WphC'], 'VA_SF': ['VA', 'VAphA', 'VAphB', 'VAphC'],
+              'VAR_SF': ['VAR', 'VARphA', 'VARphB', 'VARphC'], 'PF_SF': ['PF', 'PFphA', 'PFphB', 'PFphC'],
+              'TotWh_SF': ['TotWhExp', 'TotWhImp']}
+    encoded = scaled_values(layout, values, groups, {'TotWhExp': 'acc32'})
+    details = meter['Details']
+    return b''.join([
+        b'SunS',
+        common_model(details['Manufacturer'], details['Model'], meter_serial(meter_id)),
+        model(213 if floats else 203, encode(layout, encoded)),
+        struct.pack('>HH', 0xFFFF, 0),
+    ])
+
+
+# Register maps of the virtual inverters and meters by unit id, one variant per sample of the Solar API mock data.
+class RegisterMaps:
+    def __init__(self, inverters: int, meters: int, floats: bool):
+        common = load_samples('CommonInverterData')
+        three_phase = load_samples('3PInverterData')
+        meter_samples = load_samples('MeterRealtimeData')
+
+        self.units: Dict[int, List[bytes]] = {}
+        for device_id in range(1, inverters + 1):
+            self.units[device_id] = [
+                inverter_registers(device_id, common[(idx + device_id) % len(common)]['Body']['Data'],
+                                   three_phase[(idx + device_id) % len(three_phase)]['Body']['Data'], floats)
+                for idx in range(len(common))
+            ]
+        for meter_id in range(meters):
+            self.units[METER_UNIT + meter_id] = [
+                meter_registers(meter_id, next(iter(sample['Body']['Data'].values())), floats)
+                for sample in meter_samples
+            ]
+
+    def read(self, unit: int, address: int, count: int) -> Tuple[Optional[bytes], int]:
+        variants = self.units.get(unit)
+        if variants is None:
+            return None, GATEWAY_TARGET_FAILED
+        registers = random.choice(variants)
+        offset = (address - SUNSPEC_BASE) * 2
+        if offset < 0 or offset + count * 2 > len(registers) or not 0 < count <= 125:
+            return None, ILLEGAL_ADDRESS
+        return registers[offset:offset + count * 2], 0
+
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            header = self._receive(7)
+            if header is None:
+                return
+            transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+            pdu = self._receive(length - 1)
+            if pdu is None:
+                return
+            if self.server.latency > 0.0:
+                time.sleep(self.server.latency)
+
+            function = pdu[0]
+            if function in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS) and len(pdu) == 5:
+                address, count = struct.unpack('>HH', pdu[1:5])
+                registers, error = self.server.maps.read(unit, address, count)
+            else:
+                registers, error = None, ILLEGAL_FUNCTION
+            if error:
+                response = struct.pack('>BB', function | 0x80, error)
+            else:
+                response = struct.pack('>BB', function, len(registers)) + registers
+            self.server.requests += 1
+            self.request.sendall(struct.pack('>HHHB', transaction, protocol, len(response) + 1, unit) + response)
+
+    def _receive(self, size: int) -> Optional[bytes]:
+        data = b''
+        while len(data) < size:
+            try:
+                chunk = self.request.recv(size - len(data))
+            except ConnectionError:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+class ModbusServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], maps: RegisterMaps, latency: float = 0.0):
+        super().__init__(address, ModbusHandler)
+        self.maps = maps
+        self.latency = latency
+        self.requests = 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='SunSpec Modbus TCP mock server',
+                                     description='Serve the sample data as SunSpec registers of virtual inverters '
+                                                 'and meters')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5502)
+    parser.add_argument('--inverters', type=int, default=1, help='Number of virtual inverters (unit ids 1, 2, ...)')
+    parser.add_argument('--meters', type=int, default=1, help=f'Number of virtual meters (unit ids {METER_UNIT}, ...)')
+    parser.add_argument('--float', action='store_true', help='Float models (113, 213) instead of int+SF (103, 203)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response latency in seconds')
+    args = parser.parse_args()
+
+    server = ModbusServer((args.host, args.port), RegisterMaps(args.inverters, args.meters, args.float), args.latency)
+    print(f'serving {args.inverters} inverters and {args.meters} meters on {args.host}:{server.server_address[1]}')
+    server.serve_forever()
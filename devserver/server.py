@@ -1,78 +1,403 @@
+import argparse
+import collections
+import copy
 import datetime
 import json
+import os
 import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
 import flask
 import pytz
-from flask import Flask, request
+from flask import Flask, Response, request
 
 app = Flask(__name__)
 
-# config section
+# config section, can be overridden by environment variables or command line arguments
 TIMEZONE = pytz.timezone('Europe/Vienna')
 
 
-with open('samples/CommonInverterData.json', 'r') as f:
-    common_inverter_data = json.loads(f.read())
+class FleetConfig:
+    inverters = int(os.environ.get('DEVSERVER_INVERTERS', 1))
+    meters = int(os.environ.get('DEVSERVER_METERS', 1))
+    # response latency: 'fixed:<s>', 'uniform:<min s>:<max s>' or 'lognormal:<median s>:<sigma>'
+    latency = os.environ.get('DEVSERVER_LATENCY', 'fixed:0')
+    # fraction of responses with a non-zero Head.Status.Code
+    error_rate = float(os.environ.get('DEVSERVER_ERROR_RATE', 0.0))
+    # fraction of requests which are answered only after the timeout
+    timeout_rate = float(os.environ.get('DEVSERVER_TIMEOUT_RATE', 0.0))
+    timeout = float(os.environ.get('DEVSERVER_TIMEOUT', 30.0))
+    # enforce the API rate limit per client with HTTP 429
+    rate_limit = os.environ.get('DEVSERVER_RATE_LIMIT', '0').lower() in ['1', 'true', 'yes']
+    max_parallel_requests = int(os.environ.get('DEVSERVER_MAX_PARALLEL_REQUESTS', 2))
+    min_request_gap = float(os.environ.get('DEVSERVER_MIN_REQUEST_GAP', 4.0))
 
-with open('samples/3PInverterData.json', 'r') as f:
-    threep_inverter_data = json.loads(f.read())
 
-with open('samples/MinMaxInverterData.json', 'r') as f:
-    min_max_inverter_data = json.loads(f.read())
+# Fronius status codes used for injected errors
+ERROR_CODES = {
+    5: 'Timeout',
+    8: 'LNRequestTimeout',
+    12: 'DeviceNotAvailable',
+    255: 'UnknownError',
+}
+DEVICE_NOT_AVAILABLE = 12
 
-with open('samples/CumulationInverterData.json', 'r') as f:
-    cumulation_inverter_data = json.loads(f.read())
+# the timestamp is spliced into the pre-serialized responses
+TIMESTAMP_MARKER = '@@TIMESTAMP@@'
 
-with open('samples/MeterRealtimeData.json', 'r') as f:
-    smart_meter_data = json.loads(f.read())
 
-with open('samples/PowerFlowRealtimeData.json', 'r') as f:
-    power_flow_data = json.loads(f.read())
+def load_samples(name: str) -> List[Dict]:
+    with open(f'samples/{name}.json', 'r') as f:
+        return json.loads(f.read())
+
+
+common_inverter_data = load_samples('CommonInverterData')
+threep_inverter_data = load_samples('3PInverterData')
+min_max_inverter_data = load_samples('MinMaxInverterData')
+cumulation_inverter_data = load_samples('CumulationInverterData')
+smart_meter_data = load_samples('MeterRealtimeData')
+power_flow_data = load_samples('PowerFlowRealtimeData')
+
+
+def inverter_serial(device_id: int) -> str:
+    return f'3010{device_id:05d}'
+
+
+def meter_serial(meter_id: int) -> str:
+    return f'01234{meter_id:05d}'
+
+
+def serialize(response: Dict) -> Tuple[bytes, bytes]:
+    response = copy.deepcopy(response)
+    response['Head']['Timestamp'] = TIMESTAMP_MARKER
+    prefix, suffix = json.dumps(response).encode('utf-8').split(TIMESTAMP_MARKER.encode('utf-8'))
+    return prefix, suffix
+
+
+def error_response(request_arguments: Dict, code: int) -> Tuple[bytes, bytes]:
+    return serialize({
+        'Body': {'Data': {}},
+        'Head': {
+            'RequestArguments': request_arguments,
+            'Status': {'Code': code, 'Reason': ERROR_CODES.get(code, ''), 'UserMessage': ''},
+            'Timestamp': '',
+        },
+    })
+
+
+# Pre-serialized responses of the virtual fleet by endpoint key, every variant is split at the timestamp.
+class Fleet:
+    def __init__(self, inverters: int, meters: int):
+        self.inverters = inverters
+        self.meters = meters
+        self.responses: Dict[Tuple, List[Tuple[bytes, bytes]]] = {}
+
+        inverter_collections = {
+            'CommonInverterData': common_inverter_data,
+            '3PInverterData': threep_inverter_data,
+            'MinMaxInverterData': min_max_inverter_data,
+            'CumulationInverterData': cumulation_inverter_data,
+        }
+        for device_id in range(1, inverters + 1):
+            for collection, samples in inverter_collections.items():
+                variants = []
+                # every inverter cycles through the samples with its own offset
+                for idx in range(len(samples)):
+                    response = copy.deepcopy(samples[(idx + device_id) % len(samples)])
+                    response['Head']['RequestArguments']['DeviceId'] = str(device_id)
+                    variants.append(serialize(response))
+                self.responses[('inverter', collection, str(device_id))] = variants
+
+        self.responses[('inverter', 'System')] = [self._system_response(idx)
+                                                  for idx in range(len(cumulation_inverter_data))]
+        self.responses[('meter',)] = [self._meter_response(idx) for idx in range(len(smart_meter_data))]
+        self.responses[('powerflow',)] = [self._power_flow_response(idx) for idx in range(len(power_flow_data))]
+        self.responses[('inverterinfo',)] = [self._inverter_info_response()]
+        self.responses[('activedeviceinfo',)] = [self._active_device_info_response()]
+
+    def _system_response(self, idx: int) -> Tuple[bytes, bytes]:
+        # the cumulated values of all inverters, keyed by device id
+        response = copy.deepcopy(cumulation_inverter_data[idx])
+        response['Head']['RequestArguments'] = {'DeviceClass': 'Inverter', 'Scope': 'System'}
+        data = {}
+        for device_id in range(1, self.inverters + 1):
+            sample = cumulation_inverter_data[(idx + device_id) % len(cumulation_inverter_data)]['Body']['Data']
+            for key in ['PAC', 'DAY_ENERGY', 'YEAR_ENERGY', 'TOTAL_ENERGY']:
+                value = sample.get(key) or {}
+                data.setdefault(key, {'Unit': value.get('Unit'), 'Values': {}})['Values'][str(device_id)] = \
+                    value.get('Value')
+        response['Body']['Data'] = data
+        return serialize(response)
+
+    def _active_device_info_response(self) -> Tuple[bytes, bytes]:
+        return serialize({
+            'Body': {'Data': {
+                str(device_id): {'DT': 1, 'Serial': inverter_serial(device_id)}
+                for device_id in range(1, self.inverters + 1)
+            }},
+            'Head': {'RequestArguments': {'DeviceClass': 'Inverter'},
+                     'Status': {'Code': 0, 'Reason': '', 'UserMessage': ''}, 'Timestamp': ''},
+        })
+
+    def _meter_response(self, idx: int) -> Tuple[bytes, bytes]:
+        response = copy.deepcopy(smart_meter_data[idx])
+        data = {}
+        for meter_id in range(self.meters):
+            meter = copy.deepcopy(next(iter(smart_meter_data[(idx + meter_id) % len(smart_meter_data)]['Body']['Data'].values())))
+            meter['Details']['Serial'] = meter_serial(meter_id)
+            data[str(meter_id)] = meter
+        response['Body']['Data'] = data
+        return serialize(response)
+
+    def _power_flow_response(self, idx: int) -> Tuple[bytes, bytes]:
+        response = copy.deepcopy(power_flow_data[idx])
+        template = next(iter(response['Body']['Data']['Inverters'].values()))
+        response['Body']['Data']['Inverters'] = {
+            str(device_id): copy.deepcopy(template) for device_id in range(1, self.inverters + 1)
+        }
+        return serialize(response)
+
+    def _inverter_info_response(self) -> Tuple[bytes, bytes]:
+        return serialize({
+            'Body': {'Data': {
+                str(device_id): {
+                    'CustomName': f'Inverter {device_id}',
+                    'DT': 1,
+                    'ErrorCode': 0,
+                    'PVPower': 10000,
+                    'Show': 1,
+                    'StatusCode': 7,
+                    'UniqueID': inverter_serial(device_id),
+                } for device_id in range(1, self.inverters + 1)
+            }},
+            'Head': {'RequestArguments': {}, 'Status': {'Code': 0, 'Reason': '', 'UserMessage': ''}, 'Timestamp': ''},
+        })
+
+    def get(self, key: Tuple) -> Optional[Tuple[bytes, bytes]]:
+        variants = self.responses.get(key)
+        return random.choice(variants) if variants else None
+
+
+# Sliding window of request start times per client, which allows max_parallel requests within min_gap seconds.
+class RateLimit:
+    def __init__(self, max_parallel: int, min_gap: float):
+        self.max_parallel = max_parallel
+        self.min_gap = min_gap
+        self.lock = threading.Lock()
+        self.requests: Dict[str, collections.deque] = collections.defaultdict(collections.deque)
+        self.throttled = 0
+
+    def acquire(self, client: str) -> Optional[float]:
+        # returns None if the request is allowed, otherwise the seconds until the next request is allowed
+        now = time.monotonic()
+        with self.lock:
+            starts = self.requests[client]
+            while starts and now - starts[0] >= self.min_gap:
+                starts.popleft()
+            if len(starts) >= self.max_parallel:
+                self.throttled += 1
+                return self.min_gap - (now - starts[0])
+            starts.append(now)
+            return None
+
+
+def sample_latency(spec: str) -> float:
+    kind, *params = spec.split(':')
+    if kind == 'fixed':
+        return float(params[0]) if params else 0.0
+    if kind == 'uniform':
+        return random.uniform(float(params[0]), float(params[1]))
+    if kind == 'lognormal':
+        median, sigma = float(params[0]), float(params[1])
+        return random.lognormvariate(0.0, sigma) * median
+    raise ValueError(f'invalid latency distribution: {spec}')
+
+
+fleet: Fleet = None
+rate_limit: RateLimit = None
+
+
+def setup():
+    global fleet, rate_limit
+    sample_latency(FleetConfig.latency)
+    fleet = Fleet(FleetConfig.inverters, FleetConfig.meters)
+    rate_limit = RateLimit(FleetConfig.max_parallel_requests, FleetConfig.min_request_gap)
+    app.logger.info(f'serving {FleetConfig.inverters} inverters and {FleetConfig.meters} meters')
+
+
+def respond(key: Tuple, request_arguments: Dict, body: Optional[Tuple[bytes, bytes]] = None) -> Response:
+    if FleetConfig.rate_limit:
+        retry_after = rate_limit.acquire(request.remote_addr)
+        if retry_after is not None:
+            response = Response('Too Many Requests', status=429)
+            response.headers['Retry-After'] = f'{max(1, round(retry_after))}'
+            return response
+
+    if FleetConfig.timeout_rate and random.random() < FleetConfig.timeout_rate:
+        time.sleep(FleetConfig.timeout)
+    else:
+        latency = sample_latency(FleetConfig.latency)
+        if latency > 0.0:
+            time.sleep(latency)
+
+    if body is None:
+        body = fleet.get(key)
+    if body is None:
+        body = error_response(request_arguments, DEVICE_NOT_AVAILABLE)
+    elif FleetConfig.error_rate and random.random() < FleetConfig.error_rate:
+        body = error_response(request_arguments, random.choice(list(ERROR_CODES)))
+
+    prefix, suffix = body
+    now = datetime.datetime.now(tz=TIMEZONE).isoformat('T')
+    return Response(b''.join([prefix, now.encode('utf-8'), suffix]), mimetype='application/json')
 
 
 @app.route('/solar_api/v1/GetInverterRealtimeData.cgi', methods=['GET'])
-def get_inverter_realtime_data() -> str:
+def get_inverter_realtime_data() -> Response:
     scope = request.args.get('Scope')
     data_collection = request.args.get('DataCollection')
     device_id = request.args.get('DeviceId')
 
-    now = datetime.datetime.now(tz=TIMEZONE).isoformat('T')
-    if data_collection == 'CommonInverterData':
-        json_response = random.choice(common_inverter_data)
-    elif data_collection == '3PInverterData':
-        json_response = random.choice(threep_inverter_data)
-    elif data_collection == 'MinMaxInverterData':
-        json_response = random.choice(min_max_inverter_data)
-    elif data_collection == 'CumulationInverterData':
-        json_response = random.choice(cumulation_inverter_data)
-    else:
-        json_response = {}
-
-    if json_response:
-        json_response['Head']['Timestamp'] = now
-    return json_response
+    if scope == 'System':
+        return respond(('inverter', 'System'), {'DeviceClass': 'Inverter', 'Scope': scope})
+    if scope != 'Device':
+        flask.abort(400, f'No sample data for scope: {scope}')
+    return respond(('inverter', data_collection, device_id), {
+        'DataCollection': data_collection,
+        'DeviceClass': 'Inverter',
+        'DeviceId': device_id,
+        'Scope': scope,
+    })
 
 
 @app.route('/solar_api/v1/GetPowerFlowRealtimeData.fcgi', methods=['GET'])
-def get_power_flow_data() -> str:
-    json_response = random.choice(power_flow_data)
-    json_response['Head']['Timestamp'] = datetime.datetime.now(tz=TIMEZONE).isoformat('T')
-    return json_response
+def get_power_flow_data() -> Response:
+    return respond(('powerflow',), {})
 
 
 @app.route('/solar_api/v1/GetMeterRealtimeData.cgi', methods=['GET'])
-def get_smart_meter_data() -> str:
+def get_smart_meter_data() -> Response:
     scope = request.args.get('Scope')
 
-    if scope == 'System':
-        json_response = random.choice(smart_meter_data)
-        json_response['Head']['Timestamp'] = datetime.datetime.now(tz=TIMEZONE).isoformat('T')
-    else:
-        json_response = {}
+    if scope != 'System':
         flask.abort(400, f'No sample data for scope: {scope}')
-    return json_response
+    return respond(('meter',), {'Scope': scope})
+
+
+@app.route('/solar_api/v1/GetInverterInfo.cgi', methods=['GET'])
+def get_inverter_info() -> Response:
+    return respond(('inverterinfo',), {})
+
+
+@app.route('/solar_api/v1/GetActiveDeviceInfo.cgi', methods=['GET'])
+def get_active_device_info() -> Response:
+    device_class = request.args.get('DeviceClass')
+
+    if device_class != 'Inverter':
+        flask.abort(400, f'No sample data for device class: {device_class}')
+    return respond(('activedeviceinfo',), {'DeviceClass': device_class})
+
+
+# archive channels with the field of the realtime samples by device type
+ARCHIVE_CHANNELS = {
+    'inverter': {
+        'PowerReal_PAC_Sum': ('CommonInverterData', 'PAC'),
+        'Voltage_DC_String_1': ('CommonInverterData', 'UDC'),
+        'Current_DC_String_1': ('CommonInverterData', 'IDC'),
+    },
+    'meter': {
+        'PowerReal_PAC_Sum': ('MeterRealtimeData', 'PowerReal_P_Sum'),
+        'EnergyReal_WAC_Plus_Absolute': ('MeterRealtimeData', 'EnergyReal_WAC_Plus_Absolute'),
+        'EnergyReal_WAC_Minus_Absolute': ('MeterRealtimeData', 'EnergyReal_WAC_Minus_Absolute'),
+    },
+}
+ARCHIVE_PERIOD = 300
+
+
+def archive_values(device_type: str, field: str, count: int) -> Dict[str, float]:
+    values = {}
+    for idx in range(count):
+        if device_type == 'inverter':
+            value = common_inverter_data[idx % len(common_inverter_data)]['Body']['Data'].get(field, {}).get('Value')
+        else:
+            value = next(iter(smart_meter_data[idx % len(smart_meter_data)]['Body']['Data'].values())).get(field)
+        if value is not None:
+            values[str(idx * ARCHIVE_PERIOD)] = value
+    return values
+
+
+@app.route('/solar_api/v1/GetArchiveData.cgi', methods=['GET'])
+def get_archive_data() -> Response:
+    # synthetic 5 minute values of the samples for every requested channel
+    try:
+        start = datetime.datetime.fromisoformat(request.args['StartDate'])
+        end = datetime.datetime.fromisoformat(request.args['EndDate'])
+    except (KeyError, ValueError):
+        flask.abort(400, 'StartDate and EndDate are required')
+    if start.tzinfo is None:
+        start, end = TIMEZONE.localize(start), TIMEZONE.localize(end)
+    channels = request.args.getlist('Channel')
+    count = int((end - start).total_seconds()) // ARCHIVE_PERIOD + 1
+
+    devices = {f'inverter/{device_id}': 'inverter' for device_id in range(1, fleet.inverters + 1)}
+    devices.update({f'meter:{meter_serial(meter_id)}': 'meter' for meter_id in range(fleet.meters)})
+    data = {}
+    for device, device_type in devices.items():
+        data[device] = {
+            'Start': start.isoformat('T'),
+            'End': end.isoformat('T'),
+            'Data': {
+                channel: {'Unit': '', 'Values': archive_values(device_type, field, count)}
+                for channel, (_, field) in ARCHIVE_CHANNELS[device_type].items() if channel in channels
+            },
+        }
+    request_arguments = {'Scope': 'System', 'StartDate': request.args['StartDate'],
+                         'EndDate': request.args['EndDate'], 'Channel': channels}
+    return respond(('archive',), request_arguments, serialize({
+        'Body': {'Data': data},
+        'Head': {
+            'RequestArguments': request_arguments,
+            'Status': {'Code': 0, 'Reason': '', 'UserMessage': ''},
+            'Timestamp': '',
+        },
+    }))
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats() -> Dict:
+    return {'throttled': rate_limit.throttled}
+
+
+setup()
 
 
 if __name__ == '__main__':
-    app.run(threaded=True)
+    parser = argparse.ArgumentParser(prog='Fronius Solar API mock server',
+                                     description='Serve the sample data for a fleet of virtual inverters and meters')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--inverters', type=int, default=FleetConfig.inverters, help='Number of virtual inverters')
+    parser.add_argument('--meters', type=int, default=FleetConfig.meters, help='Number of virtual meters')
+    parser.add_argument('--latency', type=str, default=FleetConfig.latency,
+                        help="Response latency: 'fixed:<s>', 'uniform:<min s>:<max s>' or 'lognormal:<median s>:<sigma>'")
+    parser.add_argument('--error-rate', type=float, default=FleetConfig.error_rate,
+                        help='Fraction of responses with a non-zero status code')
+    parser.add_argument('--timeout-rate', type=float, default=FleetConfig.timeout_rate,
+                        help='Fraction of requests answered only after the timeout')
+    parser.add_argument('--timeout', type=float, default=FleetConfig.timeout, help='Timeout in seconds')
+    parser.add_argument('--rate-limit', action='store_true', default=FleetConfig.rate_limit,
+                        help='Answer requests exceeding the API rate limit with HTTP 429')
+    args = parser.parse_args()
+
+    FleetConfig.inverters = args.inverters
+    FleetConfig.meters = args.meters
+    FleetConfig.latency = args.latency
+    FleetConfig.error_rate = args.error_rate
+    FleetConfig.timeout_rate = args.timeout_rate
+    FleetConfig.timeout = args.timeout
+    FleetConfig.rate_limit = args.rate_limit
+    setup()
+
+    app.run(host=args.host, port=args.port, threaded=True)
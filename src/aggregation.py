@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from line_protocol import to_nanoseconds
+
+
+# running statistics of one field within one window
+class _Accumulator:
+    __slots__ = ('count', 'min', 'max', 'sum', 'last', 'last_ns')
+
+    def __init__(self, value, timestamp: int):
+        self.count = 1
+        self.min = self.max = self.last = value
+        self.sum = value if _is_number(value) else 0.0
+        self.last_ns = timestamp
+
+    def add(self, value, timestamp: int):
+        self.count += 1
+        if _is_number(value) and _is_number(self.min):
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+            self.sum += value
+        # out-of-order samples must not overwrite the last value
+        if timestamp >= self.last_ns:
+            self.last = value
+            self.last_ns = timestamp
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _Series:
+    __slots__ = ('measurement', 'tags', 'watermark', 'closed', 'windows', 'touched')
+
+    def __init__(self, measurement: str, tags: Optional[Dict]):
+        self.measurement = measurement
+        self.tags = tags
+        # latest sample timestamp in ns
+        self.watermark = 0
+        # start of the oldest window per window size which still accepts samples
+        self.closed: Dict[int, int] = {}
+        # open windows by (window size, window start)
+        self.windows: Dict[Tuple[int, int], Dict[str, _Accumulator]] = {}
+        self.touched = time.monotonic()
+
+
+# Aggregates data points into wall-clock aligned windows and emits min, max, mean, last and count of every field
+# to the measurement "<measurement>_<window>s" once a window is complete.
+# Windows stay open for the allowed lateness after their end, later samples are dropped.
+class WindowAggregator:
+    def __init__(self, windows: List[float], allowed_lateness: float = 5.0, keep_raw: bool = False,
+                 measurements: Optional[List[str]] = None, max_series: int = 1000):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.windows = sorted(int(window * 1e9) for window in windows)
+        self.lateness_ns = int(allowed_lateness * 1e9)
+        self.keep_raw = keep_raw
+        self.measurements = set(measurements) if measurements else None
+        self.max_series = max_series
+
+        # series which did not receive samples for the longest window are closed by wall-clock time
+        self.idle_timeout = (self.windows[-1] + self.lateness_ns) / 1e9
+
+        self._lock = threading.Lock()
+        self._series: 'OrderedDict[Tuple, _Series]' = OrderedDict()
+        # closed windows of evicted series, so a returning series does not emit a window again with its late samples
+        self._evicted: 'OrderedDict[Tuple, Dict[int, int]]' = OrderedDict()
+
+        self.samples = 0
+        self.emitted = 0
+        self.late = 0
+
+    def process(self, points: List[Dict]) -> List[Dict]:
+        output = []
+        with self._lock:
+            for point in points:
+                if self.measurements is not None and point['measurement'] not in self.measurements:
+                    output.append(point)
+                    continue
+                if self.keep_raw:
+                    output.append(point)
+                self._add(point, output)
+            self._close_idle(output)
+        return output
+
+    def _add(self, point: Dict, output: List[Dict]):
+        tags = point.get('tags')
+        key = (point['measurement'], tuple(tags.items()) if tags else ())
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(point['measurement'], tags)
+            series.closed = self._evicted.pop(key, series.closed)
+            if len(self._series) > self.max_series:
+                evicted_key, evicted = self._series.popitem(last=False)
+                self._close(evicted, None, output)
+                self._evicted[evicted_key] = evicted.closed
+                if len(self._evicted) > self.max_series:
+                    self._evicted.popitem(last=False)
+        else:
+            self._series.move_to_end(key)
+        series.touched = time.monotonic()
+
+        timestamp = to_nanoseconds(point['time']) if point.get('time') is not None else time.time_ns()
+        for window in self.windows:
+            start = timestamp - timestamp % window
+            if start < series.closed.get(window, 0):
+                self.late += 1
+                continue
+
+            accumulators = series.windows.get((window, start))
+            if accumulators is None:
+                accumulators = series.windows[(window, start)] = {}
+            for field, value in point['fields'].items():
+                if value is None:
+                    continue
+                accumulator = accumulators.get(field)
+                if accumulator is None:
+                    accumulators[field] = _Accumulator(value, timestamp)
+                else:
+                    accumulator.add(value, timestamp)
+        self.samples += 1
+
+        if timestamp > series.watermark:
+            series.watermark = timestamp
+            self._close(series, series.watermark - self.lateness_ns, output)
+
+    def _close(self, series: _Series, until: Optional[int], output: List[Dict]):
+        # emit all windows which end before the given timestamp, or all windows
+        for window, start in sorted(series.windows):
+            end = start + window
+            if until is not None and end > until:
+                continue
+            accumulators = series.windows.pop((window, start))
+            series.closed[window] = max(series.closed.get(window, 0), end)
+            point = self._emit(series, window, start, accumulators)
+            if point:
+                output.append(point)
+
+    def _close_idle(self, output: List[Dict]):
+        now = time.monotonic()
+        for series in self._series.values():
+            if series.windows and now - series.touched > self.idle_timeout:
+                self._close(series, None, output)
+
+    def _emit(self, series: _Series, window: int, start: int, accumulators: Dict[str, _Accumulator]) -> Optional[Dict]:
+        fields = {}
+        for field, accumulator in accumulators.items():
+            if _is_number(accumulator.min):
+                fields[f'{field}_min'] = accumulator.min
+                fields[f'{field}_max'] = accumulator.max
+                fields[f'{field}_mean'] = accumulator.sum / accumulator.count
+            fields[f'{field}_last'] = accumulator.last
+            fields[f'{field}_count'] = accumulator.count
+        if not fields:
+            return None
+
+        self.emitted += 1
+        return {
+            'measurement': f'{series.measurement}_{window // 10 ** 9}s',
+            'tags': series.tags,
+            'time': start,
+            'fields': fields,
+        }
+
+    def flush(self) -> List[Dict]:
+        output = []
+        with self._lock:
+            for series in self._series.values():
+                self._close(series, None, output)
+        return output
+
+    def report(self) -> List[str]:
+        with self._lock:
+            open_windows = sum(len(series.windows) for series in self._series.values())
+            return [f"aggregation: {len(self._series)} series, {open_windows} open windows, "
+                    f"samples={self.samples}, emitted={self.emitted}, late={self.late}"]
@@ -0,0 +1,334 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+from influxdb_client import InfluxDBClient
+
+from data_processor import DataProcessor
+from decoder import ResponseDecoder
+from http_client import SessionPool
+from influx_writer import BatchingWriter
+from scheduler import RateLimiter
+from solar_schedule import SolarSchedule
+
+# maximum time span of one archive request
+MAX_CHUNK_DAYS = 16
+
+# archive channels by device type, mapped to the measurement and field of the realtime data
+ARCHIVE_CHANNELS: Dict[str, Dict[str, Tuple[str, str]]] = {
+    'inverter': {
+        'PowerReal_PAC_Sum': ('CommonInverterData', 'PAC'),
+        'Current_DC_String_1': ('CommonInverterData', 'IDC_MPP1'),
+        'Voltage_DC_String_1': ('CommonInverterData', 'UDC_MPP1'),
+        'Current_DC_String_2': ('CommonInverterData', 'IDC_MPP2'),
+        'Voltage_DC_String_2': ('CommonInverterData', 'UDC_MPP2'),
+        'Current_AC_Phase_1': ('3PInverterData', 'IAC_L1'),
+        'Current_AC_Phase_2': ('3PInverterData', 'IAC_L2'),
+        'Current_AC_Phase_3': ('3PInverterData', 'IAC_L3'),
+        'Voltage_AC_Phase_1': ('3PInverterData', 'UAC_L1'),
+        'Voltage_AC_Phase_2': ('3PInverterData', 'UAC_L2'),
+        'Voltage_AC_Phase_3': ('3PInverterData', 'UAC_L3'),
+    },
+    'meter': {
+        'PowerReal_PAC_Sum': ('MeterRealtimeData', 'P_Sum'),
+        'EnergyReal_WAC_Plus_Absolute': ('MeterRealtimeData', 'E_WAC_Plus_Absolute'),
+        'EnergyReal_WAC_Minus_Absolute': ('MeterRealtimeData', 'E_WAC_Minus_Absolute'),
+        'Meter_Location_Current': ('MeterRealtimeData', 'Meter_Location_Current'),
+        'Current_AC_Phase_1': ('MeterRealtimeData', 'IAC_L1'),
+        'Current_AC_Phase_2': ('MeterRealtimeData', 'IAC_L2'),
+        'Current_AC_Phase_3': ('MeterRealtimeData', 'IAC_L3'),
+        'Voltage_AC_Phase_1': ('MeterRealtimeData', 'UAC_L1'),
+        'Voltage_AC_Phase_2': ('MeterRealtimeData', 'UAC_L2'),
+        'Voltage_AC_Phase_3': ('MeterRealtimeData', 'UAC_L3'),
+    },
+}
+
+DEFAULT_CHANNELS = sorted({channel for channels in ARCHIVE_CHANNELS.values() for channel in channels})
+
+# series of the realtime data whose gaps are backfilled from the archive, by metric, and whether they stop at night
+GAP_SERIES: Dict[str, Tuple[str, str, bool]] = {
+    'CommonInverterData': ('CommonInverterData', 'PAC', True),
+    '3PInverterData': ('3PInverterData', 'IAC_L1', True),
+    'MeterRealtimeData': ('MeterRealtimeData', 'P_Sum', False),
+}
+
+
+def subtract_periods(gaps: List[Tuple[datetime.datetime, datetime.datetime]],
+                     periods: List[Tuple[datetime.datetime, datetime.datetime]]) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+    for period_start, period_end in periods:
+        remaining = []
+        for start, end in gaps:
+            if period_end <= start or period_start >= end:
+                remaining.append((start, end))
+                continue
+            if start < period_start:
+                remaining.append((start, period_start))
+            if period_end < end:
+                remaining.append((period_end, end))
+        gaps = remaining
+    return gaps
+
+
+def merge_periods(periods: List[Tuple[datetime.datetime, datetime.datetime]]) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+    merged = []
+    for start, end in sorted(periods):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def split_range(start: datetime.datetime, end: datetime.datetime,
+                chunk: datetime.timedelta) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+    chunks = []
+    while start < end:
+        chunks.append((start, min(start + chunk, end)))
+        start += chunk
+    return chunks
+
+
+# JSON file with the progress of every requested range: {"<from>/<to>": "<start of the next chunk>"}
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self.ranges: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.ranges = json.load(f)
+
+    @staticmethod
+    def key(start: datetime.datetime, end: datetime.datetime) -> str:
+        return f"{start.isoformat()}/{end.isoformat()}"
+
+    def resume(self, start: datetime.datetime, end: datetime.datetime) -> datetime.datetime:
+        done = self.ranges.get(self.key(start, end))
+        return datetime.datetime.fromisoformat(done) if done else start
+
+    def update(self, start: datetime.datetime, end: datetime.datetime, done: datetime.datetime):
+        self.ranges[self.key(start, end)] = min(done, end).isoformat()
+        self._save()
+
+    def prune(self, before: datetime.datetime):
+        # forget completed ranges which end before the given time
+        for key, done in list(self.ranges.items()):
+            end = datetime.datetime.fromisoformat(key.split('/')[1])
+            if end < before and datetime.datetime.fromisoformat(done) >= end:
+                del self.ranges[key]
+        self._save()
+
+    def _save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.ranges, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+
+# Reads the archive of the Datamanager with GetArchiveData.cgi and writes it to the measurements of the realtime
+# data with the archive timestamps. Writing a range again overwrites the same points, so ranges can be retried.
+class Backfill:
+    def __init__(self, base_url: str, influx_client: InfluxDBClient, bucket: str, writer: BatchingWriter,
+                 http: SessionPool, decoder: ResponseDecoder, processor: DataProcessor,
+                 checkpoint_file: str, chunk_days: float = 1.0, channels: Optional[List[str]] = None,
+                 min_request_gap: float = 4.0, metrics: Optional[List[str]] = None,
+                 schedule: Optional[SolarSchedule] = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.base_url = base_url
+        self.influx_client = influx_client
+        self.bucket = bucket
+        self.writer = writer
+        self.http = http
+        self.decoder = decoder
+        self.processor = processor
+        self.checkpoint = Checkpoint(checkpoint_file)
+        self.chunk = datetime.timedelta(days=min(chunk_days, MAX_CHUNK_DAYS))
+        self.channels = channels or DEFAULT_CHANNELS
+        self.min_request_gap = min_request_gap
+        # the gap detection uses the polled series of the archive, and skips the nights and paused phases
+        self.gap_series = [GAP_SERIES[metric] for metric in (metrics or ['CommonInverterData']) if metric in GAP_SERIES]
+        self.schedule = schedule
+
+        # tags of the realtime meter data by serial number
+        self.meter_tags: Dict[str, Dict] = {}
+        self._last_request = 0.0
+        # the rate limiter of the running poll scheduler, which is shared while polling
+        self.limiter: Optional[RateLimiter] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop = threading.Event()
+
+        self.requests = 0
+        self.points = 0
+
+    def _get(self, route: str, params: Dict) -> Dict:
+        url = f"{self.base_url}/{route}?{urllib.parse.urlencode(params, doseq=True)}"
+
+        # archive requests count to the same rate limit as the realtime requests
+        if self.limiter:
+            slot = asyncio.run_coroutine_threadsafe(self.limiter.acquire(), self.loop).result()
+            try:
+                response = self.http.get(url)
+            finally:
+                self.loop.call_soon_threadsafe(self.limiter.release, slot)
+        else:
+            delay = self._last_request + self.min_request_gap - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            self._last_request = time.monotonic()
+            response = self.http.get(url)
+
+        response.raise_for_status()
+        self.requests += 1
+        return self.decoder.decode(response.content)
+
+    def _update_devices(self):
+        if not self.processor.inverter_map:
+            self.processor.update_inverters(self._get('GetInverterInfo.cgi', {}))
+        if not self.meter_tags:
+            meters = self._get('GetMeterRealtimeData.cgi', {'Scope': 'System'})
+            for point in self.processor.process_points('MeterRealtimeData', meters):
+                self.meter_tags[point['tags']['Serial']] = point['tags']
+
+    def _tags(self, device_type: str, device_id: str) -> Optional[Dict]:
+        if device_type == 'inverter':
+            return self.processor.devices.tags(device_id)
+        if device_type == 'meter':
+            return self.meter_tags.get(device_id, {'Serial': device_id})
+        return None
+
+    def process(self, response: Dict) -> List[Dict]:
+        points: Dict[Tuple, Dict] = {}
+        for device, device_data in response['Body']['Data'].items():
+            # devices are named 'inverter/<device id>' or 'meter:<serial>'
+            device_type, _, device_id = device.replace(':', '/').partition('/')
+            channels = ARCHIVE_CHANNELS.get(device_type)
+            tags = self._tags(device_type, device_id)
+            if not channels or tags is None or not device_data.get('Data'):
+                continue
+
+            start = datetime.datetime.fromisoformat(device_data['Start'])
+            for channel, series in device_data['Data'].items():
+                if channel not in channels:
+                    continue
+                measurement, field = channels[channel]
+                for offset, value in series.get('Values', {}).items():
+                    if value is None:
+                        continue
+                    timestamp = start + datetime.timedelta(seconds=int(offset))
+                    key = (measurement, device, timestamp)
+                    point = points.get(key)
+                    if point is None:
+                        point = points[key] = {
+                            'measurement': measurement,
+                            'time': timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None).isoformat(),
+                            'fields': {},
+                            'tags': tags,
+                        }
+                    point['fields'][field] = float(value)
+        return list(points.values())
+
+    def run(self, start: datetime.datetime, end: datetime.datetime):
+        self._update_devices()
+
+        resume = self.checkpoint.resume(start, end)
+        if resume >= end:
+            self.logger.info(f"backfill {start} - {end} is already complete")
+            return
+        if resume > start:
+            self.logger.info(f"resuming backfill {start} - {end} at {resume}")
+
+        for chunk_start, chunk_end in split_range(resume, end, self.chunk):
+            if self._stop.is_set():
+                return
+            response = self._get('GetArchiveData.cgi', {
+                'Scope': 'System',
+                'SeriesType': 'Detail',
+                'HumanReadable': 'false',
+                'StartDate': chunk_start.isoformat(),
+                # the end date is inclusive
+                'EndDate': (chunk_end - datetime.timedelta(seconds=1)).isoformat(),
+                'Channel': self.channels,
+            })
+            code = response['Head']['Status']['Code']
+            if code != 0:
+                raise RuntimeError(f"archive request {chunk_start} - {chunk_end} failed: code={code} "
+                                   f"{response['Head']['Status'].get('Reason', '')}")
+
+            points = self.process(response)
+            failed, dropped = self.writer.failed, self.writer.dropped
+            self.writer.write(points)
+            # the progress is saved once the points are written (or spooled), otherwise the chunk is retried
+            if not self.writer.flush() or self.writer.failed > failed or self.writer.dropped > dropped:
+                raise RuntimeError(f"writing the backfill {chunk_start} - {chunk_end} failed")
+            self.checkpoint.update(start, end, chunk_end)
+            self.points += len(points)
+            self.logger.info(f"backfilled {chunk_start} - {chunk_end}: {len(points)} points")
+
+        self.logger.info(f"backfill {start} - {end} complete: {self.requests} requests, {self.points} points")
+
+    def detect_gaps(self, lookback: datetime.timedelta,
+                    min_gap: datetime.timedelta) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        paused = self.schedule.paused_phases() if self.schedule else []
+        gaps = []
+        for measurement, field, nightly in self.gap_series:
+            series_gaps = self._detect_series_gaps(lookback, min_gap, measurement, field, now)
+            if self.schedule:
+                # e.g. the inverter is switched off at night, or polling was paused by the solar schedule
+                phases = paused + ['night'] if nightly and 'night' not in paused else paused
+                series_gaps = subtract_periods(series_gaps, self.schedule.periods(now - lookback, now, phases))
+            gaps.extend(gap for gap in series_gaps if gap[1] - gap[0] > min_gap)
+
+        # whole minutes to get stable checkpoint keys
+        return merge_periods([(start.replace(second=0, microsecond=0), end.replace(second=0, microsecond=0) +
+                               datetime.timedelta(minutes=1)) for start, end in gaps])
+
+    def _detect_series_gaps(self, lookback: datetime.timedelta, min_gap: datetime.timedelta, measurement: str,
+                            field: str, now: datetime.datetime) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+        # gaps between consecutive points of the given field, and between the last point and now
+        query = f'''
+            from(bucket: "{self.bucket}")
+              |> range(start: -{int(lookback.total_seconds())}s)
+              |> filter(fn: (r) => r._measurement == "{measurement}" and r._field == "{field}")
+              |> keep(columns: ["_time"])
+              |> sort(columns: ["_time"])
+              |> elapsed(unit: 1s)
+              |> filter(fn: (r) => r.elapsed > {int(min_gap.total_seconds())})
+        '''
+        gaps = []
+        for table in self.influx_client.query_api().query(query):
+            for record in table.records:
+                end = record.get_time()
+                gaps.append((end - datetime.timedelta(seconds=record['elapsed']), end))
+
+        last_query = f'''
+            from(bucket: "{self.bucket}")
+              |> range(start: -{int(lookback.total_seconds())}s)
+              |> filter(fn: (r) => r._measurement == "{measurement}" and r._field == "{field}")
+              |> keep(columns: ["_time", "_value"])
+              |> last()
+        '''
+        last = [record.get_time() for table in self.influx_client.query_api().query(last_query)
+                for record in table.records]
+        latest = max(last) if last else now - lookback
+        if now - latest > min_gap:
+            gaps.append((latest, now))
+        return gaps
+
+    def run_gaps(self, lookback: datetime.timedelta, min_gap: datetime.timedelta):
+        self.checkpoint.prune(datetime.datetime.now(tz=datetime.timezone.utc) - lookback)
+        if not self.gap_series:
+            self.logger.info("none of the metrics is archived, no gap detection")
+            return
+        gaps = self.detect_gaps(lookback, min_gap)
+        self.logger.info(f"detected {len(gaps)} gaps in the last {lookback}")
+        for start, end in gaps:
+            self.run(start, end)
+
+    def stop(self):
+        self._stop.set()
@@ -1,64 +1,564 @@
-from typing import Tuple, Dict, List
+import os
+import urllib.parse
+from typing import Tuple, Dict, List, Optional
 
 import yaml
 from astral import LocationInfo
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from astral.location import Location
 
 
 @dataclass
 class Config:
+    @dataclass
+    class Modbus:
+        host: str
+        port: int
+        # Modbus unit ids by device id of the inverters and meters
+        units: Dict[str, int]
+        meters: Dict[str, int]
+        interval: float
+        timeout: float
+
     @dataclass
     class Inverter:
         url: str
         name: str
         device_id: int
         metrics: List[str]
+        connect_timeout: float
+        read_timeout: float
+        max_connections: int
+        site: Optional[str] = None
+        # all inverters behind the url (e.g. of a Datamanager), the device id above is the first one
+        device_ids: List[int] = field(default_factory=list)
+        # requested fields per measurement for the request planner (default: all fields)
+        fields: Optional[Dict[str, List[str]]] = None
+        # lifetime of the serial numbers in seconds and whether GetActiveDeviceInfo.cgi is queried as well
+        device_info_ttl: float = 3600.0
+        active_device_info: bool = False
+        # 'http' (Solar API) or 'modbus' (SunSpec Modbus TCP for the metrics it provides)
+        source: str = 'http'
+        modbus: Optional['Config.Modbus'] = None
 
     @dataclass
     class Record:
         influxdb_bucket: str
         request_interval: float
+        max_parallel_requests: int
+        min_request_gap: float
         ignore_sunset: bool
+        batch_size: int
+        flush_interval: float
+        max_queue_mb: float
+        line_protocol: bool
+        json_backend: str
+        plan_requests: bool
+        columnar: bool
+
+    @dataclass
+    class Spool:
+        directory: str
+        max_mb: float
+        segment_mb: float
+        fsync: str
+        replay_rate: float
+
+    @dataclass
+    class Deadband:
+        heartbeat: float
+        absolute: float
+        relative: float
+        measurements: Dict[str, Dict]
+        max_series: int
+
+    @dataclass
+    class Aggregation:
+        windows: List[int]
+        allowed_lateness: float
+        keep_raw: bool
+        measurements: Optional[List[str]]
+        max_series: int
+
+    @dataclass
+    class Schedule:
+        night_interval: Optional[float]
+        twilight_interval: Optional[float]
+        day_interval: Optional[float]
+        midday_interval: Optional[float]
+        midday_window: float
+        idle_interval: Optional[float]
+
+    @dataclass
+    class Backfill:
+        checkpoint_file: str
+        chunk_days: float
+        channels: Optional[List[str]]
+        gap_detection: bool
+        lookback_days: float
+        min_gap: float
+
+    @dataclass
+    class Metrics:
+        host: str
+        port: int
+
+    @dataclass
+    class Live:
+        host: str
+        port: int
+        history: int
+        max_series: int
+        measurements: Optional[List[str]]
+
+    @dataclass
+    class Parquet:
+        directory: str
+        partition: str
+        compression: str
+        row_group_rows: int
+        flush_interval: float
+        max_queue_points: int
+
+    @dataclass
+    class Recorder:
+        directory: str
+        segment_mb: float
+        segment_interval: float
+        max_mb: float
+
+    @dataclass
+    class RateControl:
+        latency_target: float
+        step: float
+        backoff: float
+        min_factor: float
+        max_factor: float
+        failure_threshold: int
+        open_seconds: float
+        max_open_seconds: float
+
+    @dataclass
+    class PipelineStage:
+        workers: int
+        queue: int
+        overflow: str
+
+    @dataclass
+    class Pipeline:
+        decode: 'Config.PipelineStage'
+        process: 'Config.PipelineStage'
+        write: 'Config.PipelineStage'
+        # spilled responses of the decode and process stages, replayable with --replay
+        spill_directory: Optional[str] = None
+
+    @dataclass
+    class Derived:
+        window: int
+        max_gap: float
+        # derived fields per measurement: {measurement: {field: formula}}, None for the default formulas
+        formulas: Optional[Dict[str, Dict[str, str]]]
+        max_series: int
+
+    @dataclass
+    class Fleet:
+        workers: int
+        restart_delay: float
+        max_restarts: int
+        report_interval: float
 
     inverter: Inverter
     record: Record
     location: Location
+    schedule: Schedule
+    spool: Optional[Spool] = None
+    deadband: Optional[Deadband] = None
+    aggregation: Optional[Aggregation] = None
+    backfill: Optional[Backfill] = None
+    metrics: Optional[Metrics] = None
+    # all inverters (the first one is also the inverter above) and the locations of their sites
+    inverters: List[Inverter] = field(default_factory=list)
+    sites: Dict[str, Location] = field(default_factory=dict)
+    fleet: Optional[Fleet] = None
+    live: Optional[Live] = None
+    parquet: Optional[Parquet] = None
+    recorder: Optional[Recorder] = None
+    rate_control: Optional[RateControl] = None
+    pipeline: Optional[Pipeline] = None
+    derived: Optional[Derived] = None
+
+
+def _load_inverter(inverter_cfg: Dict) -> Config.Inverter:
+    # a single device id or a list of device ids
+    device_ids = inverter_cfg['device_id']
+    if not isinstance(device_ids, list):
+        device_ids = [device_ids]
+    if not device_ids:
+        raise ValueError(f"no device id of inverter {inverter_cfg['name']}")
+
+    inverter = Config.Inverter(
+        name=inverter_cfg['name'],
+        url=inverter_cfg['url'],
+        device_id=device_ids[0],
+        metrics=inverter_cfg['metrics'],
+        connect_timeout=inverter_cfg.get('connect_timeout', 3.0),
+        read_timeout=inverter_cfg.get('read_timeout', 10.0),
+        max_connections=inverter_cfg.get('max_connections', 2),
+        site=inverter_cfg.get('site'),
+        device_ids=device_ids,
+        fields=inverter_cfg.get('fields'),
+        device_info_ttl=inverter_cfg.get('device_info_ttl', 3600.0),
+        active_device_info=inverter_cfg.get('active_device_info', False),
+    )
+
+    if inverter.connect_timeout <= 0.0 or inverter.read_timeout <= 0.0:
+        raise ValueError(f'invalid timeouts: connect={inverter.connect_timeout} s, read={inverter.read_timeout} s')
+    if inverter.max_connections < 1:
+        raise ValueError(f'invalid number of connections: {inverter.max_connections}')
+    if inverter.device_info_ttl < 60.0:
+        raise ValueError(f'invalid device info TTL: {inverter.device_info_ttl} s')
+
+    inverter.source = inverter_cfg.get('source', 'http')
+    if inverter.source not in ['http', 'modbus']:
+        raise ValueError(f'invalid source of inverter {inverter.name}: {inverter.source}')
+    if inverter.source == 'modbus':
+        modbus_cfg = inverter_cfg.get('modbus') or {}
+        inverter.modbus = Config.Modbus(
+            host=modbus_cfg.get('host', urllib.parse.urlsplit(inverter.url).hostname),
+            port=modbus_cfg.get('port', 502),
+            units={str(device_id): int(unit) for device_id, unit in
+                   (modbus_cfg.get('units') or {device_id: device_id for device_id in device_ids}).items()},
+            meters={str(meter_id): int(unit) for meter_id, unit in (modbus_cfg.get('meters') or {0: 200}).items()},
+            interval=modbus_cfg.get('interval', 1.0),
+            timeout=modbus_cfg.get('timeout', 3.0),
+        )
+        if not 0 < inverter.modbus.port < 65536:
+            raise ValueError(f'invalid Modbus port: {inverter.modbus.port}')
+        if inverter.modbus.interval < 0.1:
+            raise ValueError(f'invalid Modbus interval: {inverter.modbus.interval} s')
+        if inverter.modbus.timeout <= 0.0:
+            raise ValueError(f'invalid Modbus timeout: {inverter.modbus.timeout} s')
+    return inverter
+
+
+def _load_location(location_cfg: Dict) -> Location:
+    return Location(LocationInfo(
+        name=location_cfg['name'],
+        region=location_cfg['region'],
+        timezone=location_cfg['timezone'],
+        latitude=location_cfg['latitude'],
+        longitude=location_cfg['longitude'],
+    ))
 
 
 def load_config(config_path: str) -> Config:
     with open(config_path, "r") as yml_file:
         cfg = yaml.load(yml_file, Loader=yaml.FullLoader)
-        inverter = Config.Inverter(
-            name=cfg['inverter']['name'],
-            url=cfg['inverter']['url'],
-            device_id=cfg['inverter']['device_id'],
-            metrics=cfg['inverter']['metrics']
-        )
+        # a single inverter or a fleet of inverters
+        inverters = [_load_inverter(inverter_cfg) for inverter_cfg in cfg.get('inverters') or []]
+        if cfg.get('inverter'):
+            inverters.insert(0, _load_inverter(cfg['inverter']))
+        if not inverters:
+            raise ValueError('no inverter configured')
+        inverter = inverters[0]
 
         record = Config.Record(
             influxdb_bucket=cfg['record']['influxdb_bucket'],
             request_interval=cfg['record']['request_interval'],
-            ignore_sunset=cfg['record']['ignore_sunset']
+            max_parallel_requests=cfg['record'].get('max_parallel_requests', 2),
+            min_request_gap=cfg['record'].get('min_request_gap', 4.0),
+            ignore_sunset=cfg['record']['ignore_sunset'],
+            batch_size=cfg['record'].get('batch_size', 500),
+            flush_interval=cfg['record'].get('flush_interval', 10.0),
+            max_queue_mb=cfg['record'].get('max_queue_mb', 16.0),
+            line_protocol=cfg['record'].get('line_protocol', True),
+            json_backend=cfg['record'].get('json_backend', 'auto'),
+            plan_requests=cfg['record'].get('plan_requests', False),
+            columnar=cfg['record'].get('columnar', False),
         )
 
         if record.request_interval < 2.0 or record.request_interval > 3600.0:
             raise ValueError(f'invalid request interval: {record.request_interval} s')
+        if record.max_parallel_requests < 1:
+            raise ValueError(f'invalid number of parallel requests: {record.max_parallel_requests}')
+        if record.min_request_gap < 0.0:
+            raise ValueError(f'invalid request gap: {record.min_request_gap} s')
+        if record.batch_size < 1:
+            raise ValueError(f'invalid batch size: {record.batch_size}')
+        if record.flush_interval <= 0.0:
+            raise ValueError(f'invalid flush interval: {record.flush_interval} s')
+        if record.max_queue_mb <= 0.0:
+            raise ValueError(f'invalid write queue size: {record.max_queue_mb} MB')
+        if record.json_backend not in ['auto', 'stdlib', 'orjson']:
+            raise ValueError(f'invalid JSON backend: {record.json_backend}')
 
-        location_info = LocationInfo(
-            name=cfg['location']['name'],
-            region=cfg['location']['region'],
-            timezone=cfg['location']['timezone'],
-            latitude=cfg['location']['latitude'],
-            longitude=cfg['location']['longitude'],
+        location = _load_location(cfg['location'])
+        sites = {name: _load_location(site_cfg) for name, site_cfg in (cfg.get('sites') or {}).items()}
+        for item in inverters:
+            if item.site is not None and item.site not in sites:
+                raise ValueError(f'unknown site of inverter {item.name}: {item.site}')
+
+        # polling intervals per solar phase, none pauses polling
+        schedule_cfg = cfg.get('schedule') or {}
+        schedule = Config.Schedule(
+            night_interval=schedule_cfg.get('night_interval'),
+            twilight_interval=schedule_cfg.get('twilight_interval', max(60.0, record.request_interval)),
+            day_interval=schedule_cfg.get('day_interval', record.request_interval),
+            midday_interval=schedule_cfg.get('midday_interval', record.request_interval),
+            midday_window=schedule_cfg.get('midday_window', 4.0) * 3600.0,
+            idle_interval=schedule_cfg.get('idle_interval'),
         )
 
+        for phase in ['night', 'twilight', 'day', 'midday', 'idle']:
+            interval = getattr(schedule, f'{phase}_interval')
+            if interval is not None and (interval < 2.0 or interval > 86400.0):
+                raise ValueError(f'invalid {phase} interval: {interval} s')
+        if schedule.midday_window < 0.0:
+            raise ValueError(f'invalid midday window: {schedule.midday_window / 3600.0} h')
+
+        spool = None
+        if cfg.get('spool'):
+            spool = Config.Spool(
+                directory=cfg['spool']['directory'],
+                max_mb=cfg['spool'].get('max_mb', 512.0),
+                segment_mb=cfg['spool'].get('segment_mb', 4.0),
+                fsync=cfg['spool'].get('fsync', 'segment'),
+                replay_rate=cfg['spool'].get('replay_rate', 500.0),
+            )
+
+            if spool.max_mb < spool.segment_mb or spool.segment_mb <= 0.0:
+                raise ValueError(f'invalid spool size: max={spool.max_mb} MB, segment={spool.segment_mb} MB')
+            if spool.fsync not in ['always', 'segment', 'never']:
+                raise ValueError(f'invalid spool fsync policy: {spool.fsync}')
+            if spool.replay_rate <= 0.0:
+                raise ValueError(f'invalid spool replay rate: {spool.replay_rate} points/s')
+
+        deadband = None
+        if cfg.get('deadband'):
+            deadband = Config.Deadband(
+                heartbeat=cfg['deadband'].get('heartbeat', 300.0),
+                absolute=cfg['deadband'].get('absolute', 0.0),
+                relative=cfg['deadband'].get('relative', 0.0),
+                measurements=cfg['deadband'].get('measurements') or {},
+                max_series=cfg['deadband'].get('max_series', 1000),
+            )
+
+            if deadband.heartbeat <= 0.0:
+                raise ValueError(f'invalid deadband heartbeat: {deadband.heartbeat} s')
+            if deadband.absolute < 0.0 or deadband.relative < 0.0:
+                raise ValueError(f'invalid deadband tolerance: absolute={deadband.absolute}, relative={deadband.relative}')
+            if deadband.max_series < 1:
+                raise ValueError(f'invalid number of deadband series: {deadband.max_series}')
+
+        aggregation = None
+        if cfg.get('aggregation'):
+            aggregation = Config.Aggregation(
+                windows=cfg['aggregation'].get('windows', [60]),
+                allowed_lateness=cfg['aggregation'].get('allowed_lateness', 5.0),
+                keep_raw=cfg['aggregation'].get('keep_raw', False),
+                measurements=cfg['aggregation'].get('measurements'),
+                max_series=cfg['aggregation'].get('max_series', 1000),
+            )
+
+            if not aggregation.windows or any(not isinstance(window, int) or window < 1
+                                              for window in aggregation.windows):
+                raise ValueError(f'invalid aggregation windows: {aggregation.windows} (whole seconds expected)')
+            if aggregation.allowed_lateness < 0.0:
+                raise ValueError(f'invalid aggregation lateness: {aggregation.allowed_lateness} s')
+            if aggregation.max_series < 1:
+                raise ValueError(f'invalid number of aggregated series: {aggregation.max_series}')
+
+        backfill = None
+        if cfg.get('backfill'):
+            backfill = Config.Backfill(
+                checkpoint_file=cfg['backfill'].get('checkpoint_file', './backfill.json'),
+                chunk_days=cfg['backfill'].get('chunk_days', 1.0),
+                channels=cfg['backfill'].get('channels'),
+                gap_detection=cfg['backfill'].get('gap_detection', False),
+                lookback_days=cfg['backfill'].get('lookback_days', 7.0),
+                min_gap=cfg['backfill'].get('min_gap', 900.0),
+            )
+
+            if backfill.chunk_days <= 0.0 or backfill.chunk_days > 16.0:
+                raise ValueError(f'invalid backfill chunk size: {backfill.chunk_days} days (max. 16 days)')
+            if backfill.lookback_days <= 0.0:
+                raise ValueError(f'invalid backfill lookback: {backfill.lookback_days} days')
+            if backfill.min_gap <= 0.0:
+                raise ValueError(f'invalid backfill gap: {backfill.min_gap} s')
+
+        metrics = None
+        if cfg.get('metrics'):
+            metrics = Config.Metrics(
+                host=cfg['metrics'].get('host', '127.0.0.1'),
+                port=cfg['metrics'].get('port', 9108),
+            )
+
+            if metrics.port < 0 or metrics.port > 65535:
+                raise ValueError(f'invalid metrics port: {metrics.port}')
+
+        live = None
+        if cfg.get('live'):
+            live = Config.Live(
+                host=cfg['live'].get('host', '127.0.0.1'),
+                port=cfg['live'].get('port', 9109),
+                history=cfg['live'].get('history', 120),
+                max_series=cfg['live'].get('max_series', 1000),
+                measurements=cfg['live'].get('measurements'),
+            )
+
+            if live.port < 0 or live.port > 65535:
+                raise ValueError(f'invalid live port: {live.port}')
+            if live.history < 1:
+                raise ValueError(f'invalid live history: {live.history} samples')
+            if live.max_series < 1:
+                raise ValueError(f'invalid number of live series: {live.max_series}')
+
+        parquet = None
+        if cfg.get('parquet'):
+            parquet = Config.Parquet(
+                directory=cfg['parquet']['directory'],
+                partition=cfg['parquet'].get('partition', 'day'),
+                compression=cfg['parquet'].get('compression', 'zstd'),
+                row_group_rows=cfg['parquet'].get('row_group_rows', 50000),
+                flush_interval=cfg['parquet'].get('flush_interval', 600.0),
+                max_queue_points=cfg['parquet'].get('max_queue_points', 100000),
+            )
+
+            if parquet.partition not in ['hour', 'day']:
+                raise ValueError(f'invalid Parquet partition: {parquet.partition}')
+            if parquet.compression not in ['zstd', 'snappy', 'gzip', 'brotli', 'lz4', 'none']:
+                raise ValueError(f'invalid Parquet compression: {parquet.compression}')
+            if parquet.row_group_rows < 1:
+                raise ValueError(f'invalid Parquet row group size: {parquet.row_group_rows} rows')
+            if parquet.flush_interval <= 0.0:
+                raise ValueError(f'invalid Parquet flush interval: {parquet.flush_interval} s')
+            if parquet.max_queue_points < 1:
+                raise ValueError(f'invalid Parquet queue size: {parquet.max_queue_points} points')
+
+        recorder = None
+        if cfg.get('recorder'):
+            recorder = Config.Recorder(
+                directory=cfg['recorder']['directory'],
+                segment_mb=cfg['recorder'].get('segment_mb', 16.0),
+                segment_interval=cfg['recorder'].get('segment_interval', 3600.0),
+                max_mb=cfg['recorder'].get('max_mb', 1024.0),
+            )
+
+            if recorder.max_mb < recorder.segment_mb or recorder.segment_mb <= 0.0:
+                raise ValueError(f'invalid recorder size: max={recorder.max_mb} MB, '
+                                 f'segment={recorder.segment_mb} MB')
+            if recorder.segment_interval <= 0.0:
+                raise ValueError(f'invalid recorder segment interval: {recorder.segment_interval} s')
+
+        rate_control = None
+        if cfg.get('rate_control'):
+            rate_control = Config.RateControl(
+                latency_target=cfg['rate_control'].get('latency_target', 1.0),
+                step=cfg['rate_control'].get('step', 0.1),
+                backoff=cfg['rate_control'].get('backoff', 2.0),
+                min_factor=cfg['rate_control'].get('min_factor', 0.5),
+                max_factor=cfg['rate_control'].get('max_factor', 8.0),
+                failure_threshold=cfg['rate_control'].get('failure_threshold', 3),
+                open_seconds=cfg['rate_control'].get('open_seconds', 30.0),
+                max_open_seconds=cfg['rate_control'].get('max_open_seconds', 600.0),
+            )
+
+            if rate_control.latency_target <= 0.0:
+                raise ValueError(f'invalid latency target: {rate_control.latency_target} s')
+            if not 0.0 < rate_control.min_factor <= 1.0 <= rate_control.max_factor:
+                raise ValueError(f'invalid interval factors: min={rate_control.min_factor}, '
+                                 f'max={rate_control.max_factor}')
+            if rate_control.backoff <= 1.0 or rate_control.step <= 0.0:
+                raise ValueError(f'invalid interval adjustment: step={rate_control.step}, '
+                                 f'backoff={rate_control.backoff}')
+            if rate_control.failure_threshold < 1:
+                raise ValueError(f'invalid failure threshold: {rate_control.failure_threshold}')
+            if rate_control.open_seconds <= 0.0 or rate_control.max_open_seconds < rate_control.open_seconds:
+                raise ValueError(f'invalid circuit open time: {rate_control.open_seconds} s, '
+                                 f'max={rate_control.max_open_seconds} s')
+
+        pipeline = None
+        if cfg.get('pipeline'):
+            stages = {}
+            for name in ['decode', 'process', 'write']:
+                stage_cfg = cfg['pipeline'].get(name) or {}
+                stage = stages[name] = Config.PipelineStage(
+                    workers=stage_cfg.get('workers', 1),
+                    queue=stage_cfg.get('queue', 1000),
+                    overflow=stage_cfg.get('overflow', 'block'),
+                )
+                if stage.workers < 1:
+                    raise ValueError(f'invalid number of {name} workers: {stage.workers}')
+                if stage.queue < stage.workers:
+                    raise ValueError(f'invalid {name} queue size: {stage.queue} items')
+                if stage.overflow not in ['block', 'drop_oldest', 'spill']:
+                    raise ValueError(f'invalid {name} overflow policy: {stage.overflow}')
+            pipeline = Config.Pipeline(**stages, spill_directory=cfg['pipeline'].get('spill_directory'))
+
+            if pipeline.write.overflow == 'spill' and not spool:
+                raise ValueError('the spill overflow policy of the write stage requires a spool')
+            if 'spill' in [pipeline.decode.overflow, pipeline.process.overflow] and not pipeline.spill_directory:
+                raise ValueError('the spill overflow policy of the decode and process stages requires a spill '
+                                 'directory')
+
+        derived = None
+        if cfg.get('derived'):
+            derived = Config.Derived(
+                window=cfg['derived'].get('window', 60),
+                max_gap=cfg['derived'].get('max_gap', 30.0),
+                formulas=cfg['derived'].get('formulas'),
+                max_series=cfg['derived'].get('max_series', 1000),
+            )
+
+            if not isinstance(derived.window, int) or derived.window < 1:
+                raise ValueError(f'invalid derived metrics window: {derived.window} (whole seconds expected)')
+            if derived.max_gap <= 0.0:
+                raise ValueError(f'invalid derived metrics gap: {derived.max_gap} s')
+            if derived.formulas is not None and not all(
+                    isinstance(formulas, dict) and all(isinstance(formula, str) for formula in formulas.values())
+                    for formulas in derived.formulas.values()):
+                raise ValueError(f'invalid derived metrics formulas: {derived.formulas}')
+            if derived.max_series < 1:
+                raise ValueError(f'invalid number of derived metrics series: {derived.max_series}')
+
+        fleet = None
+        if cfg.get('fleet') or len(inverters) > 1:
+            fleet_cfg = cfg.get('fleet') or {}
+            fleet = Config.Fleet(
+                workers=fleet_cfg.get('workers', min(len(inverters), os.cpu_count() or 1)),
+                restart_delay=fleet_cfg.get('restart_delay', 5.0),
+                max_restarts=fleet_cfg.get('max_restarts', 5),
+                report_interval=fleet_cfg.get('report_interval', 300.0),
+            )
+
+            if fleet.workers < 1:
+                raise ValueError(f'invalid number of workers: {fleet.workers}')
+            if fleet.restart_delay < 0.0:
+                raise ValueError(f'invalid restart delay: {fleet.restart_delay} s')
+            if fleet.max_restarts < 0:
+                raise ValueError(f'invalid number of restarts: {fleet.max_restarts}')
+
         config = Config(
             inverter=inverter,
             record=record,
-            location=Location(location_info),
+            location=location,
+            schedule=schedule,
+            spool=spool,
+            deadband=deadband,
+            aggregation=aggregation,
+            backfill=backfill,
+            metrics=metrics,
+            inverters=inverters,
+            sites=sites,
+            fleet=fleet,
+            live=live,
+            parquet=parquet,
+            recorder=recorder,
+            rate_control=rate_control,
+            pipeline=pipeline,
+            derived=derived,
         )
 
         return config
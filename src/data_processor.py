@@ -1,8 +1,14 @@
 import logging
-from typing import Dict, List, Optional, Tuple
+import sys
+from types import MappingProxyType
+from typing import Callable, Dict, List, Mapping, Optional, Tuple, Union
 
 import datetime
 
+from columnar import NULL_VALUES, SPEC_KINDS, ColumnarBatch, MeasurementColumns
+from device_cache import DeviceCache, parse_inverter_info
+from line_protocol import LineProtocolEncoder, to_nanoseconds
+
 
 class DataCollectionError(Exception):
     pass
@@ -12,38 +18,231 @@ class WrongFroniusData(Exception):
     pass
 
 
-def _has_value(data, value: str) -> bool:
-    return value in data and data[value].get('Value', None) is not None
+def _get_string(data, value: str) -> str:
+    if value in data and data[value] is not None:
+        return data[value]
+    return ""
 
 
-def _get_float_value(data, value: str) -> float:
-    if value in data and data[value].get('Value', None) is not None:
-        return float(data[value].get('Value', 0))
-    return 0.0
+# Expressions to read and convert one source value, 'v' holds the raw value and 'get' the lookup of the data dict.
+# 'value' reads the 'Value' entry of a {"Unit": ..., "Value": ...} object.
+_FIELD_TYPES = {
+    'value': "float(v) if (v := (get({key!r}) or _EMPTY).get('Value')) is not None else 0.0",
+    'float': "float(v) if (v := get({key!r})) is not None else 0.0",
+    'int': "int(v) if (v := get({key!r})) is not None else 0",
+    'str': "v if (v := get({key!r})) is not None else ''",
+    'bool': "bool(v) if (v := get({key!r})) is not None else False",
+}
+
+# A field spec is (source key, field name, type, presence key). Fields with a presence key are
+# only written if the presence key is part of the response (or has a value for the 'value' type).
+FieldSpec = Tuple[str, str, str, Optional[str]]
+
+COMMON_INVERTER_FIELDS: List[FieldSpec] = [
+    ('IAC', 'IAC', 'value', None),
+    ('UAC', 'UAC', 'value', None),
+    ('PAC', 'PAC', 'value', None),
+    ('FAC', 'FAC', 'value', None),
+    ('IDC', 'IDC_MPP1', 'value', None),
+    ('UDC', 'UDC_MPP1', 'value', None),
+    ('DAY_ENERGY', 'DAY_ENERGY', 'value', None),
+    ('YEAR_ENERGY', 'YEAR_ENERGY', 'value', None),
+    ('TOTAL_ENERGY', 'TOTAL_ENERGY', 'value', None),
+    # additional fields for Symo GEN24
+    ('SAC', 'SAC', 'value', 'SAC'),
+    ('IDC_2', 'IDC_MPP2', 'value', 'IDC_2'),
+    ('UDC_2', 'UDC_MPP2', 'value', 'IDC_2'),
+    ('IDC_3', 'IDC_MPP3', 'value', 'IDC_3'),
+    ('UDC_3', 'UDC_MPP3', 'value', 'IDC_3'),
+    ('IDC_4', 'IDC_MPP4', 'value', 'IDC_4'),
+    ('UDC_4', 'UDC_MPP4', 'value', 'IDC_4'),
+]
 
+THREE_PHASE_INVERTER_FIELDS: List[FieldSpec] = [
+    ('IAC_L1', 'IAC_L1', 'value', None),
+    ('IAC_L2', 'IAC_L2', 'value', None),
+    ('IAC_L3', 'IAC_L3', 'value', None),
+    ('UAC_L1', 'UAC_L1', 'value', None),
+    ('UAC_L2', 'UAC_L2', 'value', None),
+    ('UAC_L3', 'UAC_L3', 'value', None),
+]
 
-def _get_float(data, value: str) -> float:
-    if value in data and data[value] is not None:
-        return float(data[value])
-    return 0.0
+MIN_MAX_INVERTER_FIELDS: List[FieldSpec] = [
+    ('DAY_PMAX', 'DAY_PMAX', 'value', None),
+    ('DAY_UACMAX', 'DAY_UACMAX', 'value', None),
+    ('DAY_UDCMAX', 'DAY_UDCMAX', 'value', None),
+    ('YEAR_PMAX', 'YEAR_PMAX', 'value', None),
+    ('YEAR_UACMAX', 'YEAR_UACMAX', 'value', None),
+    ('YEAR_UDCMAX', 'YEAR_UDCMAX', 'value', None),
+    ('TOTAL_PMAX', 'TOTAL_PMAX', 'value', None),
+    ('TOTAL_UACMAX', 'TOTAL_UACMAX', 'value', None),
+    ('TOTAL_UDCMAX', 'TOTAL_UDCMAX', 'value', None),
+]
 
+CUMULATION_INVERTER_FIELDS: List[FieldSpec] = [
+    ('PAC', 'PAC', 'value', None),
+    ('DAY_ENERGY', 'DAY_ENERGY', 'value', None),
+    ('YEAR_ENERGY', 'YEAR_ENERGY', 'value', None),
+    ('TOTAL_ENERGY', 'TOTAL_ENERGY', 'value', None),
+]
 
-def _get_int(data, value: str) -> int:
-    if value in data and data[value] is not None:
-        return int(data[value])
-    return 0
+# Dataformat for SmartMeter TS65A-3
+METER_FIELDS: List[FieldSpec] = [
+    ('Current_AC_Phase_1', 'IAC_L1', 'float', None),
+    ('Current_AC_Phase_2', 'IAC_L2', 'float', None),
+    ('Current_AC_Phase_3', 'IAC_L3', 'float', None),
+    ('Current_AC_Sum', 'IAC_Sum', 'float', None),
+    ('Enable', 'Enable', 'int', None),
+    ('EnergyReactive_VArAC_Sum_Consumed', 'E_VArAC_Consumed', 'float', None),
+    ('EnergyReactive_VArAC_Sum_Produced', 'E_VArAC_Produced', 'float', None),
+    ('EnergyReal_WAC_Minus_Absolute', 'E_WAC_Minus_Absolute', 'float', None),     # system specific view
+    ('EnergyReal_WAC_Plus_Absolute', 'E_WAC_Plus_Absolute', 'float', None),       # system specific view
+    ('EnergyReal_WAC_Sum_Consumed', 'E_WAC_Consumed', 'float', None),             # meter specific view
+    ('EnergyReal_WAC_Sum_Produced', 'E_WAC_Produced', 'float', None),             # meter specific view
+    ('Frequency_Phase_Average', 'Freq_Avg', 'float', None),
+    ('Meter_Location_Current', 'Meter_Location_Current', 'float', None),
+    ('PowerApparent_S_Phase_1', 'S_L1', 'float', None),
+    ('PowerApparent_S_Phase_2', 'S_L2', 'float', None),
+    ('PowerApparent_S_Phase_3', 'S_L3', 'float', None),
+    ('PowerApparent_S_Sum', 'S_Sum', 'float', None),
+    ('PowerFactor_Phase_1', 'CosPhi_L1', 'float', None),
+    ('PowerFactor_Phase_2', 'CosPhi_L2', 'float', None),
+    ('PowerFactor_Phase_3', 'CosPhi_L3', 'float', None),
+    ('PowerFactor_Sum', 'CosPhi_Sum', 'float', None),
+    ('PowerReactive_Q_Phase_1', 'Q_L1', 'float', None),
+    ('PowerReactive_Q_Phase_2', 'Q_L2', 'float', None),
+    ('PowerReactive_Q_Phase_3', 'Q_L3', 'float', None),
+    ('PowerReactive_Q_Sum', 'Q_Sum', 'float', None),
+    ('PowerReal_P_Phase_1', 'P_L1', 'float', None),
+    ('PowerReal_P_Phase_2', 'P_L2', 'float', None),
+    ('PowerReal_P_Phase_3', 'P_L3', 'float', None),
+    ('PowerReal_P_Sum', 'P_Sum', 'float', None),
+    ('Visible', 'Visible', 'int', None),
+    ('Voltage_AC_PhaseToPhase_12', 'UAC_L1-L2', 'float', None),
+    ('Voltage_AC_PhaseToPhase_23', 'UAC_L2-L3', 'float', None),
+    ('Voltage_AC_PhaseToPhase_31', 'UAC_L3-L1', 'float', None),
+    ('Voltage_AC_Phase_1', 'UAC_L1', 'float', None),
+    ('Voltage_AC_Phase_2', 'UAC_L2', 'float', None),
+    ('Voltage_AC_Phase_3', 'UAC_L3', 'float', None),
+]
 
+POWER_FLOW_INVERTER_FIELDS: List[FieldSpec] = [
+    ('E_Day', 'E_Day', 'float', None),
+    ('E_Total', 'E_Total', 'float', None),
+    ('E_Year', 'E_Year', 'float', None),
+    ('P', 'P', 'float', None),
+    ('Battery_Mode', 'Battery_Mode', 'str', 'Battery_Mode'),
+    ('SOC', 'SOC', 'float', 'SOC'),
+]
 
-def _get_string(data, value: str) -> str:
-    if value in data and data[value] is not None:
-        return data[value]
-    return ""
+POWER_FLOW_SITE_FIELDS: List[FieldSpec] = [
+    ('BackupMode', 'BackupMode', 'bool', None),
+    ('E_Day', 'E_Day', 'float', None),
+    ('E_Total', 'E_Total', 'float', None),
+    ('E_Year', 'E_Year', 'float', None),
+    ('Mode', 'Mode', 'str', None),
+    ('P_Akku', 'P_Akku', 'float', None),
+    ('P_Grid', 'P_Grid', 'float', None),
+    ('P_Load', 'P_Load', 'float', None),
+    ('P_PV', 'P_PV', 'float', None),
+    ('rel_Autonomy', 'rel_Autonomy', 'float', None),
+    ('rel_SelfConsumption', 'rel_SelfConsumption', 'float', None),
+    ('BatteryStandby', 'BatteryStandby', 'bool', 'BatteryStandby'),
+]
 
 
-def _get_bool(data, value: str) -> bool:
-    if value in data and data[value] is not None:
-        return bool(data[value])
-    return False
+def _compile_extractor(fields: List[FieldSpec]) -> Callable[[Dict], Dict]:
+    # generate a single dict display, so extracting a sample is one pass without per-field function calls
+    items = ",\n".join(f"        {name!r}: {_FIELD_TYPES[kind].format(key=key)}" for key, name, kind, _ in fields)
+    source = f"def extract(data):\n    get = data.get\n    return {{\n{items}\n    }}\n"
+    namespace = {'_EMPTY': {}}
+    exec(compile(source, '<extractor>', 'exec'), namespace)
+    return namespace['extract']
+
+
+def _compile_signature(presence: List[Tuple[str, bool]]) -> Callable[[Dict], Tuple[bool, ...]]:
+    checks = "".join(f"(get({key!r}) or _EMPTY).get('Value') is not None, " if is_value else f"{key!r} in data, "
+                     for key, is_value in presence)
+    source = f"def signature(data):\n    get = data.get\n    return ({checks})\n"
+    namespace = {'_EMPTY': {}}
+    exec(compile(source, '<signature>', 'exec'), namespace)
+    return namespace['signature']
+
+
+def _compile_appender(fields: List[FieldSpec], present: set) -> Callable[[Dict, Tuple, Tuple], None]:
+    # generate the appends of one sample to the columns of all fields, absent optional fields are appended as null
+    values = ", ".join(f"a{idx}" for idx in range(len(fields)))
+    lines = [f"    {values}, = a"]
+    for idx, (key, _, kind, presence) in enumerate(fields):
+        if presence is None:
+            lines.append(f"    a{idx}({_FIELD_TYPES[kind].format(key=key)})")
+        elif presence in present:
+            lines.append(f"    a{idx}({_FIELD_TYPES[kind].format(key=key)}); m[{idx}](1)")
+        else:
+            lines.append(f"    a{idx}({NULL_VALUES[SPEC_KINDS[kind]]!r}); m[{idx}](0)")
+    source = "def append(data, a, m):\n    get = data.get\n" + "\n".join(lines) + "\n"
+    namespace = {'_EMPTY': {}}
+    exec(compile(source, '<appender>', 'exec'), namespace)
+    return namespace['append']
+
+
+class FieldMapping:
+    def __init__(self, fields: List[FieldSpec]):
+        self.fields = fields
+
+        # presence keys of optional fields and how to check them
+        self.presence: List[Tuple[str, bool]] = []
+        for key, _, kind, presence in fields:
+            if presence is not None and all(presence != p for p, _ in self.presence):
+                self.presence.append((presence, kind == 'value'))
+
+        self._signature = _compile_signature(self.presence)
+
+        # extractors by presence signature, resolved per device after its first response
+        self._extractors: Dict[Tuple[bool, ...], Callable[[Dict], Dict]] = {}
+        self._devices: Dict[str, Tuple[Tuple[bool, ...], Callable[[Dict], Dict]]] = {}
+        # the same for the appenders of the columnar representation
+        self._appenders: Dict[Tuple[bool, ...], Callable] = {}
+        self._append_devices: Dict[str, Tuple[Tuple[bool, ...], Callable]] = {}
+
+    def _extractor(self, signature: Tuple[bool, ...]) -> Callable[[Dict], Dict]:
+        extractor = self._extractors.get(signature)
+        if extractor is None:
+            present = {key for (key, _), found in zip(self.presence, signature) if found}
+            fields = [spec for spec in self.fields if spec[3] is None or spec[3] in present]
+            extractor = self._extractors[signature] = _compile_extractor(fields)
+        return extractor
+
+    def extract(self, device_id: str, data: Dict) -> Dict:
+        if not self.presence:
+            return self._extractor(())(data)
+
+        signature = self._signature(data)
+        cached = self._devices.get(device_id)
+        if cached is None or cached[0] != signature:
+            cached = self._devices[device_id] = (signature, self._extractor(signature))
+        return cached[1](data)
+
+    def _appender(self, signature: Tuple[bool, ...]) -> Callable:
+        appender = self._appenders.get(signature)
+        if appender is None:
+            present = {key for (key, _), found in zip(self.presence, signature) if found}
+            appender = self._appenders[signature] = _compile_appender(self.fields, present)
+        return appender
+
+    def append(self, device_id: str, data: Dict, columns: MeasurementColumns, ns: int, tags: Optional[Mapping]):
+        # the fields of a sample straight into the typed columns of the measurement, without a dict per sample
+        if not self.presence:
+            appender = self._appender(())
+        else:
+            signature = self._signature(data)
+            cached = self._append_devices.get(device_id)
+            if cached is None or cached[0] != signature:
+                cached = self._append_devices[device_id] = (signature, self._appender(signature))
+            appender = cached[1]
+        appender(data, *columns.appends())
+        columns.time.append(ns)
+        columns.tags.append(tags)
 
 
 INVERTER_METRICS = [
@@ -65,9 +264,27 @@ INVERTER_METRICS = [
 
 
 class DataProcessor:
-    def __init__(self):
+    def __init__(self, encoder: Optional[LineProtocolEncoder] = None, devices: Optional[DeviceCache] = None):
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.inverter_map = {}
+        # serial numbers and tags of the inverters
+        self.devices = devices or DeviceCache()
+
+        # emit encoded line protocol instead of data point dicts
+        self.encoder = encoder
+
+        self.inverter_mappings = {
+            'CommonInverterData': FieldMapping(COMMON_INVERTER_FIELDS),
+            '3PInverterData': FieldMapping(THREE_PHASE_INVERTER_FIELDS),
+            'MinMaxInverterData': FieldMapping(MIN_MAX_INVERTER_FIELDS),
+            'CumulationInverterData': FieldMapping(CUMULATION_INVERTER_FIELDS),
+        }
+        self.meter_mapping = FieldMapping(METER_FIELDS)
+        self.power_flow_inverter_mapping = FieldMapping(POWER_FLOW_INVERTER_FIELDS)
+        self.power_flow_site_mapping = FieldMapping(POWER_FLOW_SITE_FIELDS)
+
+        # shared tag sets of the meters and the site, like the inverter tags of the device cache
+        self._tag_sets: Dict[Tuple, Mapping[str, str]] = {}
+        self._last_time: Tuple = (None, 0)
 
     def _check_response(self, response: Dict) -> Optional[Tuple]:
         try:
@@ -84,19 +301,41 @@ class DataProcessor:
         timestamp = timestamp.replace("+00:00", "")
         return timestamp, data
 
+    @property
+    def inverter_map(self) -> Dict[str, str]:
+        return self.devices.serials
+
     def update_inverters(self, response: Dict):
         tpl = self._check_response(response)
         if not tpl:
             return
         _, data = tpl
 
-        self.inverter_map = {}
-        
-        # iterate over inverters
-        for id, info in data.items():
-            self.inverter_map[id] = info['UniqueID']
-
-    def process(self, metric: str, response: Dict) -> List[Dict]:
+        self.devices.update(parse_inverter_info(data))
+
+    def process(self, metric: str, response: Dict) -> List[Union[Dict, bytes]]:
+        points = self.process_points(metric, response)
+        if self.encoder is None:
+            return points
+        return [line for line in map(self.encoder.encode, points) if line]
+
+    def _shared_tags(self, **tags) -> Mapping[str, str]:
+        key = tuple(tags.items())
+        shared = self._tag_sets.get(key)
+        if shared is None:
+            if len(self._tag_sets) >= 1000:
+                self._tag_sets.clear()
+            shared = self._tag_sets[key] = MappingProxyType(
+                {name: sys.intern(value) if type(value) is str else value for name, value in tags.items()})
+        return shared
+
+    def _timestamp_ns(self, timestamp) -> int:
+        # the samples of a response share their timestamp
+        if self._last_time[0] != timestamp:
+            self._last_time = (timestamp, to_nanoseconds(timestamp))
+        return self._last_time[1]
+
+    def process_points(self, metric: str, response: Dict) -> List[Dict]:
         tpl = self._check_response(response)
         if not tpl:
             return []
@@ -114,108 +353,30 @@ class DataProcessor:
             raise ValueError(f"Metric '{metric}' not supported yet")
 
     def _process_inverter_data(self, device_id: str, collection: str, timestamp: str, data: Dict) -> List[Dict]:
-        self.logger.debug(f"process device_id={device_id}, {collection}, {timestamp}: {data}")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"process device_id={device_id}, {collection}, {timestamp}: {data}")
+        mapping = self.inverter_mappings.get(collection)
+        if mapping is None:
+            raise DataCollectionError("Unknown data collection type.")
+
+        inverter_data = {
+            'measurement': collection,
+            'time': timestamp,
+            'fields': mapping.extract(device_id, data),
+        }
+        if collection != 'MinMaxInverterData':
+            inverter_data['tags'] = self.devices.tags(device_id)
+
         if collection == 'CommonInverterData':
             device_status = {
                 'measurement': 'InverterStatus',
                 'time': timestamp,
                 'fields': data['DeviceStatus'],
-                'tags': {
-                    'DeviceId': device_id,
-                    'Serial': self.inverter_map.get(device_id, "None")
-                }
-            }
-
-            inverter_data = {
-                'measurement': collection,
-                'time': timestamp,
-                'fields': {
-                    'IAC': _get_float_value(data, 'IAC'),
-                    'UAC': _get_float_value(data, 'UAC'),
-                    'PAC': _get_float_value(data, 'PAC'),
-                    'FAC': _get_float_value(data, 'FAC'),
-                    'IDC_MPP1': _get_float_value(data, 'IDC'),
-                    'UDC_MPP1': _get_float_value(data, 'UDC'),
-                    'DAY_ENERGY': _get_float_value(data, 'DAY_ENERGY'),
-                    'YEAR_ENERGY': _get_float_value(data, 'YEAR_ENERGY'),
-                    'TOTAL_ENERGY': _get_float_value(data, 'TOTAL_ENERGY'),
-                },
-                'tags': {
-                    'DeviceId': device_id,
-                    'Serial': self.inverter_map.get(device_id, "None")
-                }
+                'tags': inverter_data['tags'],
             }
-
-            # add additional fields for Symo GEN24
-            if _has_value(data, 'SAC'):
-                inverter_data['fields']['SAC'] = _get_float_value(data, 'SAC')
-            if _has_value(data, 'IDC_2'):
-                inverter_data['fields']['IDC_MPP2'] = _get_float_value(data, 'IDC_2')
-                inverter_data['fields']['UDC_MPP2'] = _get_float_value(data, 'UDC_2')
-            if _has_value(data, 'IDC_3'):
-                inverter_data['fields']['IDC_MPP3'] = _get_float_value(data, 'IDC_3')
-                inverter_data['fields']['UDC_MPP3'] = _get_float_value(data, 'UDC_3')
-            if _has_value(data, 'IDC_4'):
-                inverter_data['fields']['IDC_MPP4'] = _get_float_value(data, 'IDC_4')
-                inverter_data['fields']['UDC_MPP4'] = _get_float_value(data, 'UDC_4')
-
             return [device_status, inverter_data]
-        elif collection == '3PInverterData':
-            return [
-                {
-                    'measurement': collection,
-                    'time': timestamp,
-                    'fields': {
-                        'IAC_L1': _get_float_value(data, 'IAC_L1'),
-                        'IAC_L2': _get_float_value(data, 'IAC_L2'),
-                        'IAC_L3': _get_float_value(data, 'IAC_L3'),
-                        'UAC_L1': _get_float_value(data, 'UAC_L1'),
-                        'UAC_L2': _get_float_value(data, 'UAC_L2'),
-                        'UAC_L3': _get_float_value(data, 'UAC_L3'),
-                    },
-                    'tags': {
-                        'DeviceId': device_id,
-                        'Serial': self.inverter_map.get(device_id, "None")
-                    }
-                }
-            ]
-        elif collection == 'MinMaxInverterData':
-            return [
-                {
-                    'measurement': collection,
-                    'time': timestamp,
-                    'fields': {
-                        'DAY_PMAX': _get_float_value(data, 'DAY_PMAX'),
-                        'DAY_UACMAX': _get_float_value(data, 'DAY_UACMAX'),
-                        'DAY_UDCMAX': _get_float_value(data, 'DAY_UDCMAX'),
-                        'YEAR_PMAX': _get_float_value(data, 'YEAR_PMAX'),
-                        'YEAR_UACMAX': _get_float_value(data, 'YEAR_UACMAX'),
-                        'YEAR_UDCMAX': _get_float_value(data, 'YEAR_UDCMAX'),
-                        'TOTAL_PMAX': _get_float_value(data, 'TOTAL_PMAX'),
-                        'TOTAL_UACMAX': _get_float_value(data, 'TOTAL_UACMAX'),
-                        'TOTAL_UDCMAX': _get_float_value(data, 'TOTAL_UDCMAX'),
-                    }
-                }
-            ]
-        elif collection == 'CumulationInverterData':
-            return [
-                {
-                    'measurement': collection,
-                    'time': timestamp,
-                    'fields': {
-                        'PAC': _get_float_value(data, 'PAC'),
-                        'DAY_ENERGY': _get_float_value(data, 'DAY_ENERGY'),
-                        'YEAR_ENERGY': _get_float_value(data, 'YEAR_ENERGY'),
-                        'TOTAL_ENERGY': _get_float_value(data, 'TOTAL_ENERGY'),
-                    },
-                    'tags': {
-                        'DeviceId': device_id,
-                        'Serial': self.inverter_map.get(device_id, "None")
-                    }
-                }
-            ]
-        else:
-            raise DataCollectionError("Unknown data collection type.")
+
+        return [inverter_data]
         
     def _process_meter_data(self, timestamp: str, data_map: Dict) -> List[Dict]:
         data_list = []
@@ -232,53 +393,11 @@ class DataProcessor:
 
                 meter_timestamp = datetime.datetime.utcfromtimestamp(int(data['TimeStamp']))
 
-                # Dataformat for SmartMeter TS65A-3
                 meter_data = {
                     'measurement': 'MeterRealtimeData',
                     'time': meter_timestamp,
-                    'fields': {
-                        'IAC_L1': _get_float(data, 'Current_AC_Phase_1'),
-                        'IAC_L2': _get_float(data, 'Current_AC_Phase_2'),
-                        'IAC_L3': _get_float(data, 'Current_AC_Phase_3'),
-                        'IAC_Sum': _get_float(data, 'Current_AC_Sum'),
-                        'Enable': _get_int(data, 'Enable'),
-                        'E_VArAC_Consumed': _get_float(data, 'EnergyReactive_VArAC_Sum_Consumed'),
-                        'E_VArAC_Produced': _get_float(data, 'EnergyReactive_VArAC_Sum_Produced'),
-                        'E_WAC_Minus_Absolute': _get_float(data, 'EnergyReal_WAC_Minus_Absolute'),  # system specific view
-                        'E_WAC_Plus_Absolute': _get_float(data, 'EnergyReal_WAC_Plus_Absolute'),    # system specific view
-                        'E_WAC_Consumed': _get_float(data, 'EnergyReal_WAC_Sum_Consumed'),      # meter specific view
-                        'E_WAC_Produced': _get_float(data, 'EnergyReal_WAC_Sum_Produced'),      # meter specific view
-                        'Freq_Avg': _get_float(data, 'Frequency_Phase_Average'),
-                        'Meter_Location_Current': _get_float(data, 'Meter_Location_Current'),
-                        'S_L1': _get_float(data, 'PowerApparent_S_Phase_1'),
-                        'S_L2': _get_float(data, 'PowerApparent_S_Phase_2'),
-                        'S_L3': _get_float(data, 'PowerApparent_S_Phase_3'),
-                        'S_Sum': _get_float(data, 'PowerApparent_S_Sum'),
-                        'CosPhi_L1': _get_float(data, 'PowerFactor_Phase_1'),
-                        'CosPhi_L2': _get_float(data, 'PowerFactor_Phase_2'),
-                        'CosPhi_L3': _get_float(data, 'PowerFactor_Phase_3'),
-                        'CosPhi_Sum': _get_float(data, 'PowerFactor_Sum'),
-                        'Q_L1': _get_float(data, 'PowerReactive_Q_Phase_1'),
-                        'Q_L2': _get_float(data, 'PowerReactive_Q_Phase_2'),
-                        'Q_L3': _get_float(data, 'PowerReactive_Q_Phase_3'),
-                        'Q_Sum': _get_float(data, 'PowerReactive_Q_Sum'),
-                        'P_L1': _get_float(data, 'PowerReal_P_Phase_1'),
-                        'P_L2': _get_float(data, 'PowerReal_P_Phase_2'),
-                        'P_L3': _get_float(data, 'PowerReal_P_Phase_3'),
-                        'P_Sum': _get_float(data, 'PowerReal_P_Sum'),
-                        'Visible': _get_int(data, 'Visible'),
-                        'UAC_L1-L2': _get_float(data, 'Voltage_AC_PhaseToPhase_12'),
-                        'UAC_L2-L3': _get_float(data, 'Voltage_AC_PhaseToPhase_23'),
-                        'UAC_L3-L1': _get_float(data, 'Voltage_AC_PhaseToPhase_31'),
-                        'UAC_L1': _get_float(data, 'Voltage_AC_Phase_1'),
-                        'UAC_L2': _get_float(data, 'Voltage_AC_Phase_2'),
-                        'UAC_L3': _get_float(data, 'Voltage_AC_Phase_3'),
-                    },
-                    'tags': {
-                        'Model': details['Model'],
-                        'Serial': details['Serial'],
-                        'DeviceId': id
-                    }
+                    'fields': self.meter_mapping.extract(id, data),
+                    'tags': self._shared_tags(Model=details['Model'], Serial=details['Serial'], DeviceId=id),
                 }
 
                 data_list.append(meter_data)
@@ -295,23 +414,9 @@ class DataProcessor:
             inverter_data = {
                 'measurement': 'PowerFlowDataInverter',
                 'time': timestamp,
-                'fields': {
-                    'E_Day': _get_float(inverter, 'E_Day'),
-                    'E_Total': _get_float(inverter, 'E_Total'),
-                    'E_Year': _get_float(inverter, 'E_Year'),
-                    'P': _get_float(inverter, 'P'),
-                },
-                'tags': {
-                    'DeviceId': device_id,
-                    'Serial': self.inverter_map.get(device_id, "None"),
-                    'Version': _get_string(data, 'Version'),
-                },
+                'fields': self.power_flow_inverter_mapping.extract(device_id, inverter),
+                'tags': self.devices.tags(device_id, _get_string(data, 'Version')),
             }
-            if 'Battery_Mode' in inverter:
-                inverter_data['fields']['Battery_Mode'] = _get_string(inverter, 'Battery_Mode')
-            if 'SOC' in inverter:
-                inverter_data['fields']['SOC'] = _get_float(inverter, 'SOC')
-
             data_list.append(inverter_data)
 
         # Map primary SmartMeter data
@@ -319,27 +424,10 @@ class DataProcessor:
         meter_data = {
             'measurement': 'PowerFlowDataSite',
             'time': timestamp,
-            'fields': {
-                'BackupMode': _get_bool(site_data, 'BackupMode'),
-                'E_Day': _get_float(site_data, 'E_Day'),
-                'E_Total': _get_float(site_data, 'E_Total'),
-                'E_Year': _get_float(site_data, 'E_Year'),
-                'Mode': _get_string(site_data, 'Mode'),
-                'P_Akku': _get_float(site_data, 'P_Akku'),
-                'P_Grid': _get_float(site_data, 'P_Grid'),
-                'P_Load': _get_float(site_data, 'P_Load'),
-                'P_PV': _get_float(site_data, 'P_PV'),
-                'rel_Autonomy': _get_float(site_data, 'rel_Autonomy'),
-                'rel_SelfConsumption': _get_float(site_data, 'rel_SelfConsumption'),
-            },
-            'tags': {
-                'Version': _get_string(data, 'Version'),
-                'Location': _get_string(site_data, 'Meter_Location'),
-            },
+            'fields': self.power_flow_site_mapping.extract('Site', site_data),
+            'tags': self._shared_tags(Version=_get_string(data, 'Version'),
+                                      Location=_get_string(site_data, 'Meter_Location')),
         }
-        if 'BatteryStandby' in site_data:
-            meter_data['fields']['BatteryStandby'] = _get_bool(site_data, 'BatteryStandby')
-
         data_list.append(meter_data)
 
         # TODO Map Secondary Meters
@@ -347,3 +435,50 @@ class DataProcessor:
         # TODO Map Smartloads
 
         return data_list
+
+    def process_columnar(self, metric: str, response: Dict, batch: Optional[ColumnarBatch] = None) -> ColumnarBatch:
+        # the same samples as process_points, appended to the typed columns of a batch
+        if batch is None:
+            batch = ColumnarBatch()
+        tpl = self._check_response(response)
+        if not tpl:
+            return batch
+        timestamp, data = tpl
+        ns = self._timestamp_ns(timestamp)
+
+        if metric in ["CumulationInverterData", "CommonInverterData", "3PInverterData", "MinMaxInverterData"]:
+            collection = response['Head']['RequestArguments']['DataCollection']
+            device_id = response['Head']['RequestArguments']['DeviceId']
+            mapping = self.inverter_mappings.get(collection)
+            if mapping is None:
+                raise DataCollectionError("Unknown data collection type.")
+            tags = self.devices.tags(device_id) if collection != 'MinMaxInverterData' else None
+            if collection == 'CommonInverterData':
+                batch.append('InverterStatus', ns, tags, data['DeviceStatus'])
+            mapping.append(device_id, data, batch.table(collection, mapping.fields), ns, tags)
+        elif metric == "MeterRealtimeData":
+            columns = batch.table('MeterRealtimeData', self.meter_mapping.fields)
+            for id, meter in data.items():
+                details = meter['Details']
+                if details["Manufacturer"] != "Fronius":
+                    self.logger.warning(f"Unsupported SmartMeter manufacturer: {details['Manufacturer']}")
+                    continue
+                if details['Model'] not in ['Smart Meter 63A-3', 'Smart Meter 50kA-3', 'Smart Meter TS 65A-3', 'Smart Meter TS 5kA-3']:
+                    self.logger.warning(f"Unsupported SmartMeter type: {details['Model']}")
+                    continue
+                tags = self._shared_tags(Model=details['Model'], Serial=details['Serial'], DeviceId=id)
+                self.meter_mapping.append(id, meter, columns, int(meter['TimeStamp']) * 10 ** 9, tags)
+        elif metric == "PowerFlowRealtimeData":
+            version = _get_string(data, 'Version')
+            columns = batch.table('PowerFlowDataInverter', self.power_flow_inverter_mapping.fields)
+            for device_id, inverter in data['Inverters'].items():
+                self.power_flow_inverter_mapping.append(device_id, inverter, columns, ns,
+                                                        self.devices.tags(device_id, version))
+            site_data = data['Site']
+            tags = self._shared_tags(Version=version, Location=_get_string(site_data, 'Meter_Location'))
+            self.power_flow_site_mapping.append('Site', site_data, batch.table('PowerFlowDataSite',
+                                                                                self.power_flow_site_mapping.fields),
+                                                ns, tags)
+        else:
+            raise ValueError(f"Metric '{metric}' not supported yet")
+        return batch
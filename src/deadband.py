@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from line_protocol import to_nanoseconds
+
+
+@dataclass
+class Tolerance:
+    absolute: float = 0.0
+    relative: float = 0.0
+
+    def within(self, value: float, last: float) -> bool:
+        delta = abs(value - last)
+        return delta <= self.absolute or delta <= self.relative * abs(last)
+
+
+@dataclass
+class _Counter:
+    fields: int = 0
+    suppressed: int = 0
+
+
+# Suppresses field values which did not change by more than a tolerance since they were last written.
+# Every field is written at least once per heartbeat interval.
+class DeadbandFilter:
+    def __init__(self, heartbeat: float = 300.0, default: Optional[Tolerance] = None,
+                 measurements: Optional[Dict[str, Dict]] = None, max_series: int = 1000):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.heartbeat_ns = int(heartbeat * 1e9)
+        self.default = default or Tolerance()
+        self.max_series = max_series
+
+        # tolerances per measurement: {'absolute': .., 'relative': .., 'fields': {field: {'absolute': .., ...}}}
+        self._measurements: Dict[str, Tuple[Tolerance, Dict[str, Tolerance]]] = {}
+        for measurement, cfg in (measurements or {}).items():
+            cfg = cfg or {}
+            measurement_default = Tolerance(cfg.get('absolute', self.default.absolute),
+                                            cfg.get('relative', self.default.relative))
+            fields = {
+                field: Tolerance(field_cfg.get('absolute', measurement_default.absolute),
+                                 field_cfg.get('relative', measurement_default.relative))
+                for field, field_cfg in (cfg.get('fields') or {}).items()
+            }
+            self._measurements[measurement] = (measurement_default, fields)
+
+        self._lock = threading.Lock()
+        # last written (value, timestamp in ns) per series and field, the least recently updated series is evicted
+        # and writes all of its fields again when it returns
+        self._last: 'OrderedDict[Tuple, Dict[str, Tuple[object, int]]]' = OrderedDict()
+        self.counters: Dict[str, _Counter] = {}
+
+    def _tolerances(self, measurement: str) -> Tuple[Tolerance, Dict[str, Tolerance]]:
+        return self._measurements.get(measurement, (self.default, {}))
+
+    def filter(self, points: List[Dict]) -> List[Dict]:
+        with self._lock:
+            return [point for point in map(self._filter_point, points) if point]
+
+    def _filter_point(self, point: Dict) -> Optional[Dict]:
+        measurement = point['measurement']
+        tags = point.get('tags')
+        series = (measurement, tuple(tags.items()) if tags else ())
+        timestamp = to_nanoseconds(point['time']) if point.get('time') is not None else time.time_ns()
+
+        last = self._last.get(series)
+        if last is None:
+            last = self._last[series] = {}
+            if len(self._last) > self.max_series:
+                self._last.popitem(last=False)
+        else:
+            self._last.move_to_end(series)
+        default, tolerances = self._tolerances(measurement)
+        counter = self.counters.setdefault(measurement, _Counter())
+
+        fields = {}
+        for field, value in point['fields'].items():
+            previous = last.get(field)
+            if previous is not None and timestamp - previous[1] < self.heartbeat_ns:
+                last_value = previous[0]
+                if isinstance(value, (int, float)) and not isinstance(value, bool) \
+                        and isinstance(last_value, (int, float)) and not isinstance(last_value, bool):
+                    unchanged = tolerances.get(field, default).within(value, last_value)
+                else:
+                    unchanged = value == last_value
+                if unchanged:
+                    counter.suppressed += 1
+                    continue
+
+            fields[field] = value
+            last[field] = (value, timestamp)
+        counter.fields += len(point['fields'])
+
+        if not fields:
+            return None
+        filtered = dict(point)
+        filtered['fields'] = fields
+        return filtered
+
+    def report(self) -> List[str]:
+        with self._lock:
+            return [f"deadband {measurement}: suppressed {counter.suppressed}/{counter.fields} fields "
+                    f"({counter.suppressed / counter.fields * 100 if counter.fields else 0.0:.1f} %)"
+                    for measurement, counter in self.counters.items()]
@@ -0,0 +1,34 @@
+import json
+import logging
+from typing import Callable, Dict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKENDS = ['auto', 'stdlib', 'orjson']
+
+
+def get_loads(backend: str = 'auto') -> Callable[[bytes], object]:
+    if backend not in BACKENDS:
+        raise ValueError(f"invalid JSON backend: {backend}")
+    if backend == 'orjson' and orjson is None:
+        raise ValueError("JSON backend 'orjson' is not installed")
+    if backend in ['auto', 'orjson'] and orjson is not None:
+        return orjson.loads
+    return json.loads
+
+
+# Decodes Solar API responses from the raw response body with the fastest available JSON backend.
+# 'auto' uses orjson if it is installed and falls back to the standard library otherwise.
+class ResponseDecoder:
+    def __init__(self, backend: str = 'auto'):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.loads = get_loads(backend)
+        self.backend = 'stdlib' if self.loads is json.loads else 'orjson'
+        self.logger.info(f"decoding responses with the {self.backend} JSON backend")
+
+    def decode(self, body: bytes) -> Dict:
+        return self.loads(body)
@@ -0,0 +1,289 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from line_protocol import to_nanoseconds
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Derived fields per measurement, evaluated in order on the arrays of the samples of a window: field names are the
+# sample values (NaN if missing), names of earlier formulas are their results. Array results are reduced to their mean.
+# PowerFlowDataSite: P_Grid > 0 is imported, P_Load < 0 is consumed.
+DEFAULT_FORMULAS: Dict[str, Dict[str, str]] = {
+    'CommonInverterData': {
+        'PDC_MPP1': 'UDC_MPP1 * IDC_MPP1',
+        'PDC_MPP2': 'UDC_MPP2 * IDC_MPP2',
+        'E_AC': 'integral(PAC)',
+        'E_DC': 'integral(nan0(UDC_MPP1 * IDC_MPP1) + nan0(UDC_MPP2 * IDC_MPP2))',
+        'Efficiency': 'E_AC / E_DC',
+    },
+    '3PInverterData': {
+        'IAC_Imbalance': '(pmax(IAC_L1, IAC_L2, IAC_L3) - pmin(IAC_L1, IAC_L2, IAC_L3)) / pmean(IAC_L1, IAC_L2, IAC_L3)',
+        'UAC_Imbalance': '(pmax(UAC_L1, UAC_L2, UAC_L3) - pmin(UAC_L1, UAC_L2, UAC_L3)) / pmean(UAC_L1, UAC_L2, UAC_L3)',
+    },
+    'PowerFlowDataSite': {
+        'E_Grid_Import': 'integral(clip(P_Grid, 0, None))',
+        'E_Grid_Export': 'integral(clip(-P_Grid, 0, None))',
+        'E_Load': 'integral(abs(P_Load))',
+        'E_PV': 'integral(nan0(P_PV))',
+        'SelfConsumption': '1 - E_Grid_Export / E_PV',
+        'Autarky': '1 - E_Grid_Import / E_Load',
+    },
+}
+
+# functions of the formulas besides the reductions and the integral of a window
+_FUNCTIONS = ['abs', 'clip', 'maximum', 'minimum', 'nan0', 'pmax', 'pmean', 'pmin', 'sqrt', 'where',
+              'integral', 'last', 'max', 'mean', 'min']
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _Formula:
+    __slots__ = ('name', 'expression', 'code')
+
+    def __init__(self, name: str, expression: str):
+        self.name = name
+        self.expression = expression
+        try:
+            self.code = compile(expression, f'<{name}>', 'eval')
+        except SyntaxError as e:
+            raise ValueError(f"invalid formula {name}: {expression} ({e.msg})")
+
+
+class _Series:
+    __slots__ = ('measurement', 'tags', 'fields', 'start', 'times', 'values', 'carry', 'touched')
+
+    def __init__(self, measurement: str, tags: Optional[Dict], fields: List[str]):
+        self.measurement = measurement
+        self.tags = tags
+        self.fields = fields
+        # start of the current window in ns
+        self.start: Optional[int] = None
+        # samples of the current window: timestamps in ns and a value list per field
+        self.times: List[int] = []
+        self.values: List[List[float]] = [[] for _ in fields]
+        # last sample of the previous window (timestamp, values), integrals start with it
+        self.carry: Optional[Tuple[int, List[float]]] = None
+        self.touched = time.monotonic()
+
+
+# The arrays of a window with the reductions and the integral over its timestamps. The first sample is the last one
+# of the previous window if it is not further away than the maximum gap, it only counts for the integrals. The results
+# are numpy scalars, a division by zero in a formula gives inf or NaN instead of raising.
+class _Window:
+    def __init__(self, seconds, offset: int, max_gap: float):
+        self.seconds = seconds
+        self.offset = offset
+        self.max_gap = max_gap
+
+    def integral(self, values) -> 'numpy.float64':
+        # trapezoidal energy in Wh of a power in W, intervals longer than the maximum gap or with a missing value at
+        # one of their ends are left out
+        values = numpy.broadcast_to(values, self.seconds.shape)
+        dt = numpy.diff(self.seconds)
+        areas = (values[1:] + values[:-1]) * 0.5 * dt
+        valid = (dt <= self.max_gap) & numpy.isfinite(areas)
+        return areas[valid].sum() / 3600.0
+
+    def _samples(self, values):
+        values = numpy.broadcast_to(values, self.seconds.shape)[self.offset:]
+        return values[numpy.isfinite(values)]
+
+    def mean(self, values) -> 'numpy.float64':
+        values = self._samples(values)
+        return values.mean() if len(values) else numpy.float64('nan')
+
+    def min(self, values) -> 'numpy.float64':
+        values = self._samples(values)
+        return values.min() if len(values) else numpy.float64('nan')
+
+    def max(self, values) -> 'numpy.float64':
+        values = self._samples(values)
+        return values.max() if len(values) else numpy.float64('nan')
+
+    def last(self, values) -> 'numpy.float64':
+        values = self._samples(values)
+        return values[-1] if len(values) else numpy.float64('nan')
+
+    def namespace(self) -> Dict:
+        return {
+            'abs': numpy.abs,
+            'clip': numpy.clip,
+            'maximum': numpy.maximum,
+            'minimum': numpy.minimum,
+            'nan0': lambda values: numpy.where(numpy.isnan(values), 0.0, values),
+            'pmax': lambda *values: numpy.max(numpy.broadcast_arrays(*values), axis=0),
+            'pmean': lambda *values: numpy.mean(numpy.broadcast_arrays(*values), axis=0),
+            'pmin': lambda *values: numpy.min(numpy.broadcast_arrays(*values), axis=0),
+            'sqrt': numpy.sqrt,
+            'where': numpy.where,
+            'integral': self.integral,
+            'last': self.last,
+            'max': self.max,
+            'mean': self.mean,
+            'min': self.min,
+        }
+
+
+# Collects the samples of the configured measurements per series (measurement and tags) into arrays for wall-clock
+# aligned windows and evaluates vectorized formulas on them once a window is complete, e.g. the inverter efficiency,
+# phase imbalance or the energy integrals of PowerFlowDataSite. The results are emitted to the measurement
+# "<measurement>_derived_<window>s" at the start of the window, the samples themselves are passed on unchanged.
+class DerivedMetrics:
+    def __init__(self, window: int = 60, max_gap: float = 30.0,
+                 formulas: Optional[Dict[str, Dict[str, str]]] = None, max_series: int = 1000):
+        if numpy is None:
+            raise ValueError("derived metrics require numpy, install it with 'pip install -e .[derived]'")
+        if window < 1 or max_gap <= 0.0:
+            raise ValueError(f"invalid derived metrics window: {window} s, max gap={max_gap} s")
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.window_ns = int(window * 1e9)
+        self.window = window
+        self.max_gap = max_gap
+        self.max_series = max_series
+
+        # compiled formulas and the fields they read per measurement
+        self.formulas: Dict[str, List[_Formula]] = {}
+        self.fields: Dict[str, List[str]] = {}
+        for measurement, expressions in (DEFAULT_FORMULAS if formulas is None else formulas).items():
+            compiled = [_Formula(name, expression) for name, expression in expressions.items()]
+            names = set()
+            fields = []
+            for formula in compiled:
+                for name in formula.code.co_names:
+                    if name not in _FUNCTIONS and name not in names and name not in fields:
+                        fields.append(name)
+                names.add(formula.name)
+            self.formulas[measurement] = compiled
+            self.fields[measurement] = fields
+
+        # series which did not receive samples for a window and the maximum gap are closed by wall-clock time
+        self.idle_timeout = window + max_gap
+
+        self._lock = threading.Lock()
+        self._series: 'OrderedDict[Tuple, _Series]' = OrderedDict()
+
+        self.samples = 0
+        self.emitted = 0
+        self.late = 0
+        self.failed = 0
+
+    def process(self, points: List[Dict]) -> List[Dict]:
+        output = []
+        with self._lock:
+            for point in points:
+                output.append(point)
+                if point['measurement'] in self.formulas:
+                    self._add(point, output)
+            self._close_idle(output)
+        return output
+
+    def _add(self, point: Dict, output: List[Dict]):
+        tags = point.get('tags')
+        key = (point['measurement'], tuple(tags.items()) if tags else ())
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(point['measurement'], tags, self.fields[point['measurement']])
+            if len(self._series) > self.max_series:
+                _, evicted = self._series.popitem(last=False)
+                self._close(evicted, output)
+        else:
+            self._series.move_to_end(key)
+        series.touched = time.monotonic()
+
+        timestamp = to_nanoseconds(point['time']) if point.get('time') is not None else time.time_ns()
+        start = timestamp - timestamp % self.window_ns
+        if series.start is not None and start != series.start:
+            if start < series.start:
+                self.late += 1
+                return
+            self._close(series, output)
+        series.start = start
+
+        # a list append per field and sample, the arrays are built once per window
+        fields = point['fields']
+        series.times.append(timestamp)
+        for name, values in zip(series.fields, series.values):
+            value = fields.get(name)
+            values.append(value if _is_number(value) else float('nan'))
+        self.samples += 1
+
+    def _close(self, series: _Series, output: List[Dict]):
+        if not series.times:
+            return
+        times = numpy.array(series.times, dtype=numpy.int64)
+        columns = numpy.array(series.values, dtype=numpy.float64).reshape(len(series.fields), len(times))
+        if numpy.any(times[1:] < times[:-1]):
+            order = numpy.argsort(times, kind='stable')
+            times = times[order]
+            columns = columns[:, order]
+        samples = len(times)
+        start = series.start
+        carry = series.carry
+        series.times = []
+        series.values = [[] for _ in series.fields]
+        series.carry = (int(times[-1]), columns[:, -1].tolist())
+
+        offset = 0
+        if carry is not None and (times[0] - carry[0]) / 1e9 <= self.max_gap:
+            times = numpy.concatenate(([carry[0]], times))
+            columns = numpy.concatenate((numpy.array(carry[1], dtype=numpy.float64).reshape(-1, 1), columns), axis=1)
+            offset = 1
+
+        window = _Window((times - times[0]) / 1e9, offset, self.max_gap)
+        namespace = window.namespace()
+        namespace.update(zip(series.fields, columns))
+        fields = {}
+        with numpy.errstate(all='ignore'):
+            for formula in self.formulas[series.measurement]:
+                try:
+                    result = eval(formula.code, {'__builtins__': {}}, namespace)
+                    if numpy.ndim(result):
+                        result = window.mean(result)
+                    result = numpy.float64(result)
+                except Exception as e:
+                    self.failed += 1
+                    self.logger.warning(f"{series.measurement}: formula {formula.name} failed: {e}")
+                    result = numpy.float64('nan')
+                namespace[formula.name] = result
+                # e.g. the efficiency without DC power at night
+                if numpy.isfinite(result):
+                    fields[formula.name] = float(result)
+        if not fields:
+            return
+        fields['samples'] = samples
+
+        self.emitted += 1
+        output.append({
+            'measurement': f'{series.measurement}_derived_{self.window}s',
+            'tags': series.tags,
+            'time': start,
+            'fields': fields,
+        })
+
+    def _close_idle(self, output: List[Dict]):
+        now = time.monotonic()
+        for series in self._series.values():
+            if series.times and now - series.touched > self.idle_timeout:
+                self._close(series, output)
+
+    def flush(self) -> List[Dict]:
+        output = []
+        with self._lock:
+            for series in self._series.values():
+                self._close(series, output)
+        return output
+
+    def report(self) -> List[str]:
+        with self._lock:
+            open_samples = sum(len(series.times) for series in self._series.values())
+            return [f"derived metrics: {len(self._series)} series, {open_samples} open samples, "
+                    f"samples={self.samples}, emitted={self.emitted}, late={self.late}, failed={self.failed}"]
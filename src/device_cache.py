@@ -0,0 +1,137 @@
+import logging
+import sys
+import threading
+import time
+from types import MappingProxyType
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+
+# minimum time in seconds between two refreshes which are requested by data of unknown devices
+MIN_REFRESH_INTERVAL = 60.0
+# delay in seconds before a failed refresh is retried
+RETRY_INTERVAL = 60.0
+
+Tags = Mapping[str, str]
+
+
+def parse_inverter_info(data: Dict) -> Dict[str, str]:
+    # {"1": {"UniqueID": "30100001", ...}, ...} of GetInverterInfo.cgi
+    return {str(device_id): str(info['UniqueID']) for device_id, info in data.items() if info.get('UniqueID')}
+
+
+def parse_active_device_info(data: Dict) -> Dict[str, str]:
+    # {"1": {"DT": 1, "Serial": "30100001"}, ...} of GetActiveDeviceInfo.cgi?DeviceClass=Inverter
+    return {str(device_id): str(info['Serial']) for device_id, info in data.items() if info.get('Serial')}
+
+
+# Serial numbers of the inverters by device id with their tags. Every tag set is built once as an immutable mapping
+# of interned strings and shared by all data points of the device until its serial number changes, so the encoder
+# can reuse the escaped tags by identity. With a fetch function the serial numbers are refreshed in a background
+# thread after the TTL and early when data of an unknown device arrives, polling never waits for a refresh.
+class DeviceCache:
+    def __init__(self, fetch: Optional[Callable[[], Dict[str, str]]] = None, ttl: float = 3600.0,
+                 min_refresh_interval: float = MIN_REFRESH_INTERVAL):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.fetch = fetch
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+
+        self.serials: Dict[str, str] = {}
+        # tags by (device id, power flow version)
+        self._tags: Dict[Tuple[str, Optional[str]], Tags] = {}
+
+        self.updated: Optional[float] = None
+        self.refreshes = 0
+        self.failures = 0
+        self.changes = 0
+        self.misses = 0
+
+        self._last_refresh = 0.0
+        self._requested = threading.Event()
+        self._closing = threading.Event()
+        # set after the first refresh attempt, successful or not
+        self.ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def tags(self, device_id: str, version: Optional[str] = None) -> Tags:
+        key = (device_id, version)
+        tags = self._tags.get(key)
+        if tags is None:
+            serial = self.serials.get(device_id)
+            if serial is None:
+                self.misses += 1
+                self.request_refresh()
+            items = {'DeviceId': sys.intern(device_id), 'Serial': sys.intern(serial or "None")}
+            if version is not None:
+                items['Version'] = sys.intern(str(version))
+            tags = self._tags.setdefault(key, MappingProxyType(items))
+        return tags
+
+    def update(self, serials: Dict[str, str]):
+        previous = self.serials
+        self.updated = time.monotonic()
+        if serials == previous:
+            return
+        changed = {device_id for device_id in set(previous) | set(serials)
+                   if previous.get(device_id) != serials.get(device_id)}
+        for device_id in sorted(changed):
+            if device_id in previous:
+                self.changes += 1
+                self.logger.info(f"serial of device {device_id} changed: {previous[device_id]} -> "
+                                 f"{serials.get(device_id)}")
+
+        # readers see either the old or the new state, the tags of unchanged devices keep their identity
+        self.serials = dict(serials)
+        self._tags = {key: tags for key, tags in self._tags.items() if key[0] not in changed}
+
+    def refresh(self) -> bool:
+        self._last_refresh = time.monotonic()
+        try:
+            serials = self.fetch()
+            if not serials:
+                # e.g. while the inverters are switched off, keep the known devices
+                raise ValueError('no devices reported')
+        except Exception as e:
+            self.failures += 1
+            self.logger.warning(f"updating the device info failed: {e}")
+            return False
+        finally:
+            self.refreshes += 1
+        self.update(serials)
+        return True
+
+    def request_refresh(self):
+        if self._thread is not None:
+            self._requested.set()
+
+    def start(self):
+        if self.fetch is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # the first refresh right away, then after the TTL or early on request
+        success = self.refresh()
+        self.ready.set()
+        while not self._closing.is_set():
+            self._requested.wait(self.ttl if success else RETRY_INTERVAL)
+            if self._closing.is_set():
+                return
+            if self._requested.is_set():
+                self._requested.clear()
+                delay = self._last_refresh + self.min_refresh_interval - time.monotonic()
+                if delay > 0 and self._closing.wait(delay):
+                    return
+            success = self.refresh()
+
+    def report(self) -> List[str]:
+        age = f"{time.monotonic() - self.updated:.0f} s" if self.updated is not None else 'n/a'
+        return [f"devices: {len(self.serials)} known, age={age}, refreshes={self.refreshes} "
+                f"(failed={self.failures}), serial changes={self.changes}, unknown lookups={self.misses}"]
+
+    def close(self):
+        self._closing.set()
+        self._requested.set()
+        if self._thread is not None:
+            self._thread.join(5.0)
@@ -0,0 +1,359 @@
+import asyncio
+import dataclasses
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Union
+
+from influxdb_client import InfluxDBClient
+
+from config import Config
+from influxdb_bridge import InfluxDBBridge, create_writer, default_tags
+from line_protocol import LineProtocolEncoder
+from metrics import NULL_METRICS, Metrics
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# maximum number of messages buffered between the workers and the writer of the supervisor
+QUEUE_SIZE = 10000
+# interval in seconds at which the workers report their resource usage
+STATS_INTERVAL = 10.0
+# a worker which ran at least this long before it failed is restarted after the initial delay again
+STABLE_AFTER = 300.0
+
+
+def shard(inverters: List[Config.Inverter], workers: int) -> List[List[Config.Inverter]]:
+    # inverters behind the same host (e.g. a Datamanager) share its rate limit, so they stay in the same worker
+    hosts: Dict[str, List[Config.Inverter]] = {}
+    for inverter in inverters:
+        hosts.setdefault(urllib.parse.urlsplit(inverter.url).netloc, []).append(inverter)
+
+    # the largest hosts first, each to the worker with the fewest inverters
+    shards: List[List[Config.Inverter]] = [[] for _ in range(min(workers, len(hosts)))]
+    for group in sorted(hosts.values(), key=len, reverse=True):
+        min(shards, key=len).extend(group)
+    return shards
+
+
+def current_rss() -> int:
+    # resident memory in bytes, the peak is used where the current value is not available
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+
+# Writer of a worker process, which encodes the data points and passes them to the shared writer of the supervisor.
+class QueueWriter:
+    def __init__(self, messages: multiprocessing.Queue, tags: Dict[str, str]):
+        self.messages = messages
+        self.encoder = LineProtocolEncoder(tags)
+        self.lines = 0
+
+    def write(self, points: List[Union[Dict, bytes]]):
+        lines = [point if isinstance(point, bytes) else self.encoder.encode(point) for point in points]
+        lines = [line for line in lines if line]
+        if lines:
+            # blocks while the supervisor is behind
+            self.messages.put(('lines', lines))
+            self.lines += len(lines)
+
+    def spill(self, lines: List[bytes]) -> bool:
+        # the spool belongs to the supervisor, blocks while it is behind
+        if lines:
+            self.messages.put(('spill', lines))
+        return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return True
+
+    def report(self) -> List[str]:
+        return []
+
+    def close(self):
+        pass
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def run_worker(idx: int, config: Config, inverters: List[Config.Inverter], influxdb_file: str,
+               messages: multiprocessing.Queue):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(processName)s %(name)s] %(levelname)s: %(message)s')
+    signal.signal(signal.SIGTERM, _terminate)
+    logger = logging.getLogger('Worker')
+
+    client = InfluxDBClient.from_config_file(influxdb_file)
+    bridges: List[InfluxDBBridge] = []
+    for inverter in inverters:
+        # the metrics endpoint, the spool and the backfill belong to the supervisor, the live values are not served
+        inverter_config = dataclasses.replace(config, inverter=inverter, inverters=[inverter],
+                                              location=config.sites.get(inverter.site, config.location),
+                                              metrics=None, spool=None, backfill=None, fleet=None, live=None)
+        writer = QueueWriter(messages, default_tags(inverter_config, client))
+        bridges.append(InfluxDBBridge(inverter_config, client, writer=writer))
+
+    # inverters behind the same host share one rate limiter and its budget before they are polled
+    limiters = {}
+    host_endpoints: Dict[str, int] = {}
+    for bridge in bridges:
+        for host, count in bridge.scheduler.host_endpoints.items():
+            host_endpoints[host] = host_endpoints.get(host, 0) + count
+    for bridge in bridges:
+        bridge.scheduler.share_limiters(limiters, host_endpoints)
+
+    async def report_stats():
+        while True:
+            messages.put(('stats', idx, {
+                'pid': os.getpid(),
+                'inverters': len(inverters),
+                'rss': current_rss(),
+                'cpu': time.process_time(),
+                'polls': sum(bridge.polls for bridge in bridges),
+                'lines': sum(bridge.writer.lines for bridge in bridges),
+            }))
+            await asyncio.sleep(STATS_INTERVAL)
+
+    async def run():
+        await asyncio.gather(report_stats(), *[bridge.run_async() for bridge in bridges])
+
+    logger.info(f"polling {', '.join(inverter.name for inverter in inverters)}")
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for bridge in bridges:
+            bridge.close()
+        # wait until the remaining data points are passed to the supervisor
+        messages.close()
+        messages.join_thread()
+
+
+@dataclasses.dataclass
+class WorkerState:
+    idx: int
+    inverters: List[Config.Inverter]
+    process: Optional[multiprocessing.Process] = None
+    started: float = 0.0
+    next_start: float = 0.0
+    failures: int = 0
+    restarts: int = 0
+    stats: Optional[Dict] = None
+    # the first stats of a worker, to exclude the start-up from the CPU time per sample
+    baseline: Optional[Dict] = None
+    # the inverters of a single host which kept failing are not polled anymore
+    quarantined: bool = False
+
+
+# Runs the inverters of a fleet sharded over worker processes, each polling its inverters in one asyncio loop. The
+# data points of all workers are written by one batching writer. Failed workers are restarted with a growing delay,
+# the hosts of a worker which keeps failing are split over it and a new worker, until the failing host is alone in a
+# worker and quarantined. The other workers keep running.
+class FleetSupervisor:
+    def __init__(self, config: Config, influx_client: InfluxDBClient, influxdb_file: str):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = config
+        self.influxdb_file = influxdb_file
+        self.metrics = Metrics() if config.metrics else NULL_METRICS
+        self.writer = create_writer(config, influx_client, self.metrics)
+
+        self.context = multiprocessing.get_context('spawn')
+        self.messages = self.context.Queue(maxsize=QUEUE_SIZE)
+        self.slots = config.fleet.workers
+        self.workers: List[WorkerState] = []
+        self._closing = False
+
+        self.worker_rss = self.metrics.gauge('worker_rss_bytes', 'Resident memory of a worker process', ['worker'])
+        self.worker_cpu = self.metrics.counter('worker_cpu_seconds', 'CPU time of a worker process', ['worker'])
+        self.worker_polls = self.metrics.counter('worker_polls', 'Requests of a worker process', ['worker'])
+        self.worker_restarts = self.metrics.counter('worker_restarts', 'Restarts of a worker process', ['worker'])
+        self.metrics.collectors.append(self._collect)
+
+    def _assign(self):
+        self.workers = [WorkerState(idx, inverters) for idx, inverters in
+                        enumerate(shard(self.config.inverters, self.slots))]
+        for worker in self.workers:
+            self.logger.info(f"worker-{worker.idx}: {', '.join(inverter.name for inverter in worker.inverters)}")
+
+    def _start(self, worker: WorkerState):
+        worker.process = self.context.Process(target=run_worker, name=f'worker-{worker.idx}', daemon=True,
+                                              args=(worker.idx, self.config, worker.inverters, self.influxdb_file,
+                                                    self.messages))
+        worker.process.start()
+        worker.started = time.monotonic()
+
+    def _stop_all(self, timeout: float = 30.0):
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+
+        # keep draining the queue, a worker only exits after its data points are passed on
+        deadline = time.monotonic() + timeout
+        while any(worker.process and worker.process.is_alive() for worker in self.workers):
+            if time.monotonic() > deadline:
+                for worker in self.workers:
+                    if worker.process and worker.process.is_alive():
+                        self.logger.warning(f"worker-{worker.idx} did not stop, killing it")
+                        worker.process.kill()
+                break
+            self._drain(0.1)
+        self._drain(0.0)
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(1.0)
+                worker.process = None
+
+    def _drain(self, timeout: float):
+        try:
+            message = self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+            while True:
+                self._handle(message)
+                message = self.messages.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _handle(self, message):
+        if message[0] == 'lines':
+            self.writer.write_lines(message[1])
+        elif message[0] == 'spill':
+            if not self.writer.spill(message[1]):
+                self.writer.write_lines(message[1])
+        elif message[0] == 'stats':
+            _, idx, stats = message
+            if idx < len(self.workers):
+                worker = self.workers[idx]
+                if worker.baseline is None:
+                    worker.baseline = stats
+                worker.stats = stats
+
+    def _check(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.quarantined:
+                continue
+            if worker.process is None:
+                if now >= worker.next_start:
+                    self._start(worker)
+                continue
+            if worker.process.is_alive():
+                continue
+
+            self.logger.warning(f"worker-{worker.idx} exited with code {worker.process.exitcode}")
+            worker.process = None
+            worker.stats = None
+            worker.baseline = None
+            worker.failures = 1 if now - worker.started >= STABLE_AFTER else worker.failures + 1
+            worker.restarts += 1
+
+            if worker.failures > self.config.fleet.max_restarts:
+                self._isolate(worker, now)
+                continue
+
+            delay = self.config.fleet.restart_delay * 2 ** min(worker.failures - 1, 6)
+            worker.next_start = now + delay
+            self.logger.info(f"restarting worker-{worker.idx} in {delay:.0f} s")
+
+    def _isolate(self, worker: WorkerState, now: float):
+        groups = shard(worker.inverters, 2)
+        if len(groups) == 1:
+            worker.quarantined = True
+            self.logger.error(f"worker-{worker.idx} failed {worker.failures} times in a row, quarantining "
+                              f"{', '.join(inverter.name for inverter in worker.inverters)}")
+            return
+
+        # the failing worker keeps half of its hosts, the other half moves to a new worker
+        self.logger.error(f"worker-{worker.idx} failed {worker.failures} times in a row, "
+                          f"splitting its inverters over two workers")
+        split = WorkerState(len(self.workers), groups[1], next_start=now + self.config.fleet.restart_delay)
+        worker.inverters = groups[0]
+        worker.failures = 0
+        worker.next_start = now + self.config.fleet.restart_delay
+        self.workers.append(split)
+        for state in (worker, split):
+            self.logger.info(f"worker-{state.idx}: {', '.join(inverter.name for inverter in state.inverters)}")
+
+    def run(self):
+        self.logger.info(f"starting fleet of {len(self.config.inverters)} inverters in {self.slots} workers")
+        if self.config.metrics:
+            self.metrics.serve(self.config.metrics.host, self.config.metrics.port)
+        if self.config.live:
+            self.logger.warning("live values are not served in fleet mode")
+        self._assign()
+
+        next_report = time.monotonic() + self.config.fleet.report_interval
+        try:
+            while True:
+                self._drain(1.0)
+                self._check()
+                if time.monotonic() >= next_report:
+                    next_report += self.config.fleet.report_interval
+                    for line in self.report():
+                        self.logger.info(line)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def _collect(self):
+        for worker in self.workers:
+            if worker.stats:
+                self.worker_rss.labels(str(worker.idx)).set(worker.stats['rss'])
+                self.worker_cpu.labels(str(worker.idx)).set(worker.stats['cpu'])
+                self.worker_polls.labels(str(worker.idx)).set(worker.stats['polls'])
+            self.worker_restarts.labels(str(worker.idx)).set(worker.restarts)
+
+    def report(self) -> List[str]:
+        lines = []
+        total_rss = current_rss()
+        total_cpu = 0.0
+        total_polls = 0
+        for worker in self.workers:
+            stats = worker.stats
+            if not stats:
+                state = "quarantined" if worker.quarantined else "not running"
+                lines.append(f"worker-{worker.idx}: {len(worker.inverters)} inverters, {state} "
+                             f"(restarts={worker.restarts})")
+                continue
+            cpu = stats['cpu'] - worker.baseline['cpu']
+            polls = stats['polls'] - worker.baseline['polls']
+            total_rss += stats['rss']
+            total_cpu += cpu
+            total_polls += polls
+            cpu_per_sample = f"{cpu / polls * 1000:.2f} ms" if polls else "n/a"
+            lines.append(f"worker-{worker.idx} (pid {stats['pid']}): {stats['inverters']} inverters, "
+                         f"rss={stats['rss'] / 1024 / 1024:.1f} MB "
+                         f"({stats['rss'] / stats['inverters'] / 1024 / 1024:.1f} MB/inverter), "
+                         f"cpu/sample={cpu_per_sample}, samples={stats['polls']}, points={stats['lines']}, "
+                         f"restarts={worker.restarts}")
+
+        cpu_per_sample = f"{total_cpu / total_polls * 1000:.2f} ms" if total_polls else "n/a"
+        lines.append(f"fleet: {len(self.config.inverters)} inverters in {len(self.workers)} workers, "
+                     f"rss={total_rss / 1024 / 1024:.1f} MB "
+                     f"({total_rss / len(self.config.inverters) / 1024 / 1024:.1f} MB/inverter incl. supervisor), "
+                     f"cpu/sample={cpu_per_sample}")
+        lines.extend(self.writer.report())
+        return lines
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self.logger.info("closing fleet")
+        self._stop_all()
+        self.writer.close()
+        self.metrics.close()
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+import urllib.parse
+from dataclasses import dataclass
+from typing import Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+@dataclass
+class HostStats:
+    connects: int = 0
+    requests: int = 0
+    new_connections: int = 0
+    new_latency: float = 0.0
+    reused_latency: float = 0.0
+    max_latency: float = 0.0
+
+    @property
+    def reused_connections(self) -> int:
+        return self.requests - self.new_connections
+
+    def record(self, latency: float, new_connection: bool):
+        self.requests += 1
+        if new_connection:
+            self.new_connections += 1
+            self.new_latency += latency
+        else:
+            self.reused_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+
+def _counting_pool_classes(stats: HostStats, lock: threading.Lock) -> Dict[str, type]:
+    # count every socket that is opened, including reconnects of dropped keep-alive connections
+    def new_conn(connection_cls):
+        def _new_conn(self):
+            with lock:
+                stats.connects += 1
+            return connection_cls._new_conn(self)
+        return _new_conn
+
+    http_connection = type('CountingHTTPConnection', (HTTPConnection,), {'_new_conn': new_conn(HTTPConnection)})
+    https_connection = type('CountingHTTPSConnection', (HTTPSConnection,), {'_new_conn': new_conn(HTTPSConnection)})
+    return {
+        'http': type('CountingHTTPConnectionPool', (HTTPConnectionPool,), {'ConnectionCls': http_connection}),
+        'https': type('CountingHTTPSConnectionPool', (HTTPSConnectionPool,), {'ConnectionCls': https_connection}),
+    }
+
+
+class SessionPool:
+    def __init__(self, connect_timeout: float = 3.0, read_timeout: float = 10.0, max_connections: int = 2):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_connections = max_connections
+
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+        self.stats: Dict[str, HostStats] = {}
+
+    def _session(self, host: str) -> requests.Session:
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                stats = HostStats()
+
+                # one keep-alive pool per inverter host, blocking when all connections are in use
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections, pool_block=True,
+                                      max_retries=0)
+                adapter.poolmanager.pool_classes_by_scheme = _counting_pool_classes(stats, self._lock)
+
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+                self.stats[host] = stats
+            return session
+
+    def get(self, url: str) -> requests.Response:
+        host = urllib.parse.urlsplit(url).netloc
+        session = self._session(host)
+        stats = self.stats[host]
+
+        connects = stats.connects
+        start = time.perf_counter()
+        response = session.get(url, timeout=self.timeout)
+        latency = time.perf_counter() - start
+
+        # the counter is shared by parallel requests, so attribution is approximate under load
+        with self._lock:
+            stats.record(latency, new_connection=stats.connects > connects)
+        return response
+
+    def report(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for host, stats in self.stats.items():
+                if not stats.requests:
+                    continue
+                reused = stats.reused_connections
+                new_avg = stats.new_latency / stats.new_connections if stats.new_connections else 0.0
+                reused_avg = stats.reused_latency / reused if reused else 0.0
+                saved = reused * (new_avg - reused_avg) if stats.new_connections and reused else 0.0
+                lines.append(f"{host}: {stats.requests} requests, {reused} reused connections, "
+                             f"latency new={new_avg * 1000:.1f} ms reused={reused_avg * 1000:.1f} ms "
+                             f"max={stats.max_latency * 1000:.1f} ms, saved ~{saved:.2f} s by keep-alive")
+        return lines
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
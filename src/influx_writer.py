@@ -0,0 +1,297 @@
+import datetime
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Union
+
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import WriteOptions, WriteType
+
+from line_protocol import LineProtocolEncoder
+from metrics import NULL_METRICS, Metrics
+from spool import Spool
+
+BatchCallback = Callable[[List[bytes]], None]
+
+
+class BatchingWriter:
+    def __init__(self, influx_client: InfluxDBClient, bucket: str, batch_size: int = 500,
+                 flush_interval: float = 10.0, max_queue_bytes: int = 16 * 1024 * 1024,
+                 max_retries: int = 5, retry_interval: float = 2.0, max_retry_delay: float = 60.0,
+                 spool: Optional[Spool] = None, replay_rate: float = 500.0, metrics: Metrics = NULL_METRICS,
+                 default_tags: Optional[Dict[str, str]] = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.bucket = bucket
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_bytes = max_queue_bytes
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.max_retry_delay = max_retry_delay
+        self.spool = spool
+        self.replay_rate = replay_rate
+
+        # retries are handled here, so the client must not block the flush thread with its own retries
+        self.write_api = influx_client.write_api(write_options=WriteOptions(write_type=WriteType.synchronous,
+                                                                            max_retries=0))
+        self.encoder = LineProtocolEncoder(influx_client.default_tags if default_tags is None else default_tags)
+
+        # called with batches which could not be written or were evicted from the queue
+        self.on_failure: Optional[BatchCallback] = None
+        self.on_overflow: Optional[BatchCallback] = None
+
+        self._queue: Deque[bytes] = deque()
+        self._queue_bytes = 0
+        self._queue_since: Optional[float] = None
+        # evicted points waiting for the flush thread to pass them to the overflow callback or the spool
+        self._evicted: List[bytes] = []
+        self._evicted_bytes = 0
+        self._cond = threading.Condition()
+        self._closing = threading.Event()
+        self._writing = False
+        self._flush_requests = 0
+
+        # replay of spooled batches starts optimistically and pauses while InfluxDB is unreachable
+        self._healthy = True
+        self._next_replay = time.monotonic()
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.replayed = 0
+        self.last_flush_duration = 0.0
+
+        self.write_seconds = metrics.histogram('influxdb_write_seconds',
+                                               'Duration of a write request to InfluxDB').labels()
+        self.batch_points = metrics.histogram('influxdb_batch_points', 'Number of data points per write request',
+                                              buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000)).labels()
+        self.points_total = metrics.counter('writer_points', 'Data points handled by the writer', ['result'])
+        self.queue_gauge = metrics.gauge('writer_queue_points', 'Data points waiting to be written')
+        self.queue_bytes_gauge = metrics.gauge('writer_queue_bytes', 'Memory of the data points waiting to be written')
+        self.spool_gauge = metrics.gauge('spool_points', 'Data points in the disk spool')
+        metrics.collectors.append(self._collect)
+
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def write(self, points: List[Union[Dict, bytes]]):
+        # data points can be passed pre-encoded as line protocol
+        lines = [point if isinstance(point, bytes) else self.encoder.encode(point) for point in points]
+        self.write_lines([line for line in lines if line])
+
+    def write_lines(self, lines: List[bytes]):
+        if not lines:
+            return
+
+        evicted = []
+        with self._cond:
+            if not self._queue:
+                self._queue_since = time.monotonic()
+            self._queue.extend(lines)
+            self._queue_bytes += sum(map(len, lines))
+
+            # never block the caller, evict the oldest points instead
+            while self._queue_bytes > self.max_queue_bytes and self._queue:
+                line = self._queue.popleft()
+                self._queue_bytes -= len(line)
+                evicted.append(line)
+
+            # the spool is written by the flush thread, unless it falls behind by another full queue
+            if evicted and (self.on_overflow or self.spool) and self._evicted_bytes < self.max_queue_bytes:
+                self._evicted.extend(evicted)
+                self._evicted_bytes += sum(map(len, evicted))
+                evicted = []
+                self._cond.notify_all()
+            elif len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+        if evicted:
+            self._drop(evicted)
+
+    def spill(self, lines: List[bytes]) -> bool:
+        # points which could not be queued by the caller (e.g. the write stage of a pipeline) go to the spool directly
+        if not self.spool:
+            return False
+        if lines:
+            self.spool.append(lines)
+        return True
+
+    def _take_evicted(self) -> List[bytes]:
+        evicted = self._evicted
+        self._evicted = []
+        self._evicted_bytes = 0
+        return evicted
+
+    def _overflow(self, lines: List[bytes]):
+        if self.on_overflow:
+            self.on_overflow(lines)
+        else:
+            self.spool.append(lines)
+
+    def _drop(self, lines: List[bytes]):
+        self.dropped += len(lines)
+        self.logger.warning(f"write queue is full, dropped {len(lines)} points (total {self.dropped})")
+
+    def _flush_due(self) -> bool:
+        if not self._queue:
+            return False
+        if len(self._queue) >= self.batch_size or self._closing.is_set() or self._flush_requests:
+            return True
+        return time.monotonic() - self._queue_since >= self.flush_interval
+
+    def _take_batch(self) -> List[bytes]:
+        count = min(self.batch_size, len(self._queue))
+        batch = [self._queue.popleft() for _ in range(count)]
+        self._queue_bytes -= sum(map(len, batch))
+        self._queue_since = time.monotonic() if self._queue else None
+        return batch
+
+    def _replay_due(self) -> bool:
+        if not self.spool or self._closing.is_set():
+            return False
+        return time.monotonic() >= self._next_replay and self.spool.records > 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._flush_due() and not self._replay_due() and not self._evicted:
+                    if self._closing.is_set():
+                        return
+                    timeout = self.flush_interval
+                    if self._queue_since is not None:
+                        timeout = max(0.0, self._queue_since + self.flush_interval - time.monotonic())
+                    if self.spool and self.spool.records:
+                        timeout = min(timeout, max(0.0, self._next_replay - time.monotonic()))
+                    self._cond.wait(timeout=timeout)
+                evicted = self._take_evicted()
+                batch = self._take_batch() if self._flush_due() else None
+                self._writing = bool(batch or evicted)
+
+            # the evicted points are older than the batch, live data always goes before the backlog is replayed
+            if evicted:
+                self._overflow(evicted)
+            if batch:
+                self._write_batch(batch)
+            if batch or evicted:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+            elif self._replay_due():
+                self._replay()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # write all queued points now and wait until they are written (or spooled)
+        with self._cond:
+            self._flush_requests += 1
+            self._cond.notify_all()
+            try:
+                return self._cond.wait_for(lambda: not self._queue and not self._evicted and not self._writing, timeout)
+            finally:
+                self._flush_requests -= 1
+
+    def _post(self, lines: List[bytes]):
+        start = time.perf_counter()
+        self.write_api.write(bucket=self.bucket, record=b'\n'.join(lines))
+        self.last_flush_duration = time.perf_counter() - start
+        self.write_seconds.observe(self.last_flush_duration)
+        self.batch_points.observe(len(lines))
+        self._healthy = True
+
+    def _replay(self):
+        lines = self.spool.peek()
+        if not lines:
+            # no readable record although records are counted, e.g. a record which is still being appended
+            self._next_replay = time.monotonic() + self.retry_interval
+            return
+
+        try:
+            self._post(lines)
+        except Exception as e:
+            # live batches are spooled until the next probe succeeds
+            self._healthy = False
+            self._next_replay = time.monotonic() + self.max_retry_delay
+            self.logger.warning(f"replaying {len(lines)} spooled points failed: {e}")
+            return
+
+        self.spool.commit()
+        self.replayed += len(lines)
+        self._next_replay = time.monotonic() + len(lines) / self.replay_rate
+
+    def _write_batch(self, batch: List[bytes]):
+        if self.spool and not self._healthy:
+            # keep the order of the backlog while InfluxDB is known to be down
+            self._failure(batch)
+            return
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._post(batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                if attempt == self.max_retries or self._closing.is_set():
+                    self.logger.warning(f"writing {len(batch)} points failed: {e}")
+                    break
+
+                # exponential backoff with full jitter
+                delay = random.uniform(0.0, min(self.max_retry_delay, self.retry_interval * 2 ** attempt))
+                self.logger.warning(f"writing {len(batch)} points failed, retry in {delay:.1f} s: {e}")
+                if self._closing.wait(delay):
+                    break
+
+        self._failure(batch)
+
+    def _failure(self, batch: List[bytes]):
+        if self.on_failure:
+            self.on_failure(batch)
+            return
+        if self.spool:
+            self._healthy = False
+            self.spool.append(batch)
+            return
+
+        self.failed += len(batch)
+        self.logger.error(f"dropped {len(batch)} points after failed write (total {self.failed})")
+
+    @property
+    def queue_size(self) -> int:
+        return len(self._queue)
+
+    @property
+    def queue_bytes(self) -> int:
+        return self._queue_bytes
+
+    def _collect(self):
+        self.points_total.labels('written').set(self.written)
+        self.points_total.labels('dropped').set(self.dropped + (self.spool.evicted if self.spool else 0))
+        self.points_total.labels('failed').set(self.failed)
+        self.points_total.labels('replayed').set(self.replayed)
+        self.queue_gauge.labels().set(self.queue_size)
+        self.queue_bytes_gauge.labels().set(self.queue_bytes)
+        if self.spool:
+            self.spool_gauge.labels().set(self.spool.points)
+
+    def report(self) -> List[str]:
+        lines = [f"writer: queue={self.queue_size} points ({self.queue_bytes / 1024:.1f} kB), "
+                 f"written={self.written}, dropped={self.dropped}, failed={self.failed}, "
+                 f"last flush={self.last_flush_duration * 1000:.1f} ms"]
+        if self.spool:
+            oldest = self.spool.oldest_timestamp
+            oldest_str = datetime.datetime.utcfromtimestamp(oldest / 1e9).isoformat() + 'Z' if oldest else 'n/a'
+            lines.append(f"spool: depth={self.spool.points} points in {self.spool.records} batches "
+                         f"({self.spool.size / 1024 / 1024:.1f} MB), oldest={oldest_str}, "
+                         f"replayed={self.replayed} (max {self.replay_rate:.0f} points/s), "
+                         f"evicted={self.spool.evicted}")
+        return lines
+
+    def close(self, timeout: float = 30.0):
+        self._closing.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self.write_api.close()
+        if self.spool:
+            self.spool.close()
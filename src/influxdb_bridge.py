@@ -1,80 +1,580 @@
 import argparse
+import asyncio
 import datetime
 import logging
 import time
 import urllib
-from typing import Dict
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
-import pytz
 import requests
 from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS
 
+from aggregation import WindowAggregator
+from backfill import Backfill
 from config import load_config, Config
-from data_processor import DataProcessor
+from data_processor import DataProcessor, WrongFroniusData
+from deadband import DeadbandFilter, Tolerance
+from decoder import ResponseDecoder
+from derived_metrics import DerivedMetrics
+from device_cache import DeviceCache, parse_active_device_info, parse_inverter_info
+from http_client import SessionPool
+from influx_writer import BatchingWriter
+from line_protocol import LineProtocolEncoder
+from live_cache import LiveCache
+from metrics import NULL_METRICS, Metrics
+from modbus_source import MODBUS_METRICS, ModbusSource
+from parquet_sink import ParquetSink
+from pipeline import Pipeline, Stage
+from rate_control import RateControl
+from recorder import recorder_directory, ResponseRecorder, ResponseReplay
+from request_planner import RequestPlanner
+from scheduler import HostLimits, PollScheduler
+from solar_schedule import PHASES, SolarSchedule
+from spool import Spool
 
 
-class SunIsDown(Exception):
-    pass
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"rate limited, retry after {retry_after:.0f} s")
+        self.retry_after = retry_after
+
+
+class StatusCodeError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"response status code {code}")
+        self.code = code
+
+
+def default_tags(config: Config, influx_client: InfluxDBClient) -> Dict[str, str]:
+    # the site of the inverter is an additional tag of all of its data points
+    tags = dict(influx_client.default_tags or {})
+    if config.inverter.site:
+        tags['Site'] = config.inverter.site
+    return tags
+
+
+def create_writer(config: Config, influx_client: InfluxDBClient, metrics: Metrics = NULL_METRICS,
+                  default_tags: Optional[Dict[str, str]] = None) -> BatchingWriter:
+    spool = None
+    if config.spool:
+        spool = Spool(config.spool.directory,
+                      max_bytes=int(config.spool.max_mb * 1024 * 1024),
+                      segment_bytes=int(config.spool.segment_mb * 1024 * 1024),
+                      fsync=config.spool.fsync)
+    return BatchingWriter(influx_client, config.record.influxdb_bucket,
+                          batch_size=config.record.batch_size,
+                          flush_interval=config.record.flush_interval,
+                          max_queue_bytes=int(config.record.max_queue_mb * 1024 * 1024),
+                          spool=spool,
+                          replay_rate=config.spool.replay_rate if spool else 0.0,
+                          metrics=metrics,
+                          default_tags=default_tags)
 
 
 class InfluxDBBridge:
-    def __init__(self, config: Config, influx_client: InfluxDBClient):
+    def __init__(self, config: Config, influx_client: InfluxDBClient, writer: Optional[BatchingWriter] = None,
+                 metrics: Optional[Metrics] = None):
         self.logger = logging.getLogger(self.__class__.__name__)
 
         self.config = config
         self.influx_client = influx_client
-        self.processor = DataProcessor()
-        self.endpoints = self._get_endpoints()
+
+        self.metrics = metrics or NULL_METRICS
+        if metrics is None and self.config.metrics:
+            self.metrics = Metrics()
+        self.stage_seconds = self.metrics.histogram('stage_seconds', 'Duration of a processing stage per metric',
+                                                    ['stage', 'metric'])
+        self.points_produced = self.metrics.counter('points_produced', 'Data points produced per metric', ['metric'])
+        self.poll_errors = self.metrics.counter('poll_errors', 'Failed polls per metric and error', ['metric', 'error'])
+
+        self.default_tags = default_tags(self.config, influx_client)
+
+        # the writer is shared by all inverters in fleet mode
+        self.writer = writer or create_writer(self.config, influx_client, self.metrics, self.default_tags)
+        self.decoder = ResponseDecoder(self.config.record.json_backend)
+        self.devices = DeviceCache(self._fetch_devices, ttl=self.config.inverter.device_info_ttl)
+        self.modbus = None
+        if self.config.inverter.modbus:
+            modbus = self.config.inverter.modbus
+            self.modbus = ModbusSource(modbus.host, modbus.port, units=modbus.units, meters=modbus.meters,
+                                       timeout=modbus.timeout, devices=self.devices)
+        self.processor = DataProcessor(LineProtocolEncoder(self.default_tags)
+                                       if self.config.record.line_protocol else None, self.devices)
+
+        # processing stages between the processor and the writer, which work on data point dicts
+        self.stages: List[Tuple[str, Callable[[List[Dict]], List[Dict]]]] = []
+        self.live = None
+        if self.config.live:
+            # the raw samples, before aggregation and deadband
+            self.live = LiveCache(history=self.config.live.history, max_series=self.config.live.max_series,
+                                  measurements=self.config.live.measurements)
+            self.stages.append(('live', self.live.update))
+        self.derived = None
+        if self.config.derived:
+            # the raw samples, the derived points are aggregated and filtered like the samples
+            self.derived = DerivedMetrics(window=self.config.derived.window, max_gap=self.config.derived.max_gap,
+                                          formulas=self.config.derived.formulas,
+                                          max_series=self.config.derived.max_series)
+            self.stages.append(('derived', self.derived.process))
+        self.aggregator = None
+        if self.config.aggregation:
+            self.aggregator = WindowAggregator(self.config.aggregation.windows,
+                                               allowed_lateness=self.config.aggregation.allowed_lateness,
+                                               keep_raw=self.config.aggregation.keep_raw,
+                                               measurements=self.config.aggregation.measurements,
+                                               max_series=self.config.aggregation.max_series)
+            self.stages.append(('aggregation', self.aggregator.process))
+        self.deadband = None
+        if self.config.deadband:
+            self.deadband = DeadbandFilter(heartbeat=self.config.deadband.heartbeat,
+                                           default=Tolerance(self.config.deadband.absolute,
+                                                             self.config.deadband.relative),
+                                           measurements=self.config.deadband.measurements,
+                                           max_series=self.config.deadband.max_series)
+            self.stages.append(('deadband', self.deadband.filter))
+        self.parquet = None
+        if self.config.parquet:
+            # the same data points as written to InfluxDB, handed over to the background thread of the sink
+            self.parquet = ParquetSink(self.config.parquet.directory, partition=self.config.parquet.partition,
+                                       compression=self.config.parquet.compression,
+                                       row_group_rows=self.config.parquet.row_group_rows,
+                                       flush_interval=self.config.parquet.flush_interval,
+                                       max_queue_points=self.config.parquet.max_queue_points,
+                                       default_tags=self.default_tags)
+            self.stages.append(('parquet', self.parquet.write))
+        self.recorder = None
+        if self.config.recorder:
+            # the raw responses, e.g. to replay them after a change of the processing
+            directory = recorder_directory(self.config.recorder.directory, self.config.inverter.name)
+            self.recorder = ResponseRecorder(directory,
+                                             segment_bytes=int(self.config.recorder.segment_mb * 1024 * 1024),
+                                             segment_seconds=self.config.recorder.segment_interval,
+                                             max_bytes=int(self.config.recorder.max_mb * 1024 * 1024))
+        self.pipeline = None
+        self.spill = None
+        if self.config.pipeline:
+            self.pipeline = self._create_pipeline(self.config.pipeline)
+        self.suppressed_fields = self.metrics.counter('deadband_suppressed_fields',
+                                                      'Field values skipped by the deadband filter', ['measurement'])
+        self.late_samples = self.metrics.counter('aggregation_late_samples',
+                                                 'Samples which arrived after their window was closed')
+        self.metrics.collectors.append(self._collect_metrics)
+        self.http = SessionPool(connect_timeout=self.config.inverter.connect_timeout,
+                                read_timeout=self.config.inverter.read_timeout,
+                                max_connections=self.config.inverter.max_connections)
+        self.planner = None
+        if self.config.record.plan_requests:
+            self.planner = RequestPlanner(f"{self.config.inverter.url}/solar_api/v1", self.processor,
+                                          [metric for metric in self.config.inverter.metrics
+                                           if not (self.modbus and metric in MODBUS_METRICS)],
+                                          self.config.inverter.device_ids, self.config.inverter.fields)
+            for line in self.planner.report():
+                self.logger.info(line)
+        self.endpoints = self.planner.endpoints if self.planner else self._get_endpoints()
+        hosts = None
+        if self.modbus:
+            # the metrics of the SunSpec models are read over Modbus TCP, without the rate limit of the Solar API
+            self.endpoints.update(self._get_modbus_endpoints())
+            hosts = {f"{self.modbus.client.host}:{self.modbus.client.port}":
+                     HostLimits(1, 0.0, self.config.inverter.modbus.interval)}
+        # columnar batches from the processor to the Parquet sink and the encoder, without the dict stages in between
+        self.columnar = self.config.record.columnar and not self.planner and \
+            all(name == 'parquet' for name, _ in self.stages)
+        if self.config.record.columnar and not self.columnar:
+            self.logger.warning("columnar processing is not supported with request planning, aggregation, deadband, "
+                                "live values or derived metrics and is disabled")
+        self.scheduler = PollScheduler(self.endpoints,
+                                       request_interval=self.config.record.request_interval,
+                                       max_parallel=self.config.record.max_parallel_requests,
+                                       min_gap=self.config.record.min_request_gap,
+                                       metrics=self.metrics, hosts=hosts, rate_control=self._rate_control(),
+                                       deferred_results=self.pipeline is not None)
+        self.schedule = None
+        if not self.config.record.ignore_sunset:
+            self.schedule = SolarSchedule(self.config.location, {
+                'night': self.config.schedule.night_interval,
+                'twilight': self.config.schedule.twilight_interval,
+                'day': self.config.schedule.day_interval,
+                'midday': self.config.schedule.midday_interval,
+            }, midday_window=self.config.schedule.midday_window, idle_interval=self.config.schedule.idle_interval)
+        self.scheduler.reporters.append(self.http.report)
+        self.scheduler.reporters.append(self.devices.report)
+        self.scheduler.reporters.append(self.writer.report)
+        if self.derived:
+            self.scheduler.reporters.append(self.derived.report)
+        if self.aggregator:
+            self.scheduler.reporters.append(self.aggregator.report)
+        if self.deadband:
+            self.scheduler.reporters.append(self.deadband.report)
+        if self.live:
+            self.scheduler.reporters.append(self.live.report)
+        if self.parquet:
+            self.scheduler.reporters.append(self.parquet.report)
+        if self.modbus:
+            self.scheduler.reporters.append(self.modbus.report)
+        if self.recorder:
+            self.scheduler.reporters.append(self.recorder.report)
+        if self.pipeline:
+            self.scheduler.reporters.append(self.pipeline.report)
+
+        # number of requests, e.g. to measure the CPU time per sample
+        self.polls = 0
+
+        self.backfill = None
+        if self.config.backfill:
+            self.backfill = Backfill(f"{self.config.inverter.url}/solar_api/v1", influx_client,
+                                     self.config.record.influxdb_bucket, self.writer, self.http, self.decoder,
+                                     self.processor, self.config.backfill.checkpoint_file,
+                                     chunk_days=self.config.backfill.chunk_days,
+                                     channels=self.config.backfill.channels,
+                                     min_request_gap=self.config.record.min_request_gap,
+                                     metrics=self.config.inverter.metrics,
+                                     schedule=self.schedule or SolarSchedule(self.config.location, {
+                                         phase: self.config.record.request_interval for phase in PHASES}))
 
         self.logger.info("initialize application")
         self.logger.info(f"- inverter config: {self.config.inverter}")
         self.logger.info(f"- record config: {self.config.record}")
         self.logger.info(f"- location info: {self.config.location}")
+        self.logger.info(f"- schedule config: {self.config.schedule}")
+        self.logger.info(f"- spool config: {self.config.spool}")
+        self.logger.info(f"- aggregation config: {self.config.aggregation}")
+        self.logger.info(f"- deadband config: {self.config.deadband}")
+        self.logger.info(f"- backfill config: {self.config.backfill}")
+        self.logger.info(f"- metrics config: {self.config.metrics}")
+        self.logger.info(f"- live config: {self.config.live}")
+        self.logger.info(f"- parquet config: {self.config.parquet}")
+        self.logger.info(f"- recorder config: {self.config.recorder}")
+        self.logger.info(f"- rate control config: {self.config.rate_control}")
+        self.logger.info(f"- pipeline config: {self.config.pipeline}")
+        self.logger.info(f"- derived metrics config: {self.config.derived}")
 
     def run(self):
         self.logger.info("starting application")
+        if self.config.metrics:
+            self.metrics.serve(self.config.metrics.host, self.config.metrics.port)
+        if self.live:
+            self.live.serve(self.config.live.host, self.config.live.port)
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        self.devices.start()
+        tasks = [self.scheduler.run(self._poll)]
+        if self.schedule:
+            tasks.append(self.schedule.run(self.scheduler))
+        if self.backfill and self.config.backfill.gap_detection:
+            tasks.append(self._backfill_gaps())
+        await asyncio.gather(*tasks)
+
+    async def _backfill_gaps(self):
+        # the archive requests share the rate limit of the inverter with the realtime requests
+        loop = asyncio.get_running_loop()
+        self.backfill.loop = loop
+        self.backfill.limiter = self.scheduler.limiters.get(urllib.parse.urlsplit(self.config.inverter.url).netloc)
+        try:
+            await loop.run_in_executor(None, self.backfill.run_gaps,
+                                       datetime.timedelta(days=self.config.backfill.lookback_days),
+                                       datetime.timedelta(seconds=self.config.backfill.min_gap))
+        except Exception as e:
+            self.logger.warning(f"backfill of gaps failed: {e}", exc_info=True)
+        finally:
+            self.backfill.limiter = None
+
+    def run_backfill(self, start: datetime.datetime, end: datetime.datetime):
+        self.logger.info(f"backfill {start} - {end}")
+        self.backfill.run(start, end)
+
+    def run_replay(self, path: str, speed: float):
+        # the recorded responses through the processing and the sinks, without requests to the inverter
+        replay = ResponseReplay(path, self.decoder, speed)
+        self.logger.info(f"replay {len(replay.paths)} segments of {path} at "
+                         f"{f'{speed:g}x speed' if speed else 'full speed'}")
+        start = time.perf_counter()
+        replay.run(self._replay_response)
+        duration = time.perf_counter() - start
+        for line in replay.report():
+            self.logger.info(line)
+        self.logger.info(f"replayed {replay.replayed} responses in {duration:.1f} s "
+                         f"({replay.replayed / duration if duration else 0.0:.0f} responses/s)")
+
+    def _replay_response(self, metric: str, response: Dict):
+        if metric == "InverterInfo":
+            self.devices.update(parse_inverter_info(response['Body']['Data']))
+            return
+        if metric == "ActiveDeviceInfo":
+            self.devices.update({**self.devices.serials, **parse_active_device_info(response['Body']['Data'])})
+            return
+        if self.planner and metric not in self.planner.requests:
+            self.logger.debug(f"{metric}: not a request of the current plan")
+            return
+        if self.pipeline:
+            self.pipeline.submit('process', (metric, None, response, None))
+            return
+        try:
+            data = self._process(metric, response)
+        except Exception as e:
+            self.poll_errors.labels(metric, 'exception').inc()
+            self.logger.warning(f"{metric}: replaying a response failed: {e}")
+            return
+        if data:
+            self._write_data_points(data)
+
+    def _rate_control(self) -> Optional[RateControl]:
+        if not self.config.rate_control:
+            return None
+        rate_control = self.config.rate_control
+        return RateControl(latency_target=rate_control.latency_target, step=rate_control.step,
+                           backoff=rate_control.backoff, min_factor=rate_control.min_factor,
+                           max_factor=rate_control.max_factor, failure_threshold=rate_control.failure_threshold,
+                           open_seconds=rate_control.open_seconds, max_open_seconds=rate_control.max_open_seconds)
+
+    async def _poll(self, metric: str, url: str) -> Optional[float]:
+        loop = asyncio.get_running_loop()
+        self.polls += 1
+        try:
+            await loop.run_in_executor(None, self._poll_endpoint, metric, url)
+        except RateLimited as e:
+            self.poll_errors.labels(metric, 'rate_limited').inc()
+            self.logger.warning(f"{metric}: {e}")
+            return e.retry_after
+        except StatusCodeError as e:
+            # e.g. 255 while a meter is unplugged
+            self.poll_errors.labels(metric, 'status').inc()
+            self.logger.warning(f"{metric}: {e}")
+            return 10.0
+        except (ConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.poll_errors.labels(metric, 'connection').inc()
+            self.logger.info(f"{metric}: waiting 10 seconds for connection...")
+            return 10.0
+        except Exception as e:
+            self.poll_errors.labels(metric, 'exception').inc()
+            self.logger.warning("Exception: {}".format(e), exc_info=True)
+            return 10.0
+        return None
+
+    def _fetch_devices(self) -> Dict[str, str]:
+        if self.modbus:
+            # the serial numbers of the SunSpec common model
+            return self.modbus.serials()
+        base_url = f"{self.config.inverter.url}/solar_api/v1"
+        self.logger.info(f"update inverter map: {base_url}/GetInverterInfo.cgi")
+        serials = parse_inverter_info(self._get_data(f"{base_url}/GetInverterInfo.cgi", "InverterInfo"))
+        if self.config.inverter.active_device_info:
+            # newer firmware reports the serial numbers of all active inverters here
+            serials.update(parse_active_device_info(
+                self._get_data(f"{base_url}/GetActiveDeviceInfo.cgi?DeviceClass=Inverter", "ActiveDeviceInfo")))
+        return serials
+
+    def _get_data(self, url: str, name: Optional[str] = None) -> Dict:
+        response = self.http.get(url)
+        if self.recorder and name:
+            self.recorder.record(name, url, response.status_code, response.content)
+        response.raise_for_status()
+        response = self.decoder.decode(response.content)
+        if response['Head']['Status']['Code'] != 0:
+            raise WrongFroniusData(f"status code {response['Head']['Status']['Code']} of {url}")
+        return response['Body']['Data']
+
+    def _poll_endpoint(self, metric: str, url: str):
+        # the first samples wait for the device info, later ones never wait for a refresh
+        if not self.devices.ready.is_set():
+            self.devices.ready.wait(self.config.inverter.connect_timeout + self.config.inverter.read_timeout)
+
+        if url.startswith('modbus://'):
+            return self._poll_modbus(metric, url)
+
+        self.logger.info(f"requesting {url}")
+        start = time.perf_counter()
+        response = self.http.get(url)
+        if self.recorder:
+            self.recorder.record(metric, url, response.status_code, response.content)
+        if response.status_code == 429:
+            raise RateLimited(float(response.headers.get('Retry-After', 10.0)))
+        latency = time.perf_counter() - start
+        self.stage_seconds.labels('http', metric).observe(latency)
+
+        if self.pipeline:
+            # the request slot is free again while the stages of the pipeline handle the response, the decode stage
+            # reports the result to the rate control
+            self.pipeline.submit('decode', (metric, url, response.content, latency))
+            return
+        self._write(metric, self._process(metric, self._decode(metric, response.content)))
 
-        while True:
-            try:
-                if not self.processor.inverter_map:
-                    url = f"{self.config.inverter.url}/solar_api/v1/GetInverterInfo.cgi"
-                    self.logger.info(f"update inverter map: {url}")
-                    response = requests.get(url)
-                    self.processor.update_inverters(response.json())
-
-                self._sun_is_shining()
-
-                collected_data = []
-                for metric, url in self.endpoints.items():
-                    self.logger.info(f"requesting {url}")
-                    response = requests.get(url)
-                    data = self.processor.process(metric, response.json())
-                    collected_data.extend(data)
-                    time.sleep(self.config.record.request_interval)
-
-                if collected_data:
-                    self._write_data_points(collected_data)
-            except SunIsDown:
-                self.logger.info("waiting for sunrise")
-                time.sleep(60)
-                self.logger.info('waited 60 seconds for sunrise')
-            except ConnectionError:
-                self.logger.info("waiting for connection...")
-                time.sleep(10)
-                self.logger.info('waited 10 seconds for connection')
-            except Exception as e:
-                self.logger.warning("Exception: {}".format(e), exc_info=True)
-                time.sleep(10)
+    def _decode(self, metric: str, content: bytes) -> Dict:
+        start = time.perf_counter()
+        response = self.decoder.decode(content)
+        self.stage_seconds.labels('decode', metric).observe(time.perf_counter() - start)
+        if self.config.rate_control and response.get('Head', {}).get('Status', {}).get('Code', 0) != 0:
+            # a failure of the endpoint for its circuit breaker
+            raise StatusCodeError(response['Head']['Status']['Code'])
+
+        if self.schedule:
+            self._report_power(metric, response)
+        return response
+
+    def _write(self, metric: str, data: List):
+        if data:
+            start = time.perf_counter()
+            self._write_data_points(data)
+            self.stage_seconds.labels('write', metric).observe(time.perf_counter() - start)
+
+    def _poll_modbus(self, metric: str, url: str):
+        # modbus://<host>:<port>/inverter/<device id> or modbus://<host>:<port>/meters
+        path = urllib.parse.urlsplit(url).path.split('/')
+        device_id = path[2] if path[1] == 'inverter' else None
+
+        start = time.perf_counter()
+        points = self.modbus.read(self._base_metric(metric), device_id)
+        now = time.perf_counter()
+        self.stage_seconds.labels('modbus', metric).observe(now - start)
+        self.points_produced.labels(metric).inc(len(points))
+
+        if self.schedule and self._base_metric(metric) == "CommonInverterData" and points:
+            self.schedule.report_power(points[0]['fields'].get('PAC'))
+        if self.pipeline:
+            self.pipeline.submit('process', (metric, url, points, None))
+            self.scheduler.complete(metric, now - start, False)
+            return
+        self._write(metric, self._run_stages(metric, points, now))
+
+    def _create_pipeline(self, config: Config.Pipeline) -> Pipeline:
+        # decode -> process -> write, the items of an endpoint stay in order
+        if config.spill_directory:
+            # the responses which do not fit into the queues, replayable with --replay
+            self.spill = ResponseRecorder(recorder_directory(config.spill_directory, self.config.inverter.name))
+        stages = [
+            Stage('decode', self._decode_item, config.decode.workers, config.decode.queue, config.decode.overflow,
+                  spill=lambda item: self._spill_response(item[0], item[1], item[2]), key=self._item_key),
+            Stage('process', self._process_item, config.process.workers, config.process.queue,
+                  config.process.overflow, spill=lambda item: self._spill_response(item[0], item[1], item[3]),
+                  key=self._item_key),
+            Stage('write', self._write_item, config.write.workers, config.write.queue, config.write.overflow,
+                  spill=self._spill_points, key=self._item_key),
+        ]
+        return Pipeline(stages, self.metrics)
+
+    @staticmethod
+    def _item_key(item: Tuple) -> str:
+        return item[0]
+
+    def _decode_item(self, item: Tuple[str, str, bytes, float]) -> Optional[Tuple]:
+        metric, url, content, latency = item
+        try:
+            response = self._decode(metric, content)
+        except StatusCodeError as e:
+            self.poll_errors.labels(metric, 'status').inc()
+            self.logger.warning(f"{metric}: {e}")
+            self.scheduler.complete(metric, latency, True)
+            return None
+        except Exception:
+            self.scheduler.complete(metric, latency, True)
+            raise
+        self.scheduler.complete(metric, latency, False)
+        return metric, url, response, content
+
+    def _process_item(self, item: Tuple[str, str, Union[Dict, List[Dict]], Optional[bytes]]) -> Tuple[str, List]:
+        metric, _, response, _ = item
+        if isinstance(response, list):
+            # data points of the Modbus source
+            return metric, self._run_stages(metric, response, time.perf_counter())
+        return metric, self._process(metric, response)
+
+    def _write_item(self, item: Tuple[str, List]):
+        self._write(*item)
+
+    def _spill_response(self, metric: str, url: str, content: Optional[bytes]) -> bool:
+        # the raw response of a decode or process item, not the points of the Modbus source
+        return content is not None and self.spill.record(metric, url, 200, content)
+
+    def _spill_points(self, item: Tuple[str, List]) -> bool:
+        lines = [point if isinstance(point, bytes) else self.writer.encoder.encode(point) for point in item[1]]
+        return self.writer.spill([line for line in lines if line])
+
+    def _process(self, metric: str, response: Dict) -> List:
+        start = time.perf_counter()
+        if self.planner:
+            points = self.planner.process(metric, response)
+        elif self.columnar:
+            batch = self.processor.process_columnar(self._base_metric(metric), response)
+            points = batch.encode(self.processor.encoder) if self.processor.encoder else batch.points()
+            self.points_produced.labels(metric).inc(len(points))
+            now = time.perf_counter()
+            self.stage_seconds.labels('process', metric).observe(now - start)
+            if self.parquet:
+                self.parquet.write_batch(batch)
+                self.stage_seconds.labels('parquet', metric).observe(time.perf_counter() - now)
+            return points
+        elif not self.stages:
+            points = self.processor.process(self._base_metric(metric), response)
+            self.points_produced.labels(metric).inc(len(points))
+            self.stage_seconds.labels('process', metric).observe(time.perf_counter() - start)
+            return points
+        else:
+            points = self.processor.process_points(self._base_metric(metric), response)
+        self.points_produced.labels(metric).inc(len(points))
+        now = time.perf_counter()
+        self.stage_seconds.labels('process', metric).observe(now - start)
+        return self._run_stages(metric, points, now)
+
+    def _run_stages(self, metric: str, points: List[Dict], now: float) -> List[Dict]:
+        for name, stage in self.stages:
+            start = now
+            points = stage(points)
+            now = time.perf_counter()
+            self.stage_seconds.labels(name, metric).observe(now - start)
+        return points
+
+    def _collect_metrics(self):
+        if self.deadband:
+            for measurement, counter in list(self.deadband.counters.items()):
+                self.suppressed_fields.labels(measurement).set(counter.suppressed)
+        if self.aggregator:
+            self.late_samples.labels().set(self.aggregator.late)
 
     def close(self):
         self.logger.info("closing application")
+        if self.backfill:
+            self.backfill.stop()
+        for line in self.http.report():
+            self.logger.info(line)
+        self.devices.close()
+        self.http.close()
+        if self.modbus:
+            self.modbus.close()
+        if self.pipeline:
+            # the responses in flight
+            self.pipeline.close()
+        if self.spill:
+            self.spill.close()
+        if self.derived:
+            # the incomplete windows, through the stages after the derived metrics
+            points = self.derived.flush()
+            names = [name for name, _ in self.stages]
+            for _, stage in self.stages[names.index('derived') + 1:]:
+                points = stage(points)
+            self._write_data_points(points)
+        if self.aggregator:
+            # emit the incomplete windows
+            points = self.aggregator.flush()
+            if self.parquet:
+                self.parquet.write(points)
+            self._write_data_points(points)
+        self.writer.close()
+        if self.parquet:
+            self.parquet.close()
+        if self.recorder:
+            self.recorder.close()
+        self.metrics.close()
+        if self.live:
+            self.live.close()
 
     def _get_endpoints(self) -> Dict[str, str]:
         base_url = f"{self.config.inverter.url}/solar_api/v1"
 
         endpoints = {}
         for metric in self.config.inverter.metrics:
+            if self.modbus and metric in MODBUS_METRICS:
+                continue
             params = None
             if metric in ["CumulationInverterData", "CommonInverterData", "3PInverterData", "MinMaxInverterData"]:
                 route = 'GetInverterRealtimeData.cgi'
@@ -107,7 +607,13 @@ class InfluxDBBridge:
             else:
                 raise ValueError(f"Metric '{metric}' is not supported")
 
-            # build endpoint
+            # build endpoint, one per device if there are several inverters behind the url
+            device_ids = self.config.inverter.device_ids if params and 'DeviceId' in params else []
+            if len(device_ids) > 1:
+                for device_id in device_ids:
+                    endpoint = f"{base_url}/{route}?" + urllib.parse.urlencode({**params, 'DeviceId': device_id})
+                    endpoints[f"{metric}/{device_id}"] = endpoint
+                continue
             endpoint = f"{base_url}/{route}"
             if params:
                 endpoint += "?" + urllib.parse.urlencode(params)
@@ -115,21 +621,41 @@ class InfluxDBBridge:
 
         return endpoints
 
-    def _write_data_points(self, collected_data):
-        self.logger.info(f"writing data: {[d['measurement'] for d in collected_data]}")
+    def _get_modbus_endpoints(self) -> Dict[str, str]:
+        base_url = f"modbus://{self.modbus.client.host}:{self.modbus.client.port}"
 
-        write_api = self.influx_client.write_api(write_options=SYNCHRONOUS)
-        write_api.write(bucket=self.config.record.influxdb_bucket, record=collected_data)
+        endpoints = {}
+        for metric in self.config.inverter.metrics:
+            if metric not in MODBUS_METRICS:
+                continue
+            if metric == "MeterRealtimeData":
+                endpoints[metric] = f"{base_url}/meters"
+                continue
+            device_ids = list(self.modbus.units)
+            if len(device_ids) > 1:
+                for device_id in device_ids:
+                    endpoints[f"{metric}/{device_id}"] = f"{base_url}/inverter/{device_id}"
+            else:
+                endpoints[metric] = f"{base_url}/inverter/{device_ids[0]}"
+        return endpoints
 
-    def _sun_is_shining(self):
-        if self.config.record.ignore_sunset:
-            return
+    def _write_data_points(self, collected_data):
+        self.logger.info(f"writing data: {len(collected_data)} points")
+        self.writer.write(collected_data)
 
-        sun = self.config.location.sun()
-        tz = pytz.timezone(self.config.location.timezone)
-        if sun['sunset'] < datetime.datetime.now(tz=tz) < sun['sunrise']:
-            raise SunIsDown
-        return
+    @staticmethod
+    def _base_metric(metric: str) -> str:
+        # the endpoints of several devices are named '<metric>/<device id>'
+        return metric.partition('/')[0]
+
+    def _report_power(self, metric: str, response: Dict):
+        # the AC power is missing while the inverter is switched off
+        data = response.get('Body', {}).get('Data', {})
+        metric = self._base_metric(metric)
+        if metric == "CommonInverterData":
+            self.schedule.report_power((data.get('PAC') or {}).get('Value'))
+        elif metric == "PowerFlowRealtimeData":
+            self.schedule.report_power((data.get('Site') or {}).get('P_PV'))
 
 
 def main():
@@ -141,6 +667,14 @@ def main():
                                      description='Collect Fronius inverter and SMA and store it in InfluxDB')
     parser.add_argument('--config', type=str, default='./config/sample_config.yaml', help='Path to YAML config file')
     parser.add_argument('--influxdb-file', type=str, default='./config/influxdb_config.ini', help='InfluxDB Client configuration via file')
+    parser.add_argument('--backfill', type=str, nargs=2, metavar=('FROM', 'TO'),
+                        help='Backfill the archive data of the given period (ISO 8601, local time of the location) and exit')
+    parser.add_argument('--record', type=str, metavar='DIRECTORY',
+                        help='Record the raw Solar API responses to compressed segments in the given directory')
+    parser.add_argument('--replay', type=str, metavar='PATH',
+                        help='Replay the recorded responses of a segment directory or file through the processing and exit')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed: 1 for real time, e.g. 60 for 60 times faster, 0 for as fast as possible')
     args = parser.parse_args()
 
     # initialize InfluxDB client
@@ -148,7 +682,41 @@ def main():
 
     # load config file and start application
     config = load_config(args.config)
+    if args.record and not config.recorder:
+        config.recorder = Config.Recorder(directory=args.record, segment_mb=16.0, segment_interval=3600.0,
+                                          max_mb=1024.0)
+    if args.replay:
+        # the replayed responses are neither recorded again nor requested from the inverter
+        config.recorder = None
+        config.backfill = None
+    if config.fleet and not (args.backfill or args.replay):
+        # imported here, the fleet module builds on this module
+        from fleet import FleetSupervisor
+        FleetSupervisor(config, client, args.influxdb_file).run()
+        return
+
+    if args.backfill and not config.backfill:
+        config.backfill = Config.Backfill(checkpoint_file='./backfill.json', chunk_days=1.0, channels=None,
+                                          gap_detection=False, lookback_days=7.0, min_gap=900.0)
     influxdb_bridge = InfluxDBBridge(config, client)
+
+    if args.backfill:
+        start, end = [datetime.datetime.fromisoformat(value) for value in args.backfill]
+        tz = config.location.tzinfo
+        start, end = [value if value.tzinfo else value.replace(tzinfo=tz) for value in (start, end)]
+        try:
+            influxdb_bridge.run_backfill(start, end)
+        finally:
+            influxdb_bridge.close()
+        return
+
+    if args.replay:
+        try:
+            influxdb_bridge.run_replay(args.replay, args.speed)
+        finally:
+            influxdb_bridge.close()
+        return
+
     try:
         influxdb_bridge.run()
     except KeyboardInterrupt:
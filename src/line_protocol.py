@@ -0,0 +1,151 @@
+import datetime
+import math
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, Tuple
+
+from dateutil import parser
+
+# escaping rules of the influxdb_client line protocol serializer
+_ESCAPE_MEASUREMENT = str.maketrans({
+    ',': r'\,',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+})
+
+_ESCAPE_KEY = str.maketrans({
+    ',': r'\,',
+    '=': r'\=',
+    ' ': r'\ ',
+    '\n': r'\n',
+    '\t': r'\t',
+    '\r': r'\r',
+})
+
+_ESCAPE_STRING = str.maketrans({
+    '"': r'\"',
+    '\\': r'\\',
+})
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def to_nanoseconds(timestamp) -> int:
+    if isinstance(timestamp, int):
+        return timestamp
+
+    if isinstance(timestamp, str):
+        try:
+            timestamp = datetime.datetime.fromisoformat(timestamp)
+        except ValueError:
+            timestamp = parser.parse(timestamp)
+
+    # naive timestamps are UTC
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 9 + delta.microseconds * 10 ** 3
+
+
+def escape_key(key) -> str:
+    return str(key).translate(_ESCAPE_KEY)
+
+
+def escape_string(value: str) -> str:
+    return value.translate(_ESCAPE_STRING)
+
+
+def _escape_tag_value(value) -> str:
+    ret = str(value).translate(_ESCAPE_KEY)
+    if ret.endswith('\\'):
+        ret += ' '
+    return ret
+
+
+def encode_fields(fields: Dict) -> str:
+    items = []
+    for field, value in sorted(fields.items()):
+        if value is None:
+            continue
+
+        key = str(field).translate(_ESCAPE_KEY)
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                continue
+            s = str(value)
+            if s.endswith('.0'):
+                s = s[:-2]
+            items.append(f'{key}={s}')
+        elif isinstance(value, bool):
+            items.append(f'{key}={str(value).lower()}')
+        elif isinstance(value, int):
+            items.append(f'{key}={value}i')
+        elif isinstance(value, str):
+            items.append(f'{key}="{value.translate(_ESCAPE_STRING)}"')
+        else:
+            raise ValueError(f'Type: "{type(value)}" of field: "{field}" is not supported.')
+    return ','.join(items)
+
+
+# Encodes data point dicts to line protocol with nanosecond timestamps, byte-for-byte identical to
+# influxdb_client's Point.from_dict(...).to_line_protocol() for the types produced by DataProcessor.
+class LineProtocolEncoder:
+    def __init__(self, default_tags: Optional[Dict[str, str]] = None):
+        self.default_tags = dict(default_tags or {})
+
+        # escaped "measurement,tag=value " prefixes by (measurement, tag items)
+        self._prefixes: Dict[Tuple, str] = {}
+        # prefixes of immutable tag sets (e.g. of the device cache) by (measurement, id), with the tags to keep the id
+        self._shared_prefixes: Dict[Tuple[str, int], Tuple[Mapping, str]] = {}
+        self._last_time: Tuple = (None, 0)
+
+    def prefix(self, measurement: str, tags: Optional[Mapping]) -> str:
+        if type(tags) is MappingProxyType:
+            shared = self._shared_prefixes.get((measurement, id(tags)))
+            if shared is not None and shared[0] is tags:
+                return shared[1]
+            prefix = self._prefix(measurement, tags)
+            self._shared_prefixes[(measurement, id(tags))] = (tags, prefix)
+            return prefix
+        return self._prefix(measurement, tags)
+
+    def _prefix(self, measurement: str, tags: Optional[Mapping]) -> str:
+        key = (measurement, tuple(tags.items())) if tags else (measurement, ())
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            merged = dict(tags or {})
+            merged.update(self.default_tags)
+            tag_items = []
+            for tag_key, tag_value in sorted(merged.items()):
+                if tag_value is None:
+                    continue
+                tag = str(tag_key).translate(_ESCAPE_KEY)
+                value = _escape_tag_value(tag_value)
+                if tag != '' and value != '':
+                    tag_items.append(f'{tag}={value}')
+
+            prefix = str(measurement).translate(_ESCAPE_MEASUREMENT)
+            prefix += f"{',' if tag_items else ''}{','.join(tag_items)} "
+            self._prefixes[key] = prefix
+        return prefix
+
+    def timestamp(self, time) -> int:
+        # points of one response share their timestamp
+        last_time, last_ns = self._last_time
+        if time is last_time or time == last_time:
+            return last_ns
+        ns = to_nanoseconds(time)
+        self._last_time = (time, ns)
+        return ns
+
+    def encode(self, point: Dict) -> bytes:
+        fields = encode_fields(point['fields'])
+        if not fields:
+            return b''
+
+        line = self.prefix(point['measurement'], point.get('tags')) + fields
+        time = point.get('time')
+        if time is not None:
+            line += f" {self.timestamp(time)}"
+        return line.encode('utf-8')
@@ -0,0 +1,235 @@
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Tuple
+
+# maximum number of updates buffered per event stream client, further updates are dropped for the client
+CLIENT_QUEUE_SIZE = 256
+# interval in seconds of the keep-alive comments of an event stream
+KEEPALIVE_INTERVAL = 15.0
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+class _Series:
+    __slots__ = ('measurement', 'tags', 'latest', 'history')
+
+    def __init__(self, measurement: str, tags: Dict, history: int):
+        self.measurement = measurement
+        self.tags = tags
+        # (time, received, fields) of the last sample, replaced as a whole so readers never see a partial update
+        self.latest: Optional[Tuple] = None
+        self.history: Deque[Tuple] = deque(maxlen=history)
+
+    def to_dict(self, history: bool = False) -> Dict:
+        point_time, received, fields = self.latest
+        series = {
+            'measurement': self.measurement,
+            'tags': dict(self.tags),
+            'time': point_time,
+            'age': round(time.time() - received, 3),
+            'fields': fields,
+        }
+        if history:
+            # copying a deque holds the GIL, the polling thread cannot append in between
+            series['history'] = [{'time': t, 'fields': f} for t, _, f in tuple(self.history)]
+        return series
+
+
+# Latest values and a short history per series (measurement and tags) of the processed data points, served as JSON
+# on a local HTTP endpoint, e.g. for dashboards which would otherwise query InfluxDB every few seconds. Updates
+# replace immutable snapshots and never wait for readers, event stream clients get the updates through bounded
+# queues. The memory is limited by the number of series and the history length, not by the uptime.
+class LiveCache:
+    def __init__(self, history: int = 120, max_series: int = 1000, measurements: Optional[List[str]] = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.history = history
+        self.max_series = max_series
+        self.measurements = set(measurements) if measurements else None
+
+        # series in the order of their last update, updated by several process workers of a pipeline
+        self._lock = threading.Lock()
+        self._series: 'OrderedDict[Tuple, _Series]' = OrderedDict()
+        self._clients: List[queue.Queue] = []
+        self._clients_lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+        self.updates = 0
+        self.evicted = 0
+        self.dropped_events = 0
+
+    def update(self, points: List[Dict]) -> List[Dict]:
+        # processing stage which passes the data points on unchanged
+        received = time.time()
+        events = []
+        with self._lock:
+            for point in points:
+                measurement = point['measurement']
+                if self.measurements is not None and measurement not in self.measurements:
+                    continue
+                tags = point.get('tags') or {}
+                key = (measurement, tuple(tags.items()))
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = _Series(measurement, tags, self.history)
+                    while len(self._series) > self.max_series:
+                        self._series.popitem(last=False)
+                        self.evicted += 1
+                else:
+                    self._series.move_to_end(key)
+
+                fields = dict(point['fields'])
+                series.latest = (point.get('time'), received, fields)
+                series.history.append(series.latest)
+                self.updates += 1
+                if self._clients:
+                    events.append(series)
+
+        if events:
+            self._publish([series.to_dict() for series in events])
+        return points
+
+    def _publish(self, series: List[Dict]):
+        event = json.dumps(series, default=_json_default)
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                self.dropped_events += 1
+
+    def select(self, measurement: Optional[str] = None, fields: Optional[List[str]] = None,
+               tags: Optional[Dict[str, str]] = None, history: bool = False) -> List[Dict]:
+        result = []
+        with self._lock:
+            selected = list(self._series.values())
+        for series in selected:
+            if measurement is not None and series.measurement != measurement:
+                continue
+            if tags and any(str(series.tags.get(key)) != value for key, value in tags.items()):
+                continue
+            if series.latest is None:
+                continue
+            item = series.to_dict(history)
+            if fields:
+                item['fields'] = {key: value for key, value in item['fields'].items() if key in fields}
+                if history:
+                    for sample in item['history']:
+                        sample['fields'] = {key: value for key, value in sample['fields'].items() if key in fields}
+            result.append(item)
+        return result
+
+    def subscribe(self) -> queue.Queue:
+        client = queue.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        with self._clients_lock:
+            self._clients.append(client)
+        return client
+
+    def unsubscribe(self, client: queue.Queue):
+        with self._clients_lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def serve(self, host: str, port: int):
+        cache = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                # e.g. /latest?measurement=PowerFlowDataSite&field=P_PV&field=P_Grid&tag.DeviceId=1
+                measurement = query.get('measurement', [None])[0]
+                fields = query.get('field')
+                tags = {key[4:]: values[0] for key, values in query.items() if key.startswith('tag.')}
+
+                if url.path == '/latest':
+                    self._send_json(cache.select(measurement, fields, tags))
+                elif url.path == '/history':
+                    self._send_json(cache.select(measurement, fields, tags, history=True))
+                elif url.path == '/events':
+                    self._stream(measurement, fields, tags)
+                else:
+                    self.send_error(404)
+
+            def _send_json(self, data):
+                body = json.dumps(data, default=_json_default).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-store')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, measurement: Optional[str], fields: Optional[List[str]], tags: Dict[str, str]):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-store')
+                self.end_headers()
+
+                # the current values first, then every update of a matching series
+                client = cache.subscribe()
+                try:
+                    self._send_event(cache.select(measurement, fields, tags))
+                    while True:
+                        try:
+                            event = client.get(timeout=KEEPALIVE_INTERVAL)
+                        except queue.Empty:
+                            self.wfile.write(b': keep-alive\n\n')
+                            self.wfile.flush()
+                            continue
+                        if event is None:
+                            return
+                        series = [item for item in json.loads(event)
+                                  if (measurement is None or item['measurement'] == measurement) and
+                                  all(str(item['tags'].get(key)) == value for key, value in tags.items())]
+                        if fields:
+                            for item in series:
+                                item['fields'] = {key: value for key, value in item['fields'].items()
+                                                  if key in fields}
+                        if series:
+                            self._send_event(series)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    cache.unsubscribe(client)
+
+            def _send_event(self, series: List[Dict]):
+                self.wfile.write(b'data: ' + json.dumps(series, default=_json_default).encode('utf-8') + b'\n\n')
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=self.__class__.__name__, daemon=True).start()
+        self.logger.info(f"serving live values on http://{host}:{self._server.server_port}/latest")
+
+    def report(self) -> List[str]:
+        return [f"live cache: {len(self._series)} series (max {self.max_series}), history={self.history} samples, "
+                f"updates={self.updates}, evicted={self.evicted}, event clients={len(self._clients)}, "
+                f"dropped events={self.dropped_events}"]
+
+    def close(self):
+        # end the event streams
+        with self._clients_lock:
+            for client in self._clients:
+                try:
+                    client.put_nowait(None)
+                except queue.Full:
+                    pass
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
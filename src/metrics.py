@@ -0,0 +1,227 @@
+import bisect
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# latency buckets in seconds, from a local decode (~10 us) to a slow inverter request
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float):
+        # for totals which are counted elsewhere and collected before every scrape
+        self.value = value
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Family:
+    def __init__(self, name: str, kind: str, help: str, labelnames: Sequence[str],
+                 factory: Callable[[], object]):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f'# TYPE {self.name} {self.kind}', f'# HELP {self.name} {self.help}']
+        for values, child in list(self.children.items()):
+            if self.kind == 'counter':
+                lines.append(f'{self.name}_total{_format_labels(self.labelnames, values)} {_format_value(child.value)}')
+            elif self.kind == 'gauge':
+                lines.append(f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}')
+            else:
+                counts, total = child.snapshot()
+                cumulative = 0
+                for bound, count in zip(list(child.buckets) + [math.inf], counts):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, values, f'le="{_format_value(float(bound))}"')
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, values)} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, values)} {_format_value(total)}')
+        return lines
+
+
+# Registry of the application metrics in the OpenMetrics text format. Counters and histograms are updated on the
+# hot path, totals and queue depths which are tracked elsewhere are pulled by collectors just before every scrape.
+class Metrics:
+    enabled = True
+
+    def __init__(self, namespace: str = 'fronius'):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.namespace = namespace
+        self.families: Dict[str, Family] = {}
+        self.collectors: List[Callable[[], None]] = []
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def _family(self, name: str, kind: str, help: str, labelnames: Sequence[str],
+                factory: Callable[[], object]) -> Family:
+        name = f'{self.namespace}_{name}'
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, kind, help, labelnames, factory)
+        return family
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Family:
+        return self._family(name, 'counter', help, labelnames, Counter)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Family:
+        return self._family(name, 'gauge', help, labelnames, Gauge)
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Family:
+        return self._family(name, 'histogram', help, labelnames, lambda: Histogram(buckets))
+
+    def render(self) -> bytes:
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                self.logger.warning(f"collecting metrics failed: {e}")
+        lines = []
+        for family in self.families.values():
+            lines.extend(family.render())
+        lines.append('# EOF\n')
+        return '\n'.join(lines).encode('utf-8')
+
+    def serve(self, host: str, port: int):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=self.__class__.__name__, daemon=True).start()
+        self.logger.info(f"serving metrics on http://{host}:{self._server.server_port}/metrics")
+
+    def close(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class _NullChild:
+    def inc(self, amount: float = 1.0):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+
+class _NullFamily:
+    _child = _NullChild()
+
+    def labels(self, *values: str) -> _NullChild:
+        return self._child
+
+
+class _NullCollectors(list):
+    # collectors are never called, so they are not kept either (and neither are the components they belong to)
+    def append(self, collect: Callable[[], None]):
+        pass
+
+
+# Drop-in replacement while metrics are disabled, every update is a no-op.
+class NullMetrics:
+    enabled = False
+
+    def __init__(self):
+        self.collectors: List[Callable[[], None]] = _NullCollectors()
+        self._family = _NullFamily()
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> _NullFamily:
+        return self._family
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> _NullFamily:
+        return self._family
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> _NullFamily:
+        return self._family
+
+    def close(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
@@ -0,0 +1,498 @@
+import datetime
+import logging
+import socket
+import struct
+import sys
+import threading
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from device_cache import DeviceCache
+
+# SunSpec register map: the 'SunS' marker at one of the base addresses, followed by the models as
+# (model id, length, registers ...) up to the end model 0xFFFF
+SUNSPEC_BASES = [40000, 0, 50000]
+SUNSPEC_MARKER = b'SunS'
+END_MODEL = 0xFFFF
+# maximum number of registers of a single read
+MAX_REGISTERS = 125
+
+READ_HOLDING_REGISTERS = 3
+
+# struct format and value of a not implemented point per SunSpec type
+_TYPES = {
+    'uint16': ('H', 0xFFFF),
+    'int16': ('h', -0x8000),
+    'sunssf': ('h', -0x8000),
+    'enum16': ('H', 0xFFFF),
+    'acc32': ('I', 0),
+    'uint32': ('I', 0xFFFFFFFF),
+    'bitfield32': ('I', 0xFFFFFFFF),
+    'float32': ('f', None),
+}
+
+
+class ModbusError(Exception):
+    pass
+
+
+# Register layout of a SunSpec model, decoded with a single struct unpack of the raw registers.
+# Points are (name, type), strings are 'string<registers>', 'pad' skips a register.
+class ModelLayout:
+    def __init__(self, points: List[Tuple[str, str]], scaled: bool = True):
+        self.scaled = scaled
+        self.names: List[str] = []
+        self.kinds: List[str] = []
+        self.missing: List[Optional[object]] = []
+        fmt = '>'
+        for name, kind in points:
+            if kind == 'pad':
+                fmt += '2x'
+                continue
+            if kind.startswith('string'):
+                fmt += f"{int(kind[6:]) * 2}s"
+                missing = None
+            else:
+                code, missing = _TYPES[kind]
+                fmt += code
+            self.names.append(name)
+            self.kinds.append(kind)
+            self.missing.append(missing)
+        self.struct = struct.Struct(fmt)
+        self.length = self.struct.size // 2
+
+    def decode(self, raw: bytes) -> Dict[str, object]:
+        # the implemented points, strings without the padding
+        values = {}
+        for name, missing, value in zip(self.names, self.missing, self.struct.unpack_from(raw)):
+            if type(value) is bytes:
+                value = value.rstrip(b'\x00').decode('utf-8', 'replace').strip()
+            elif value == missing or value != value:
+                continue
+            values[name] = value
+        return values
+
+
+COMMON_MODEL = ModelLayout([
+    ('Mn', 'string16'), ('Md', 'string16'), ('Opt', 'string8'), ('Vr', 'string8'), ('SN', 'string16'),
+    ('DA', 'uint16'),
+])
+
+# models 101 - 103: single, split and three phase inverter with integer values and scale factors
+INVERTER_MODEL = ModelLayout([
+    ('A', 'uint16'), ('AphA', 'uint16'), ('AphB', 'uint16'), ('AphC', 'uint16'), ('A_SF', 'sunssf'),
+    ('PPVphAB', 'uint16'), ('PPVphBC', 'uint16'), ('PPVphCA', 'uint16'),
+    ('PhVphA', 'uint16'), ('PhVphB', 'uint16'), ('PhVphC', 'uint16'), ('V_SF', 'sunssf'),
+    ('W', 'int16'), ('W_SF', 'sunssf'), ('Hz', 'uint16'), ('Hz_SF', 'sunssf'),
+    ('VA', 'int16'), ('VA_SF', 'sunssf'), ('VAr', 'int16'), ('VAr_SF', 'sunssf'), ('PF', 'int16'), ('PF_SF', 'sunssf'),
+    ('WH', 'acc32'), ('WH_SF', 'sunssf'),
+    ('DCA', 'uint16'), ('DCA_SF', 'sunssf'), ('DCV', 'uint16'), ('DCV_SF', 'sunssf'), ('DCW', 'int16'), ('DCW_SF', 'sunssf'),
+    ('TmpCab', 'int16'), ('TmpSnk', 'int16'), ('TmpTrns', 'int16'), ('TmpOt', 'int16'), ('Tmp_SF', 'sunssf'),
+    ('St', 'enum16'), ('StVnd', 'enum16'), ('Evt1', 'bitfield32'), ('Evt2', 'bitfield32'),
+    ('EvtVnd1', 'bitfield32'), ('EvtVnd2', 'bitfield32'), ('EvtVnd3', 'bitfield32'), ('EvtVnd4', 'bitfield32'),
+])
+
+# models 111 - 113: the same as float values (default of Fronius inverters)
+INVERTER_FLOAT_MODEL = ModelLayout([
+    ('A', 'float32'), ('AphA', 'float32'), ('AphB', 'float32'), ('AphC', 'float32'),
+    ('PPVphAB', 'float32'), ('PPVphBC', 'float32'), ('PPVphCA', 'float32'),
+    ('PhVphA', 'float32'), ('PhVphB', 'float32'), ('PhVphC', 'float32'),
+    ('W', 'float32'), ('Hz', 'float32'), ('VA', 'float32'), ('VAr', 'float32'), ('PF', 'float32'), ('WH', 'float32'),
+    ('DCA', 'float32'), ('DCV', 'float32'), ('DCW', 'float32'),
+    ('TmpCab', 'float32'), ('TmpSnk', 'float32'), ('TmpTrns', 'float32'), ('TmpOt', 'float32'),
+    ('St', 'enum16'), ('StVnd', 'enum16'), ('Evt1', 'bitfield32'), ('Evt2', 'bitfield32'),
+    ('EvtVnd1', 'bitfield32'), ('EvtVnd2', 'bitfield32'), ('EvtVnd3', 'bitfield32'), ('EvtVnd4', 'bitfield32'),
+], scaled=False)
+
+# model 160: multiple MPPT inverter extension, a header and 20 registers per tracker
+MPPT_MODEL = ModelLayout([
+    ('DCA_SF', 'sunssf'), ('DCV_SF', 'sunssf'), ('DCW_SF', 'sunssf'), ('DCWH_SF', 'sunssf'),
+    ('Evt', 'bitfield32'), ('N', 'uint16'), ('TmsPer', 'uint16'),
+])
+MPPT_MODULE = ModelLayout([
+    ('ID', 'uint16'), ('IDStr', 'string8'), ('DCA', 'uint16'), ('DCV', 'uint16'), ('DCW', 'uint16'),
+    ('DCWH', 'acc32'), ('Tms', 'uint32'), ('Tmp', 'int16'), ('DCSt', 'enum16'), ('DCEvt', 'bitfield32'),
+])
+
+
+def _meter_points(kind: str, scaled: bool) -> List[Tuple[str, str]]:
+    # the points of the meter models in register order, with the scale factors after each group
+    def group(names: List[str], sf: str, point_kind: str = kind) -> List[Tuple[str, str]]:
+        return [(name, point_kind) for name in names] + ([(sf, 'sunssf')] if scaled else [])
+
+    energy = 'acc32' if scaled else 'float32'
+    points = group(['A', 'AphA', 'AphB', 'AphC'], 'A_SF')
+    points += group(['PhV', 'PhVphA', 'PhVphB', 'PhVphC', 'PPV', 'PPVphAB', 'PPVphBC', 'PPVphCA'], 'V_SF')
+    points += group(['Hz'], 'Hz_SF')
+    for name in ['W', 'VA', 'VAR', 'PF']:
+        points += group([name, f'{name}phA', f'{name}phB', f'{name}phC'], f'{name}_SF')
+    for names, sf in [(['TotWhExp', 'TotWhImp'], 'TotWh_SF'), (['TotVAhExp', 'TotVAhImp'], 'TotVAh_SF'),
+                      (['TotVArhImpQ1', 'TotVArhImpQ2', 'TotVArhExpQ3', 'TotVArhExpQ4'], 'TotVArh_SF')]:
+        points += group([f'{name}{phase}' for name in names for phase in ['', 'PhA', 'PhB', 'PhC']], sf, energy)
+    return points + [('Evt', 'bitfield32')]
+
+
+# models 201 - 204: single, split and three phase meter with integer values and scale factors
+METER_MODEL = ModelLayout(_meter_points('int16', True))
+# models 211 - 214: the same as float values
+METER_FLOAT_MODEL = ModelLayout(_meter_points('float32', False), scaled=False)
+
+MODEL_LAYOUTS = {
+    1: COMMON_MODEL,
+    101: INVERTER_MODEL, 102: INVERTER_MODEL, 103: INVERTER_MODEL,
+    111: INVERTER_FLOAT_MODEL, 112: INVERTER_FLOAT_MODEL, 113: INVERTER_FLOAT_MODEL,
+    201: METER_MODEL, 202: METER_MODEL, 203: METER_MODEL, 204: METER_MODEL,
+    211: METER_FLOAT_MODEL, 212: METER_FLOAT_MODEL, 213: METER_FLOAT_MODEL, 214: METER_FLOAT_MODEL,
+}
+INVERTER_MODELS = [103, 113, 102, 112, 101, 111]
+METER_MODELS = [203, 213, 204, 214, 202, 212, 201, 211]
+
+# A point spec is (SunSpec point, field name, scale factor point, additional power of ten). The field names are the
+# ones of the DataProcessor measurements, fields without a SunSpec point (e.g. DAY_ENERGY) are not written.
+PointSpec = Tuple[str, str, str, int]
+
+COMMON_INVERTER_POINTS: List[PointSpec] = [
+    ('A', 'IAC', 'A_SF', 0),
+    ('PhVphA', 'UAC', 'V_SF', 0),
+    ('W', 'PAC', 'W_SF', 0),
+    ('Hz', 'FAC', 'Hz_SF', 0),
+    ('VA', 'SAC', 'VA_SF', 0),
+    ('DCA', 'IDC_MPP1', 'DCA_SF', 0),
+    ('DCV', 'UDC_MPP1', 'DCV_SF', 0),
+    ('WH', 'TOTAL_ENERGY', 'WH_SF', 0),
+]
+
+THREE_PHASE_INVERTER_POINTS: List[PointSpec] = [
+    ('AphA', 'IAC_L1', 'A_SF', 0),
+    ('AphB', 'IAC_L2', 'A_SF', 0),
+    ('AphC', 'IAC_L3', 'A_SF', 0),
+    ('PhVphA', 'UAC_L1', 'V_SF', 0),
+    ('PhVphB', 'UAC_L2', 'V_SF', 0),
+    ('PhVphC', 'UAC_L3', 'V_SF', 0),
+]
+
+METER_POINTS: List[PointSpec] = [
+    ('AphA', 'IAC_L1', 'A_SF', 0),
+    ('AphB', 'IAC_L2', 'A_SF', 0),
+    ('AphC', 'IAC_L3', 'A_SF', 0),
+    ('A', 'IAC_Sum', 'A_SF', 0),
+    ('TotWhImp', 'E_WAC_Consumed', 'TotWh_SF', 0),
+    ('TotWhExp', 'E_WAC_Produced', 'TotWh_SF', 0),
+    ('Hz', 'Freq_Avg', 'Hz_SF', 0),
+    ('VAphA', 'S_L1', 'VA_SF', 0),
+    ('VAphB', 'S_L2', 'VA_SF', 0),
+    ('VAphC', 'S_L3', 'VA_SF', 0),
+    ('VA', 'S_Sum', 'VA_SF', 0),
+    # SunSpec reports the power factor in percent
+    ('PFphA', 'CosPhi_L1', 'PF_SF', -2),
+    ('PFphB', 'CosPhi_L2', 'PF_SF', -2),
+    ('PFphC', 'CosPhi_L3', 'PF_SF', -2),
+    ('PF', 'CosPhi_Sum', 'PF_SF', -2),
+    ('VARphA', 'Q_L1', 'VAR_SF', 0),
+    ('VARphB', 'Q_L2', 'VAR_SF', 0),
+    ('VARphC', 'Q_L3', 'VAR_SF', 0),
+    ('VAR', 'Q_Sum', 'VAR_SF', 0),
+    ('WphA', 'P_L1', 'W_SF', 0),
+    ('WphB', 'P_L2', 'W_SF', 0),
+    ('WphC', 'P_L3', 'W_SF', 0),
+    ('W', 'P_Sum', 'W_SF', 0),
+    ('PPVphAB', 'UAC_L1-L2', 'V_SF', 0),
+    ('PPVphBC', 'UAC_L2-L3', 'V_SF', 0),
+    ('PPVphCA', 'UAC_L3-L1', 'V_SF', 0),
+    ('PhVphA', 'UAC_L1', 'V_SF', 0),
+    ('PhVphB', 'UAC_L2', 'V_SF', 0),
+    ('PhVphC', 'UAC_L3', 'V_SF', 0),
+]
+
+# metrics which are read from the SunSpec models, other metrics of a Modbus inverter are requested from the Solar API
+MODBUS_METRICS = ["CommonInverterData", "3PInverterData", "MeterRealtimeData"]
+
+
+def _scale(value, sf: int) -> float:
+    # divide by the power of ten, e.g. 2456 with -1 is 245.6 instead of 245.60000000000002
+    if sf < 0:
+        return value / 10 ** -sf
+    return float(value * 10 ** sf)
+
+
+def _float32(value: float) -> float:
+    # the shortest representation of a float32 value, e.g. 245.6 instead of 245.60000610351562
+    return float(f'{value:.7g}')
+
+
+def extract_fields(layout: ModelLayout, values: Dict[str, object], points: List[PointSpec]) -> Dict[str, float]:
+    fields = {}
+    for point, name, sf, shift in points:
+        value = values.get(point)
+        if value is None:
+            continue
+        if layout.scaled:
+            scale = values.get(sf)
+            if scale is None:
+                continue
+            fields[name] = _scale(value, scale + shift)
+        else:
+            fields[name] = _scale(_float32(value), shift)
+    return fields
+
+
+# Modbus TCP client for reading holding registers, one connection which is reopened after an error. Reads are
+# serialized, a response with an unexpected transaction id (e.g. of a timed out request) is skipped.
+class ModbusClient:
+    def __init__(self, host: str, port: int = 502, timeout: float = 3.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+        self._socket: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+        self._transaction = 0
+
+        self.requests = 0
+        self.reconnects = 0
+
+    def read_registers(self, unit: int, address: int, count: int) -> bytes:
+        # the raw registers, big-endian as on the wire
+        with self._lock:
+            raw = b''
+            while count > 0:
+                chunk = min(count, MAX_REGISTERS)
+                raw += self._read(unit, address, chunk)
+                address += chunk
+                count -= chunk
+            return raw
+
+    def _read(self, unit: int, address: int, count: int) -> bytes:
+        try:
+            if self._socket is None:
+                self._connect()
+            return self._request(unit, address, count)
+        except socket.timeout as e:
+            self._disconnect()
+            raise ConnectionError(f"Modbus read of unit {unit} from {self.host}:{self.port} timed out: {e}")
+        except OSError:
+            # a kept connection may have been closed by the inverter, retry once on a new one
+            self._disconnect()
+        try:
+            self._connect()
+            return self._request(unit, address, count)
+        except OSError as e:
+            self._disconnect()
+            raise ConnectionError(f"Modbus read of unit {unit} from {self.host}:{self.port} failed: {e}")
+
+    def _connect(self):
+        self._socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reconnects += 1
+
+    def _disconnect(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
+    def _request(self, unit: int, address: int, count: int) -> bytes:
+        self._transaction = (self._transaction + 1) & 0xFFFF
+        self._socket.sendall(struct.pack('>HHHBBHH', self._transaction, 0, 6, unit, READ_HOLDING_REGISTERS,
+                                         address, count))
+        self.requests += 1
+        while True:
+            transaction, protocol, length, _ = struct.unpack('>HHHB', self._receive(7))
+            body = self._receive(length - 1)
+            if transaction != self._transaction or protocol != 0:
+                continue
+            if body[0] & 0x80:
+                raise ModbusError(f"exception {body[1]} of unit {unit} reading {count} registers at {address}")
+            if body[1] != count * 2:
+                raise ModbusError(f"unit {unit} returned {body[1] // 2} registers instead of {count}")
+            return body[2:]
+
+    def _receive(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('connection closed')
+            data += chunk
+        return data
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+# The SunSpec models of one Modbus unit: their register addresses and the common model (manufacturer, model, serial).
+class SunSpecDevice:
+    def __init__(self, client: ModbusClient, unit: int):
+        self.unit = unit
+        self.models: Dict[int, Tuple[int, int]] = {}
+
+        for base in SUNSPEC_BASES:
+            try:
+                if client.read_registers(unit, base, 2) == SUNSPEC_MARKER:
+                    break
+            except ModbusError:
+                continue
+        else:
+            raise ModbusError(f"no SunSpec register map found on unit {unit}")
+
+        # model id: (address of the first point, length)
+        address = base + 2
+        while len(self.models) < 100:
+            model_id, length = struct.unpack('>HH', client.read_registers(unit, address, 2))
+            if model_id == END_MODEL:
+                break
+            self.models.setdefault(model_id, (address + 2, length))
+            address += 2 + length
+
+        if 1 not in self.models:
+            raise ModbusError(f"no SunSpec common model on unit {unit}")
+        address, _ = self.models[1]
+        self.common = COMMON_MODEL.decode(client.read_registers(unit, address, COMMON_MODEL.length))
+
+    def find(self, model_ids: List[int]) -> Optional[Tuple[int, int, int]]:
+        # (model id, address, length) of the first available model
+        for model_id in model_ids:
+            if model_id in self.models:
+                return (model_id,) + self.models[model_id]
+        return None
+
+
+# Reads CommonInverterData, 3PInverterData and MeterRealtimeData from the SunSpec Modbus TCP interface of Fronius
+# inverters and smart meters as the same measurements, fields and tags as the DataProcessor produces from the Solar
+# API, e.g. for sub-second intervals without the rate limit of the Solar API. Every sample is a single read of the
+# contiguous registers of a model, fields without a SunSpec point (e.g. DAY_ENERGY) are missing.
+class ModbusSource:
+    def __init__(self, host: str, port: int = 502, units: Optional[Dict[str, int]] = None,
+                 meters: Optional[Dict[str, int]] = None, timeout: float = 3.0,
+                 devices: Optional[DeviceCache] = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.client = ModbusClient(host, port, timeout)
+        # Modbus unit ids by device id of the inverters and meters
+        self.units = units or {'1': 1}
+        self.meters = meters or {}
+        self.devices = devices or DeviceCache()
+
+        self._devices: Dict[int, SunSpecDevice] = {}
+        self._meter_tags: Dict[str, Mapping[str, str]] = {}
+        self._lock = threading.Lock()
+        self.samples = 0
+
+    def _device(self, unit: int) -> SunSpecDevice:
+        device = self._devices.get(unit)
+        if device is None:
+            with self._lock:
+                device = self._devices.get(unit)
+                if device is None:
+                    device = self._devices[unit] = SunSpecDevice(self.client, unit)
+                    self.logger.info(f"unit {unit}: {device.common.get('Mn')} {device.common.get('Md')} "
+                                     f"serial={device.common.get('SN')}, models={sorted(device.models)}")
+        return device
+
+    def serials(self) -> Dict[str, str]:
+        # serial numbers of the inverters by device id, e.g. as fetch function of the device cache
+        return {device_id: str(self._device(unit).common['SN']) for device_id, unit in self.units.items()
+                if self._device(unit).common.get('SN')}
+
+    def read(self, metric: str, device_id: Optional[str] = None) -> List[Dict]:
+        try:
+            if metric == "MeterRealtimeData":
+                points = [self._read_meter(meter_id, unit) for meter_id, unit in self.meters.items()]
+            elif metric in ["CommonInverterData", "3PInverterData"]:
+                device_ids = [device_id] if device_id is not None else list(self.units)
+                points = [self._read_inverter(metric, device_id) for device_id in device_ids]
+            else:
+                raise ValueError(f"Metric '{metric}' is not supported by the Modbus source")
+        except (ModbusError, ConnectionError):
+            # discover the models again, e.g. after a firmware update
+            self._devices.clear()
+            raise
+        self.samples += len(points)
+        return [point for point in points if point is not None]
+
+    def _read_model(self, unit: int, model_ids: List[int]) -> Tuple[ModelLayout, Dict[str, object]]:
+        device = self._device(unit)
+        found = device.find(model_ids)
+        if found is None:
+            raise ModbusError(f"unit {unit} has none of the SunSpec models {model_ids}")
+        model_id, address, _ = found
+        layout = MODEL_LAYOUTS[model_id]
+        return layout, layout.decode(self.client.read_registers(unit, address, layout.length))
+
+    def _read_inverter(self, metric: str, device_id: str) -> Optional[Dict]:
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        unit = self.units[device_id]
+        layout, values = self._read_model(unit, INVERTER_MODELS)
+        if metric == "3PInverterData":
+            fields = extract_fields(layout, values, THREE_PHASE_INVERTER_POINTS)
+        else:
+            fields = extract_fields(layout, values, COMMON_INVERTER_POINTS)
+            fields.update(self._read_trackers(unit))
+        if not fields:
+            return None
+        return {
+            'measurement': metric,
+            'time': timestamp,
+            'fields': fields,
+            'tags': self.devices.tags(device_id),
+        }
+
+    def _read_trackers(self, unit: int) -> Dict[str, float]:
+        # the DC values per tracker of model 160, without the storage modules of a GEN24 (e.g. 'StCha 3')
+        found = self._device(unit).find([160])
+        if found is None:
+            return {}
+        _, address, length = found
+        raw = self.client.read_registers(unit, address, length)
+        header = MPPT_MODEL.decode(raw)
+        fields = {}
+        tracker = 0
+        for idx in range(header.get('N', 0)):
+            offset = (MPPT_MODEL.length + idx * MPPT_MODULE.length) * 2
+            if offset + MPPT_MODULE.length * 2 > len(raw):
+                break
+            module = MPPT_MODULE.decode(raw[offset:])
+            if module.get('IDStr', '').startswith('St'):
+                continue
+            tracker += 1
+            if tracker > 4:
+                break
+            for point, name in [('DCA', f'IDC_MPP{tracker}'), ('DCV', f'UDC_MPP{tracker}')]:
+                if point in module and f'{point}_SF' in header:
+                    fields[name] = _scale(module[point], header[f'{point}_SF'])
+        return fields
+
+    def _read_meter(self, meter_id: str, unit: int) -> Optional[Dict]:
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        layout, values = self._read_model(unit, METER_MODELS)
+        fields = extract_fields(layout, values, METER_POINTS)
+        if not fields:
+            return None
+        return {
+            'measurement': 'MeterRealtimeData',
+            'time': timestamp,
+            'fields': fields,
+            'tags': self._tags(meter_id, unit),
+        }
+
+    def _tags(self, meter_id: str, unit: int) -> Mapping[str, str]:
+        # the same tags as of the Solar API, shared by all samples of the meter
+        tags = self._meter_tags.get(meter_id)
+        if tags is None:
+            common = self._device(unit).common
+            tags = self._meter_tags[meter_id] = MappingProxyType({
+                'Model': sys.intern(str(common.get('Md', ''))),
+                'Serial': sys.intern(str(common.get('SN', ''))),
+                'DeviceId': sys.intern(meter_id),
+            })
+        return tags
+
+    def report(self) -> List[str]:
+        return [f"modbus {self.client.host}:{self.client.port}: {self.samples} samples, "
+                f"{self.client.requests} reads, {self.client.reconnects} connections"]
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,296 @@
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from columnar import ColumnarBatch, ColumnBuffer, MeasurementColumns
+from line_protocol import to_nanoseconds
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# directory name and length in seconds of a time partition
+PARTITIONS = {
+    'hour': ('hour=%Y-%m-%dT%H', 3600),
+    'day': ('date=%Y-%m-%d', 86400),
+}
+# schema metadata of a compacted file with the names of the files it replaces
+_COMPACTED_FROM = b'compacted_from'
+
+
+def _conform(schema: Optional['pyarrow.Schema'], table: 'pyarrow.Table') -> 'pyarrow.Table':
+    # the table with all columns of the schema in its order, null-filled where missing, followed by its own new
+    # columns, an integer column which became a float column is widened
+    fields = list(schema) if schema is not None else []
+    index = {field.name: idx for idx, field in enumerate(fields)}
+    for field in table.schema:
+        idx = index.get(field.name)
+        if idx is None:
+            index[field.name] = len(fields)
+            fields.append(field)
+        elif fields[idx].type != field.type:
+            fields[idx] = pyarrow.field(field.name, pyarrow.float64())
+    schema = pyarrow.schema(fields)
+    columns = [table.column(field.name).cast(field.type) if field.name in table.column_names
+               else pyarrow.nulls(len(table), field.type) for field in schema]
+    return pyarrow.Table.from_arrays(columns, schema=schema)
+
+
+# Rows of one measurement in one time partition, with one column per tag and field.
+class TableBuffer:
+    def __init__(self, measurement: str, partition: str, start: float):
+        self.partition = partition
+        self.since = start
+        self.columns = MeasurementColumns(measurement)
+
+    @property
+    def measurement(self) -> str:
+        return self.columns.measurement
+
+    @property
+    def rows(self) -> int:
+        return len(self.columns)
+
+    def clear(self, now: float):
+        # the columns are kept, so the schema stays stable over the files of a partition
+        columns = MeasurementColumns(self.measurement)
+        columns.columns = {key: ColumnBuffer(column.kind, nullable=column.valid is not None)
+                           for key, column in self.columns.columns.items()}
+        self.columns = columns
+        self.since = now
+
+
+# Writes the data points to compressed Parquet files per measurement and time partition for long-term analytics,
+# e.g. <directory>/CommonInverterData/date=2023-05-20/part-102709-1a2b3c4d.parquet. The points are handed over to a
+# background thread without blocking, which buffers them in typed column arrays and writes a row group when it is
+# full or too old. Columnar batches of the data processor are appended column-wise without a dict per point. Every
+# flush writes a complete file (as *.tmp, then renamed) with row groups of at most row_group_rows rows, so a killed
+# process only loses the buffered rows and never the rows already written to the partition. All files of a
+# measurement have every column seen so far (null-filled), and the files of a partition are merged into one when the
+# partition is closed or the sink is closed.
+class ParquetSink:
+    def __init__(self, directory: str, partition: str = 'day', compression: str = 'zstd',
+                 row_group_rows: int = 50000, flush_interval: float = 600.0, max_queue_points: int = 100000,
+                 default_tags: Optional[Dict[str, str]] = None):
+        if pyarrow is None:
+            raise ValueError("the Parquet sink requires pyarrow, install it with 'pip install -e .[parquet]'")
+        if partition not in PARTITIONS:
+            raise ValueError(f"invalid Parquet partition: {partition}")
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.directory = directory
+        self.partition_format, self.partition_seconds = PARTITIONS[partition]
+        self.compression = compression
+        self.row_group_rows = row_group_rows
+        self.flush_interval = flush_interval
+        self.max_queue_points = max_queue_points
+        self.default_tags = {key: str(value) for key, value in (default_tags or {}).items() if value is not None}
+
+        self._queue: queue.Queue = queue.Queue()
+        self._queued = 0
+        self._queued_lock = threading.Lock()
+        self._tables: Dict[Tuple[str, str], TableBuffer] = {}
+        # the columns of the files per measurement
+        self._schemas: Dict[str, 'pyarrow.Schema'] = {}
+        # the partition of the last point per measurement: (start ns, end ns, name)
+        self._partitions: Dict[str, Tuple[int, int, str]] = {}
+        self._closing = threading.Event()
+
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.row_groups = 0
+        self.files = 0
+        self.compacted = 0
+
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith('.parquet.tmp'):
+                    self.logger.warning(f"incomplete Parquet file of an earlier run: {os.path.join(root, name)}")
+                elif name.startswith('compacted-') and name.endswith('.parquet'):
+                    self._remove_compacted(root, name)
+
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def write(self, points: List[Dict]) -> List[Dict]:
+        # processing stage which passes the data points on unchanged, a full queue drops the points
+        with self._queued_lock:
+            if self._queued + len(points) > self.max_queue_points:
+                self.dropped += len(points)
+                return points
+            self._queued += len(points)
+        if points:
+            self._queue.put(points)
+        return points
+
+    def write_batch(self, batch: ColumnarBatch) -> ColumnarBatch:
+        # the same for a columnar batch, which must not be changed afterwards
+        rows = len(batch)
+        with self._queued_lock:
+            if self._queued + rows > self.max_queue_points:
+                self.dropped += rows
+                return batch
+            self._queued += rows
+        if rows:
+            self._queue.put(batch)
+        return batch
+
+    def _partition(self, measurement: str, ns: int) -> str:
+        cached = self._partitions.get(measurement)
+        if cached is not None and cached[0] <= ns < cached[1]:
+            return cached[2]
+        seconds = ns // 10 ** 9
+        start = seconds - seconds % self.partition_seconds
+        name = datetime.datetime.utcfromtimestamp(start).strftime(self.partition_format)
+        self._partitions[measurement] = (start * 10 ** 9, (start + self.partition_seconds) * 10 ** 9, name)
+        return name
+
+    def _append(self, points: List[Dict]):
+        now = time.monotonic()
+        last_time, last_ns = None, 0
+        for point in points:
+            point_time = point.get('time')
+            if point_time is not last_time:
+                last_time, last_ns = point_time, to_nanoseconds(point_time) if point_time is not None \
+                    else time.time_ns()
+            measurement = point['measurement']
+            key = (measurement, self._partition(measurement, last_ns))
+            self.rejected += self._table(key, now).columns.append(last_ns, point.get('tags'), point['fields'])
+
+    def _append_batch(self, batch: ColumnarBatch):
+        now = time.monotonic()
+        for measurement, columns in batch.measurements.items():
+            if not len(columns):
+                continue
+            partition = self._partition(measurement, columns.time[0])
+            if self._partition(measurement, columns.time[-1]) == partition:
+                self._table((measurement, partition), now).columns.extend(columns)
+            else:
+                # a batch across a partition boundary, row by row
+                for point in columns.points():
+                    key = (measurement, self._partition(measurement, point['time']))
+                    self.rejected += self._table(key, now).columns.append(point['time'], point.get('tags'),
+                                                                          point['fields'])
+
+    def _table(self, key: Tuple[str, str], now: float) -> TableBuffer:
+        table = self._tables.get(key)
+        if table is None:
+            table = self._tables[key] = TableBuffer(key[0], key[1], now)
+        return table
+
+    def _run(self):
+        while True:
+            try:
+                points = self._queue.get(timeout=1.0)
+                with self._queued_lock:
+                    self._queued -= len(points)
+                if isinstance(points, ColumnarBatch):
+                    self._append_batch(points)
+                else:
+                    self._append(points)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                self.logger.warning(f"buffering points for Parquet failed: {e}", exc_info=True)
+
+            closing = self._closing.is_set() and self._queue.empty()
+            now = time.monotonic()
+            for key, table in list(self._tables.items()):
+                if table.rows and (closing or table.rows >= self.row_group_rows or
+                                   now - table.since >= self.flush_interval):
+                    self._flush(table, now)
+            self._drop_tables()
+            if closing:
+                for key in self._tables:
+                    self._compact(key)
+                return
+
+    def _flush(self, table: TableBuffer, now: float):
+        try:
+            arrow_table = _conform(self._schemas.get(table.measurement), table.columns.to_arrow(self.default_tags))
+            self._schemas[table.measurement] = arrow_table.schema
+            self._write_file((table.measurement, table.partition), arrow_table)
+            self.written += table.rows
+            self.row_groups += -(-table.rows // self.row_group_rows)
+            self.files += 1
+        except Exception as e:
+            self.rejected += table.rows
+            self.logger.warning(f"writing {table.rows} rows of {table.measurement} to Parquet failed: {e}")
+        table.clear(now)
+
+    def _write_file(self, key: Tuple[str, str], arrow_table: 'pyarrow.Table', prefix: str = 'part'):
+        measurement, partition = key
+        directory = os.path.join(self.directory, measurement, partition)
+        os.makedirs(directory, exist_ok=True)
+        name = f"{prefix}-{datetime.datetime.utcnow().strftime('%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+        path = os.path.join(directory, name + '.tmp')
+        # the footer is written on close, the file is readable once it is renamed
+        with pyarrow.parquet.ParquetWriter(path, arrow_table.schema, compression=self.compression) as writer:
+            writer.write_table(arrow_table, row_group_size=self.row_group_rows)
+        os.replace(path, path[:-len('.tmp')])
+
+    def _drop_tables(self):
+        # the buffers of a measurement are not needed anymore when its points arrive for a later partition
+        for key, table in list(self._tables.items()):
+            measurement, partition = key
+            current = self._partitions.get(measurement)
+            if not table.rows and current is not None and current[2] != partition:
+                del self._tables[key]
+                self._compact(key)
+
+    def _compact(self, key: Tuple[str, str]):
+        # merges the files of a partition into one file, ordered by time
+        directory = os.path.join(self.directory, *key)
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith('.parquet'))
+        except FileNotFoundError:
+            return
+        if len(names) < 2:
+            return
+
+        try:
+            tables = [pyarrow.parquet.read_table(os.path.join(directory, name)) for name in names]
+            schema = None
+            for table in tables:
+                schema = _conform(schema, table).schema
+            merged = pyarrow.concat_tables([_conform(schema, table) for table in tables]).sort_by('time')
+            # the replaced files are listed, so they are removed on start if the process is killed before
+            merged = merged.replace_schema_metadata({_COMPACTED_FROM: json.dumps(names).encode()})
+            self._write_file(key, merged, prefix='compacted')
+        except Exception as e:
+            self.logger.warning(f"compacting {len(names)} Parquet files of {directory} failed: {e}")
+            return
+        for name in names:
+            os.remove(os.path.join(directory, name))
+        self.compacted += len(names)
+
+    def _remove_compacted(self, directory: str, name: str):
+        try:
+            metadata = pyarrow.parquet.read_schema(os.path.join(directory, name)).metadata or {}
+            sources = json.loads(metadata.get(_COMPACTED_FROM, b'[]'))
+        except Exception as e:
+            self.logger.warning(f"reading the metadata of {os.path.join(directory, name)} failed: {e}")
+            return
+        for source in sources:
+            path = os.path.join(directory, source)
+            if os.path.exists(path):
+                self.logger.warning(f"removing {path} of an interrupted compaction")
+                os.remove(path)
+
+    def report(self) -> List[str]:
+        return [f"parquet: rows={self.written} in {self.row_groups} row groups, files={self.files}, "
+                f"compacted={self.compacted}, queue={self._queued} points, dropped={self.dropped}, rejected={self.rejected}"]
+
+    def close(self, timeout: float = 30.0):
+        self._closing.set()
+        self._thread.join(timeout)
@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional
+
+from metrics import NULL_METRICS, Metrics
+
+# what a full queue does with a new item: wait for free space (back pressure to the previous stage), evict the
+# oldest item or hand the new item to a spill function (e.g. to disk)
+OVERFLOW_POLICIES = ['block', 'drop_oldest', 'spill']
+
+# items are None-free, None is returned by a get which timed out
+SpillFunction = Callable[[object], bool]
+
+
+class BoundedQueue:
+    def __init__(self, max_items: int, overflow: str = 'block', spill: Optional[SpillFunction] = None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"invalid overflow policy: {overflow}")
+        if overflow == 'spill' and spill is None:
+            raise ValueError("the spill overflow policy requires a spill function")
+        self.max_items = max_items
+        self.overflow = overflow
+        self.spill = spill
+
+        self._items: Deque = deque()
+        self._cond = threading.Condition()
+        self.closed = False
+
+        self.dropped = 0
+        self.spilled = 0
+        # time producers waited for free space in seconds
+        self.blocked = 0.0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item) -> bool:
+        # whether the item was queued
+        with self._cond:
+            if len(self._items) >= self.max_items:
+                if self.overflow == 'drop_oldest':
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.overflow == 'block':
+                    start = time.monotonic()
+                    while len(self._items) >= self.max_items and not self.closed:
+                        self._cond.wait(0.1)
+                    self.blocked += time.monotonic() - start
+                    if self.closed:
+                        self.dropped += 1
+                        return False
+            if len(self._items) < self.max_items:
+                self._items.append(item)
+                self._cond.notify_all()
+                return True
+
+        # outside of the lock, spilling may write to disk
+        spilled = self.spill(item)
+        with self._cond:
+            if spilled:
+                self.spilled += 1
+            else:
+                self.dropped += 1
+        return False
+
+    def get(self, timeout: float):
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+                if not self._items:
+                    return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+# Worker threads which take items from bounded queues, handle them and pass the results (if not None) on to the next
+# stage. With several workers every worker has its own queue, items with the same key (e.g. the endpoint) go to the
+# same worker and keep their order.
+class Stage:
+    def __init__(self, name: str, handle: Callable[[object], object], workers: int = 1, max_items: int = 1000,
+                 overflow: str = 'block', spill: Optional[SpillFunction] = None,
+                 key: Optional[Callable[[object], str]] = None):
+        if workers < 1 or max_items < 1:
+            raise ValueError(f"invalid {name} stage: workers={workers}, queue={max_items}")
+        self.logger = logging.getLogger(f"{self.__class__.__name__}.{name}")
+
+        self.name = name
+        self.handle = handle
+        self.key = key
+        self.queues = [BoundedQueue(max(1, max_items // workers), overflow, spill) for _ in range(workers)]
+        self.next: Optional['Stage'] = None
+
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+        self.processed = 0
+        self.failed = 0
+        # time spent handling items in seconds, over all workers
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.queues)
+
+    def put(self, item) -> bool:
+        if len(self.queues) == 1:
+            return self.queues[0].put(item)
+        if self.key is not None:
+            return self.queues[hash(self.key(item)) % len(self.queues)].put(item)
+        return min(self.queues, key=len).put(item)
+
+    def start(self):
+        for idx in range(len(self.queues)):
+            thread = threading.Thread(target=self._run, args=(idx,), name=f"{self.name}-{idx}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self, idx: int):
+        queue = self.queues[idx]
+        while not (self._stopping.is_set() and not len(queue)):
+            item = queue.get(0.1)
+            if item is None:
+                continue
+            start = time.perf_counter()
+            try:
+                result = self.handle(item)
+                if result is not None and self.next is not None:
+                    self.next.put(result)
+                failed = 0
+            except Exception as e:
+                failed = 1
+                self.logger.warning(f"handling an item failed: {e}", exc_info=True)
+            with self._lock:
+                self.busy_seconds += time.perf_counter() - start
+                self.processed += 1 - failed
+                self.failed += failed
+
+    def stop(self, timeout: float):
+        # the queued items are handled before the workers exit
+        self._stopping.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        for queue in self.queues:
+            queue.close()
+        if self.depth:
+            self.logger.warning(f"{self.depth} items were not handled")
+
+    @property
+    def dropped(self) -> int:
+        return sum(queue.dropped for queue in self.queues)
+
+    @property
+    def spilled(self) -> int:
+        return sum(queue.spilled for queue in self.queues)
+
+    @property
+    def blocked(self) -> float:
+        return sum(queue.blocked for queue in self.queues)
+
+
+# Stages connected in order, e.g. decode -> process -> write. Items can enter at any stage, a shutdown drains the
+# stages one after the other.
+class Pipeline:
+    def __init__(self, stages: List[Stage], metrics: Metrics = NULL_METRICS):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.stages = {stage.name: stage for stage in stages}
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+        self._started = time.monotonic()
+
+        self.depth_gauge = metrics.gauge('pipeline_queue_items', 'Items waiting in the queues of a stage', ['stage'])
+        self.items_total = metrics.counter('pipeline_items', 'Items handled by a stage', ['stage', 'result'])
+        self.blocked_total = metrics.counter('pipeline_blocked_seconds',
+                                             'Time the previous stage waited for free space in the queues', ['stage'])
+        self.busy_total = metrics.counter('pipeline_busy_seconds', 'Time the workers of a stage were busy', ['stage'])
+        metrics.collectors.append(self._collect)
+
+        for stage in stages:
+            stage.start()
+
+    def submit(self, stage: str, item) -> bool:
+        return self.stages[stage].put(item)
+
+    def _collect(self):
+        for name, stage in self.stages.items():
+            self.depth_gauge.labels(name).set(stage.depth)
+            self.items_total.labels(name, 'processed').set(stage.processed)
+            self.items_total.labels(name, 'failed').set(stage.failed)
+            self.items_total.labels(name, 'dropped').set(stage.dropped)
+            self.items_total.labels(name, 'spilled').set(stage.spilled)
+            self.blocked_total.labels(name).set(stage.blocked)
+            self.busy_total.labels(name).set(stage.busy_seconds)
+
+    def report(self) -> List[str]:
+        elapsed = time.monotonic() - self._started
+        lines = []
+        for name, stage in self.stages.items():
+            workers = len(stage.queues)
+            lines.append(f"pipeline {name}: queue={stage.depth}, processed={stage.processed} "
+                         f"({stage.processed / elapsed if elapsed else 0.0:.1f}/s), "
+                         f"busy={stage.busy_seconds / elapsed / workers * 100.0 if elapsed else 0.0:.1f} % "
+                         f"of {workers} workers, blocked={stage.blocked:.1f} s, dropped={stage.dropped}, "
+                         f"spilled={stage.spilled}, failed={stage.failed}")
+        return lines
+
+    def close(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        for stage in self.stages.values():
+            stage.stop(max(0.0, deadline - time.monotonic()))
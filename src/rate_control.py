@@ -0,0 +1,150 @@
+import logging
+from typing import Optional
+
+# states of a circuit breaker and their gauge values
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# weight of the latest response in the smoothed latency
+LATENCY_ALPHA = 0.3
+
+
+# Isolates a failing endpoint, e.g. MeterRealtimeData while the meter is unplugged: after a number of failures in a
+# row it stays open (no requests) for a while, then lets a single probe request through. A successful probe closes it,
+# a failed one opens it again for twice as long.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 3, open_seconds: float = 30.0, max_open_seconds: float = 600.0):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+        self._open_for = open_seconds
+
+    def allow(self, now: float) -> Optional[float]:
+        # None if a request may be made, otherwise the seconds until the next probe
+        if self.state == OPEN:
+            if now < self.open_until:
+                return self.open_until - now
+            self.state = HALF_OPEN
+        return None
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self._open_for = self.open_seconds
+
+    def failure(self, now: float) -> bool:
+        # whether the breaker opened
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.open_until = now + self._open_for
+            self._open_for = min(self._open_for * 2.0, self.max_open_seconds)
+            self.trips += 1
+            return True
+        return False
+
+
+# Feedback control of the polling interval of an endpoint as a factor of the target interval: the request rate is
+# increased additively while the device answers within the latency target and decreased multiplicatively when it
+# answers slower or fails (AIMD). The scheduler keeps the interval within the rate limit.
+class IntervalController:
+    def __init__(self, latency_target: float = 1.0, step: float = 0.1, backoff: float = 2.0,
+                 min_factor: float = 0.5, max_factor: float = 8.0):
+        self.latency_target = latency_target
+        self.step = step
+        self.backoff = backoff
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+
+        # request rate relative to the target interval
+        self.rate = 1.0
+        # smoothed response latency in seconds
+        self.latency: Optional[float] = None
+
+    @property
+    def factor(self) -> float:
+        return 1.0 / self.rate
+
+    def update(self, latency: float, failed: bool) -> float:
+        if not failed:
+            self.latency = latency if self.latency is None else \
+                LATENCY_ALPHA * latency + (1.0 - LATENCY_ALPHA) * self.latency
+        if failed or latency > self.latency_target:
+            self.rate = max(self.rate / self.backoff, 1.0 / self.max_factor)
+        else:
+            self.rate = min(self.rate + self.step, 1.0 / self.min_factor)
+        return self.factor
+
+
+# Interval controller and circuit breaker of an endpoint.
+class EndpointControl:
+    def __init__(self, metric: str, controller: IntervalController, breaker: CircuitBreaker):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.metric = metric
+        self.controller = controller
+        self.breaker = breaker
+
+    @property
+    def factor(self) -> float:
+        return self.controller.factor
+
+    def allow(self, now: float) -> Optional[float]:
+        was_open = self.breaker.state == OPEN
+        retry = self.breaker.allow(now)
+        if was_open and retry is None:
+            self.logger.info(f"{self.metric}: probing the endpoint")
+        return retry
+
+    def update(self, now: float, latency: float, failed: bool):
+        self.controller.update(latency, failed)
+        if failed:
+            if self.breaker.failure(now):
+                self.logger.warning(f"{self.metric}: circuit open for {self.breaker.open_until - now:.0f} s after "
+                                    f"{self.breaker.failures} failures")
+        elif self.breaker.state != CLOSED or self.breaker.failures:
+            if self.breaker.state != CLOSED:
+                self.logger.info(f"{self.metric}: circuit closed")
+            self.breaker.success()
+
+    def report(self) -> str:
+        latency = f"{self.controller.latency * 1000:.0f} ms" if self.controller.latency is not None else 'n/a'
+        return f"interval factor={self.factor:.2f}, latency={latency}, circuit {self.breaker.state} " \
+               f"(trips={self.breaker.trips})"
+
+
+# Creates the controls of the endpoints with the same settings.
+class RateControl:
+    def __init__(self, latency_target: float = 1.0, step: float = 0.1, backoff: float = 2.0,
+                 min_factor: float = 0.5, max_factor: float = 8.0, failure_threshold: int = 3,
+                 open_seconds: float = 30.0, max_open_seconds: float = 600.0):
+        if latency_target <= 0.0:
+            raise ValueError(f"invalid latency target: {latency_target} s")
+        if not 0.0 < min_factor <= 1.0 <= max_factor:
+            raise ValueError(f"invalid interval factors: min={min_factor}, max={max_factor}")
+        if backoff <= 1.0 or step <= 0.0:
+            raise ValueError(f"invalid interval adjustment: step={step}, backoff={backoff}")
+        if failure_threshold < 1 or open_seconds <= 0.0 or max_open_seconds < open_seconds:
+            raise ValueError(f"invalid circuit breaker: threshold={failure_threshold}, open={open_seconds} s, "
+                             f"max={max_open_seconds} s")
+        self.latency_target = latency_target
+        self.step = step
+        self.backoff = backoff
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+
+    def endpoint(self, metric: str) -> EndpointControl:
+        return EndpointControl(metric,
+                               IntervalController(self.latency_target, self.step, self.backoff, self.min_factor,
+                                                  self.max_factor),
+                               CircuitBreaker(self.failure_threshold, self.open_seconds, self.max_open_seconds))
@@ -0,0 +1,225 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from decoder import ResponseDecoder
+
+_SEGMENT_SUFFIX = '.jsonl.gz'
+_TMP_SUFFIX = '.tmp'
+
+# maximum age in seconds of recorded responses which are only buffered by the compressor
+FLUSH_INTERVAL = 10.0
+
+
+def recorder_directory(directory: str, inverter_name: str) -> str:
+    # one directory per inverter, e.g. for the workers of a fleet
+    return os.path.join(directory, re.sub(r'[^\w.-]', '_', inverter_name))
+
+
+def _segment_seq(name: str) -> int:
+    return int(name.split('-', 1)[0])
+
+
+# Appends the raw Solar API responses with their receive time to rotating, gzip compressed JSON lines segments, e.g.
+# <directory>/000003-20230520T102709.jsonl.gz with a line per response:
+# {"time": <receive time in ns>, "metric": "CommonInverterData/1", "url": "...", "status": 200, "response": {...}}
+# The poll loop only hands over the response bytes, a background thread builds the lines and compresses them. A
+# segment is written as *.tmp and renamed when it reaches its size or age and on shutdown, the oldest segments are
+# removed when the directory exceeds its maximum size.
+class ResponseRecorder:
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, segment_seconds: float = 3600.0,
+                 max_bytes: int = 1024 * 1024 * 1024, max_queue: int = 10000, compresslevel: int = 6):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+
+        self._queue: queue.Queue = queue.Queue(max_queue)
+        self._file = None
+        self._gzip: Optional[gzip.GzipFile] = None
+        self._path: Optional[str] = None
+        self._opened = 0.0
+        self._flushed = 0.0
+        self._closing = threading.Event()
+
+        self.recorded = 0
+        self.dropped = 0
+        self.failed = 0
+        self.raw_bytes = 0
+        self.segments = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # complete segments in recording order: (sequence number, path, size)
+        self._segments: List[Tuple[int, str, int]] = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith(_SEGMENT_SUFFIX):
+                self._segments.append((_segment_seq(name), path, os.path.getsize(path)))
+            elif name.endswith(_SEGMENT_SUFFIX + _TMP_SUFFIX):
+                self.logger.warning(f"incomplete segment of an earlier run: {path}")
+        self._segments.sort()
+        self._seq = max([seq for seq, _, _ in self._segments] +
+                        [_segment_seq(name) for name in os.listdir(directory)
+                         if name.endswith(_SEGMENT_SUFFIX + _TMP_SUFFIX)], default=-1) + 1
+
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def record(self, metric: str, url: str, status: int, content: bytes, received_ns: Optional[int] = None) -> bool:
+        # called by the poll loop, a full queue drops the response
+        try:
+            self._queue.put_nowait((received_ns or time.time_ns(), metric, url, status, content))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    @staticmethod
+    def _line(received_ns: int, metric: str, url: str, status: int, content: bytes) -> bytes:
+        # the JSON response is embedded as it is, line breaks are whitespace outside of JSON strings
+        content = content.strip()
+        if content[:1] == b'{':
+            response = content.replace(b'\r', b' ').replace(b'\n', b' ')
+        else:
+            # e.g. an HTML error page
+            response = json.dumps(content.decode('utf-8', 'replace')).encode('utf-8')
+        return b'{"time":%d,"metric":%s,"url":%s,"status":%d,"response":%s}\n' % (
+            received_ns, json.dumps(metric).encode('utf-8'), json.dumps(url).encode('utf-8'), status, response)
+
+    def _run(self):
+        while True:
+            try:
+                record = self._queue.get(timeout=1.0)
+                line = self._line(*record)
+                if self._gzip is None:
+                    self._open()
+                self._gzip.write(line)
+                self.recorded += 1
+                self.raw_bytes += len(line)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                self.failed += 1
+                self.logger.warning(f"recording a response failed: {e}", exc_info=True)
+
+            closing = self._closing.is_set() and self._queue.empty()
+            if self._gzip is not None:
+                now = time.monotonic()
+                if closing or self._file.tell() >= self.segment_bytes or now - self._opened >= self.segment_seconds:
+                    self._close_segment()
+                elif now - self._flushed >= FLUSH_INTERVAL and self._queue.empty():
+                    # readable up to here if the process is killed
+                    self._gzip.flush(zlib.Z_SYNC_FLUSH)
+                    self._flushed = now
+            if closing:
+                return
+
+    def _open(self):
+        name = f"{self._seq:06d}-{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')}{_SEGMENT_SUFFIX}"
+        self._path = os.path.join(self.directory, name + _TMP_SUFFIX)
+        self._file = open(self._path, 'wb')
+        self._gzip = gzip.GzipFile(filename=name[:-len('.gz')], mode='wb', compresslevel=self.compresslevel,
+                                   fileobj=self._file)
+        self._opened = self._flushed = time.monotonic()
+        self._seq += 1
+
+    def _close_segment(self):
+        self._gzip.close()
+        self._file.close()
+        path = self._path[:-len(_TMP_SUFFIX)]
+        os.replace(self._path, path)
+        self._segments.append((self._seq - 1, path, os.path.getsize(path)))
+        self._gzip = self._file = self._path = None
+        self.segments += 1
+
+        # retention by the size of the complete segments
+        size = sum(segment[2] for segment in self._segments)
+        while size > self.max_bytes and len(self._segments) > 1:
+            _, oldest, oldest_size = self._segments.pop(0)
+            os.remove(oldest)
+            size -= oldest_size
+
+    def report(self) -> List[str]:
+        size = sum(segment[2] for segment in self._segments)
+        return [f"recorder: responses={self.recorded} ({self.raw_bytes / 1024 / 1024:.1f} MB raw), "
+                f"segments={len(self._segments)} ({size / 1024 / 1024:.1f} MB), queue={self._queue.qsize()}, "
+                f"dropped={self.dropped}, failed={self.failed}"]
+
+    def close(self, timeout: float = 30.0):
+        self._closing.set()
+        self._thread.join(timeout)
+
+
+def segment_paths(path: str) -> List[str]:
+    # a segment file, or the segments of a directory in recording order including an incomplete last one
+    if os.path.isfile(path):
+        return [path]
+    names = [name for name in os.listdir(path)
+             if name.endswith(_SEGMENT_SUFFIX) or name.endswith(_SEGMENT_SUFFIX + _TMP_SUFFIX)]
+    return [os.path.join(path, name) for name in sorted(names, key=_segment_seq)]
+
+
+# Reads recorded responses back in recording order, paced by their receive times at real-time speed (1.0), a
+# multiple of it (e.g. 60.0) or as fast as possible (0). Lines which can not be decoded and the truncated end of
+# a segment of a killed process are skipped.
+class ResponseReplay:
+    def __init__(self, path: str, decoder: Optional[ResponseDecoder] = None, speed: float = 1.0):
+        if speed < 0.0:
+            raise ValueError(f"invalid replay speed: {speed}")
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.paths = segment_paths(path)
+        if not self.paths:
+            raise ValueError(f"no recorded responses in {path}")
+        self.decoder = decoder or ResponseDecoder()
+        self.speed = speed
+
+        self.replayed = 0
+        self.skipped = 0
+        # maximum delay of a response behind its paced time in seconds
+        self.max_lag = 0.0
+
+    def records(self) -> Iterator[Dict]:
+        for path in self.paths:
+            try:
+                with gzip.open(path, 'rb') as f:
+                    for line in f:
+                        try:
+                            yield self.decoder.decode(line)
+                        except ValueError:
+                            self.skipped += 1
+            except (EOFError, OSError, zlib.error) as e:
+                self.logger.warning(f"segment {path} is truncated: {e}")
+
+    def run(self, handle: Callable[[str, Dict], None]):
+        first_ns, start = None, time.monotonic()
+        for record in self.records():
+            if self.speed and record.get('time'):
+                if first_ns is None:
+                    first_ns = record['time']
+                delay = start + (record['time'] - first_ns) / 1e9 / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+            if record.get('status') == 429 or not isinstance(record.get('response'), dict):
+                # rate limited requests and error pages
+                self.skipped += 1
+                continue
+            handle(record['metric'], record['response'])
+            self.replayed += 1
+
+    def report(self) -> List[str]:
+        return [f"replay: responses={self.replayed} from {len(self.paths)} segments, skipped={self.skipped}, "
+                f"max lag={self.max_lag:.3f} s"]
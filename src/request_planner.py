@@ -0,0 +1,275 @@
+import logging
+import urllib.parse
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from data_processor import (COMMON_INVERTER_FIELDS, CUMULATION_INVERTER_FIELDS, MIN_MAX_INVERTER_FIELDS,
+                            THREE_PHASE_INVERTER_FIELDS, METER_FIELDS, POWER_FLOW_INVERTER_FIELDS,
+                            POWER_FLOW_SITE_FIELDS, DataProcessor, WrongFroniusData)
+
+# measurements written for every metric
+METRIC_MEASUREMENTS: Dict[str, List[str]] = {
+    'CommonInverterData': ['CommonInverterData', 'InverterStatus'],
+    'CumulationInverterData': ['CumulationInverterData'],
+    '3PInverterData': ['3PInverterData'],
+    'MinMaxInverterData': ['MinMaxInverterData'],
+    'MeterRealtimeData': ['MeterRealtimeData'],
+    'PowerFlowRealtimeData': ['PowerFlowDataInverter', 'PowerFlowDataSite'],
+}
+
+# measurements with one series per inverter, all others are one series per system
+DEVICE_MEASUREMENTS = {'CommonInverterData', 'InverterStatus', 'CumulationInverterData', '3PInverterData',
+                       'MinMaxInverterData'}
+
+# field names per measurement, None for measurements with a dynamic set of fields
+MEASUREMENT_FIELDS: Dict[str, Optional[Set[str]]] = {
+    'CommonInverterData': {name for _, name, _, _ in COMMON_INVERTER_FIELDS},
+    'InverterStatus': None,
+    'CumulationInverterData': {name for _, name, _, _ in CUMULATION_INVERTER_FIELDS},
+    '3PInverterData': {name for _, name, _, _ in THREE_PHASE_INVERTER_FIELDS},
+    'MinMaxInverterData': {name for _, name, _, _ in MIN_MAX_INVERTER_FIELDS},
+    'MeterRealtimeData': {name for _, name, _, _ in METER_FIELDS},
+    'PowerFlowDataInverter': {name for _, name, _, _ in POWER_FLOW_INVERTER_FIELDS},
+    'PowerFlowDataSite': {name for _, name, _, _ in POWER_FLOW_SITE_FIELDS},
+}
+
+# AC power and energy of an inverter, which are part of every inverter response
+CUMULATED_FIELDS = MEASUREMENT_FIELDS['CumulationInverterData']
+
+# the cumulated values of an inverter in the power flow data
+POWER_FLOW_CUMULATED = {
+    'PAC': 'P',
+    'DAY_ENERGY': 'E_Day',
+    'YEAR_ENERGY': 'E_Year',
+    'TOTAL_ENERGY': 'E_Total',
+}
+
+# a series of a measurement: (measurement, device id), the device id is None for system measurements
+Series = Tuple[str, Optional[str]]
+
+
+@dataclass
+class PlannedRequest:
+    name: str
+    # how the response is fanned out: 'device', 'system', 'powerflow' or 'meter'
+    kind: str
+    route: str
+    params: Dict[str, str]
+    # fields by series which the response contains, None for all fields of the measurement
+    provides: Dict[Series, Optional[Set[str]]]
+    # series which are written from the response
+    assigned: Set[Series] = field(default_factory=set)
+
+    def covers(self, series: Series, fields: Optional[Set[str]]) -> bool:
+        if series not in self.provides:
+            return False
+        provided = self.provides[series]
+        return provided is None or (fields is not None and fields <= provided)
+
+
+def _is_ok(response: Dict) -> bool:
+    try:
+        return response['Head']['Status']['Code'] == 0
+    except KeyError:
+        raise WrongFroniusData('Response structure is not healthy.')
+
+
+def _with_arguments(response: Dict, collection: str, device_id: str, data: Dict) -> Dict:
+    # a device response of the given data collection with the given data
+    head = dict(response['Head'])
+    head['RequestArguments'] = {'DataCollection': collection, 'DeviceId': device_id, 'Scope': 'Device'}
+    return {'Head': head, 'Body': {'Data': data}}
+
+
+# Plans the smallest set of Solar API requests which covers all requested measurements (and fields) of the
+# configured devices, e.g. CumulationInverterData is taken from CommonInverterData or PowerFlowRealtimeData when
+# these are requested anyway, or from one Scope=System request for all inverters. The responses are fanned out to
+# the data points of the requested measurements, in the same shape as without planning.
+class RequestPlanner:
+    def __init__(self, base_url: str, processor: DataProcessor, metrics: List[str], device_ids: List[str],
+                 fields: Optional[Dict[str, List[str]]] = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.base_url = base_url
+        self.processor = processor
+        self.device_ids = [str(device_id) for device_id in device_ids]
+
+        # requested series with the requested fields (None for all fields)
+        self.required: Dict[Series, Optional[Set[str]]] = {}
+        for metric in metrics:
+            if metric not in METRIC_MEASUREMENTS:
+                raise ValueError(f"Metric '{metric}' is not supported by the request planner")
+            for measurement in METRIC_MEASUREMENTS[metric]:
+                selected = (fields or {}).get(measurement)
+                if selected is not None:
+                    known = MEASUREMENT_FIELDS[measurement]
+                    unknown = set(selected) - known if known is not None else set()
+                    if unknown:
+                        raise ValueError(f"unknown fields of {measurement}: {', '.join(sorted(unknown))}")
+                    selected = set(selected)
+                devices = self.device_ids if measurement in DEVICE_MEASUREMENTS else [None]
+                for device_id in devices:
+                    self.required[(measurement, device_id)] = selected
+
+        self.requests: Dict[str, PlannedRequest] = {}
+        for request in self._plan(self._candidates()):
+            self.requests[request.name] = request
+        self.naive_requests = sum(len(self.device_ids) if METRIC_MEASUREMENTS[metric][0] in DEVICE_MEASUREMENTS
+                                  else 1 for metric in metrics)
+
+        self._fanout: Dict[str, Callable[[PlannedRequest, Dict], List[Dict]]] = {
+            'device': self._fanout_device,
+            'system': self._fanout_system,
+            'powerflow': self._fanout_power_flow,
+            'meter': self._fanout_native,
+        }
+
+    def _candidates(self) -> List[PlannedRequest]:
+        # in order of preference, requests of a single device return exactly the requested data
+        candidates = []
+        for device_id in self.device_ids:
+            for collection, provides in [
+                ('CommonInverterData', {'CommonInverterData': None, 'InverterStatus': None,
+                                        'CumulationInverterData': None}),
+                ('3PInverterData', {'3PInverterData': None}),
+                ('MinMaxInverterData', {'MinMaxInverterData': None}),
+                ('CumulationInverterData', {'CumulationInverterData': None,
+                                            'CommonInverterData': CUMULATED_FIELDS}),
+            ]:
+                candidates.append(PlannedRequest(
+                    f'{collection}/{device_id}', 'device', 'GetInverterRealtimeData.cgi',
+                    {'Scope': 'Device', 'DataCollection': collection, 'DeviceId': device_id},
+                    {(measurement, device_id): fields for measurement, fields in provides.items()}))
+
+        cumulated = {}
+        for device_id in self.device_ids:
+            cumulated[('CumulationInverterData', device_id)] = None
+            cumulated[('CommonInverterData', device_id)] = CUMULATED_FIELDS
+        candidates.append(PlannedRequest('CumulationInverterData/System', 'system', 'GetInverterRealtimeData.cgi',
+                                         {'Scope': 'System'}, dict(cumulated)))
+        candidates.append(PlannedRequest('PowerFlowRealtimeData', 'powerflow', 'GetPowerFlowRealtimeData.fcgi', {}, {
+            ('PowerFlowDataInverter', None): None,
+            ('PowerFlowDataSite', None): None,
+            **cumulated,
+        }))
+        candidates.append(PlannedRequest('MeterRealtimeData', 'meter', 'GetMeterRealtimeData.cgi', {'Scope': 'System'},
+                                         {('MeterRealtimeData', None): None}))
+        return candidates
+
+    def _plan(self, candidates: List[PlannedRequest]) -> List[PlannedRequest]:
+        # greedy set cover: take the request which covers most of the remaining series until all are covered
+        remaining = dict(self.required)
+        chosen: List[PlannedRequest] = []
+        while remaining:
+            # on a tie the request with the least other data
+            best = max(candidates, key=lambda request: (sum(request.covers(series, fields)
+                                                            for series, fields in remaining.items()),
+                                                        -len(request.provides)))
+            covered = [series for series, fields in remaining.items() if best.covers(series, fields)]
+            if not covered:
+                raise ValueError(f"no request covers {', '.join(f'{m}/{d}' for m, d in remaining)}")
+            chosen.append(best)
+            candidates.remove(best)
+            for series in covered:
+                del remaining[series]
+
+        # drop requests whose series are all covered by the others
+        for request in list(reversed(chosen)):
+            others = [other for other in chosen if other is not request]
+            if all(any(other.covers(series, fields) for other in others)
+                   for series, fields in self.required.items() if request.covers(series, fields)):
+                chosen.remove(request)
+
+        # every series is written from a request which returns the measurement itself if possible
+        for series, fields in self.required.items():
+            covering = [request for request in chosen if request.covers(series, fields)]
+            native = [request for request in covering if request.provides[series] is None]
+            (native or covering)[0].assigned.add(series)
+        return chosen
+
+    @property
+    def endpoints(self) -> Dict[str, str]:
+        endpoints = {}
+        for name, request in self.requests.items():
+            url = f"{self.base_url}/{request.route}"
+            if request.params:
+                url += "?" + urllib.parse.urlencode(request.params)
+            endpoints[name] = url
+        return endpoints
+
+    def process(self, name: str, response: Dict) -> List[Dict]:
+        request = self.requests[name]
+        points = self._fanout[request.kind](request, response)
+
+        # only the requested fields of the measurements
+        for point in points:
+            device_id = None
+            if point['measurement'] in DEVICE_MEASUREMENTS:
+                device_id = (point.get('tags') or {}).get('DeviceId', request.params.get('DeviceId'))
+            fields = self.required.get((point['measurement'], device_id))
+            if fields is not None:
+                point['fields'] = {key: value for key, value in point['fields'].items() if key in fields}
+        return points
+
+    def _cumulated(self, request: PlannedRequest, response: Dict, data: Dict[str, Dict],
+                   measurements: Tuple[str, ...] = ('CumulationInverterData', 'CommonInverterData')) -> List[Dict]:
+        # data points of the cumulated values per device, as CumulationInverterData and/or CommonInverterData
+        points = []
+        for device_id, device_data in data.items():
+            for measurement in measurements:
+                if (measurement, device_id) not in request.assigned:
+                    continue
+                for point in self.processor.process_points('CumulationInverterData', _with_arguments(
+                        response, 'CumulationInverterData', device_id, device_data)):
+                    point['measurement'] = measurement
+                    points.append(point)
+        return points
+
+    def _fanout_device(self, request: PlannedRequest, response: Dict) -> List[Dict]:
+        device_id = request.params['DeviceId']
+        collection = request.params['DataCollection']
+        points = [point for point in self.processor.process_points(collection, response)
+                  if (point['measurement'], device_id) in request.assigned]
+
+        # the cumulated values of the other inverter measurement
+        derived = tuple(measurement for measurement in ['CumulationInverterData', 'CommonInverterData']
+                        if measurement not in METRIC_MEASUREMENTS[collection])
+        if derived and _is_ok(response):
+            points.extend(self._cumulated(request, response, {device_id: response['Body']['Data']}, derived))
+        return points
+
+    def _fanout_system(self, request: PlannedRequest, response: Dict) -> List[Dict]:
+        if not _is_ok(response):
+            self.logger.warning(f"Response status code is not 0: code={response['Head']['Status']['Code']}")
+            return []
+
+        # {"PAC": {"Unit": "W", "Values": {"1": 4711, ...}}, ...} to the device data of every inverter
+        data: Dict[str, Dict] = {}
+        for key, value in response['Body']['Data'].items():
+            for device_id, device_value in (value.get('Values') or {}).items():
+                if device_id in self.device_ids:
+                    data.setdefault(device_id, {})[key] = {'Unit': value.get('Unit'), 'Value': device_value}
+        return self._cumulated(request, response, data)
+
+    def _fanout_power_flow(self, request: PlannedRequest, response: Dict) -> List[Dict]:
+        points = [point for point in self.processor.process_points('PowerFlowRealtimeData', response)
+                  if (point['measurement'], None) in request.assigned]
+        if not _is_ok(response):
+            return points
+
+        data = {}
+        for device_id, inverter in response['Body']['Data'].get('Inverters', {}).items():
+            if device_id in self.device_ids:
+                data[device_id] = {key: {'Value': inverter.get(source)} for key, source in POWER_FLOW_CUMULATED.items()}
+        points.extend(self._cumulated(request, response, data))
+        return points
+
+    def _fanout_native(self, request: PlannedRequest, response: Dict) -> List[Dict]:
+        return self.processor.process_points(request.name, response)
+
+    def report(self) -> List[str]:
+        lines = [f"request planner: {len(self.requests)} requests per cycle instead of {self.naive_requests}"]
+        for request in self.requests.values():
+            series = ', '.join(sorted(f"{m}/{d}" if d else m for m, d in request.assigned))
+            lines.append(f"- {request.name}: {series}")
+        return lines
@@ -0,0 +1,338 @@
+import asyncio
+import logging
+import urllib.parse
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from metrics import NULL_METRICS, Metrics
+from rate_control import OPEN, STATE_VALUES, EndpointControl, RateControl
+
+# Fronius Solar API rate limit for realtime requests: up to 2 requests in parallel
+# and at least 4 seconds between two consecutive calls.
+MAX_PARALLEL_REQUESTS = 2
+MIN_REQUEST_GAP = 4.0
+
+
+class RateLimiter:
+    def __init__(self, max_parallel: int = MAX_PARALLEL_REQUESTS, min_gap: float = MIN_REQUEST_GAP):
+        self.max_parallel = max_parallel
+        self.min_gap = min_gap
+
+        # every slot holds the loop time at which it may start its next request
+        self._slots: Optional[asyncio.PriorityQueue] = None
+
+    def _get_slots(self) -> asyncio.PriorityQueue:
+        # create lazily to bind the queue to the running event loop
+        if self._slots is None:
+            self._slots = asyncio.PriorityQueue()
+            for idx in range(self.max_parallel):
+                self._slots.put_nowait((0.0, idx))
+        return self._slots
+
+    async def acquire(self) -> Tuple[int, float]:
+        loop = asyncio.get_running_loop()
+        ready_at, idx = await self._get_slots().get()
+        delay = ready_at - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return idx, loop.time()
+
+    def release(self, slot: Tuple[int, float]):
+        idx, started = slot
+        self._get_slots().put_nowait((started + self.min_gap, idx))
+
+    @property
+    def max_rate(self) -> float:
+        # maximum number of requests per second
+        return self.max_parallel / self.min_gap if self.min_gap > 0 else float('inf')
+
+
+# Limits of a host which differ from the Solar API, e.g. of a Modbus TCP interface.
+@dataclass
+class HostLimits:
+    max_parallel: int
+    min_gap: float
+    # fixed polling interval of the endpoints of the host instead of the target interval
+    interval: Optional[float] = None
+
+
+@dataclass
+class EndpointStats:
+    metric: str
+    url: str
+    target_interval: float
+    planned_interval: float
+    # shortest interval of the endpoint within the rate limit of its device
+    floor: float = 0.0
+    samples: int = 0
+    first_sample: Optional[float] = None
+    last_sample: Optional[float] = None
+
+    def record(self, started: float):
+        if self.first_sample is None:
+            self.first_sample = started
+        self.last_sample = started
+        self.samples += 1
+
+    @property
+    def achieved_interval(self) -> Optional[float]:
+        if self.samples < 2:
+            return None
+        return (self.last_sample - self.first_sample) / (self.samples - 1)
+
+    def reset(self):
+        self.samples = 0
+        self.first_sample = None
+        self.last_sample = None
+
+
+PollFunction = Callable[[str, str], Awaitable[Optional[float]]]
+
+
+# Polls every endpoint on its own deadline while keeping all requests to a device within the rate limit.
+# The poll function is awaited with (metric, url) and may return a delay in seconds to back off the endpoint,
+# which also counts as a failed poll for the optional rate control of the endpoint. With deferred results the
+# outcome of a successful request is only known after its response was handled elsewhere (e.g. by a pipeline) and
+# is reported with complete() instead.
+class PollScheduler:
+    def __init__(self, endpoints: Dict[str, str], request_interval: float,
+                 max_parallel: int = MAX_PARALLEL_REQUESTS, min_gap: float = MIN_REQUEST_GAP,
+                 report_interval: float = 300.0, metrics: Metrics = NULL_METRICS,
+                 hosts: Optional[Dict[str, HostLimits]] = None, rate_control: Optional[RateControl] = None,
+                 deferred_results: bool = False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.endpoints = endpoints
+        self.hosts = hosts or {}
+        self.report_interval = report_interval
+        self.reporters: List[Callable[[], List[str]]] = [self.report]
+
+        # one rate limiter per device (host) shared by all of its endpoints
+        self.limiters: Dict[str, RateLimiter] = {}
+        for url in endpoints.values():
+            host = urllib.parse.urlsplit(url).netloc
+            if host not in self.limiters:
+                limits = self.hosts.get(host)
+                self.limiters[host] = RateLimiter(limits.max_parallel, limits.min_gap) if limits else \
+                    RateLimiter(max_parallel, min_gap)
+        # endpoints per device, including those of other schedulers sharing its rate limiter
+        self.host_endpoints: Dict[str, int] = {}
+        for url in endpoints.values():
+            host = urllib.parse.urlsplit(url).netloc
+            self.host_endpoints[host] = self.host_endpoints.get(host, 0) + 1
+        self.request_interval = request_interval
+
+        # set and replaced whenever the intervals change or polling is paused or resumed
+        self.paused = False
+        self._pauses = 0
+        self._changed: Optional[asyncio.Event] = None
+        self.deferred_results = deferred_results
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self.jitter = metrics.histogram('sampling_jitter_seconds',
+                                        'Deviation of the sampling interval from the planned interval', ['metric'])
+        self.rate_limit_wait = metrics.histogram('rate_limit_wait_seconds',
+                                                 'Time a due request waited for the rate limit', ['metric'])
+        self.planned = metrics.gauge('planned_interval_seconds', 'Planned polling interval', ['metric'])
+        self.paused_gauge = metrics.gauge('paused', 'Polling is paused by the solar schedule')
+        self.breaker_state = metrics.gauge('circuit_breaker_state',
+                                           'Circuit breaker state (0 closed, 1 half open, 2 open)', ['metric'])
+        self.breaker_trips = metrics.counter('circuit_breaker_trips', 'Times the circuit breaker opened', ['metric'])
+        self.latency = metrics.gauge('smoothed_latency_seconds', 'Smoothed response latency', ['metric'])
+        metrics.collectors.append(self._collect)
+
+        self.stats: Dict[str, EndpointStats] = {
+            metric: EndpointStats(metric, url, request_interval, request_interval)
+            for metric, url in endpoints.items()
+        }
+        # interval controller and circuit breaker per endpoint
+        self.controls: Dict[str, EndpointControl] = {
+            metric: rate_control.endpoint(metric) for metric in endpoints
+        } if rate_control else {}
+        self.set_target_interval(request_interval)
+
+    def _limiter(self, url: str) -> RateLimiter:
+        return self.limiters[urllib.parse.urlsplit(url).netloc]
+
+    def set_target_interval(self, request_interval: float):
+        # every endpoint of a device shares the device's request budget, so the
+        # fastest achievable interval grows with the number of endpoints per device
+        self.request_interval = request_interval
+        for metric, url in self.endpoints.items():
+            host = urllib.parse.urlsplit(url).netloc
+            floor = self.host_endpoints[host] / self.limiters[host].max_rate
+            stats = self.stats[metric]
+            limits = self.hosts.get(host)
+            stats.target_interval = limits.interval if limits and limits.interval else request_interval
+            stats.floor = floor
+            self._plan(metric)
+
+            if floor > stats.target_interval:
+                self.logger.warning(f"{metric}: requested interval of {stats.target_interval:.1f} s exceeds the rate "
+                                    f"limit, polling every {floor:.1f} s instead")
+        self._notify()
+
+    def share_limiters(self, limiters: Dict[str, RateLimiter], host_endpoints: Dict[str, int]):
+        # devices polled by several schedulers (e.g. inverters behind one Datamanager) use one rate limiter, whose
+        # budget is split over the endpoints of all of them
+        for host in self.limiters:
+            self.limiters[host] = limiters.setdefault(host, self.limiters[host])
+            self.host_endpoints[host] = host_endpoints.get(host, self.host_endpoints[host])
+        self.set_target_interval(self.request_interval)
+
+    def _plan(self, metric: str):
+        # the target interval scaled by the rate control, within the rate limit
+        stats = self.stats[metric]
+        control = self.controls.get(metric)
+        interval = stats.target_interval * control.factor if control else stats.target_interval
+        stats.planned_interval = max(interval, stats.floor)
+
+    def pause(self):
+        if not self.paused:
+            self.paused = True
+            self._pauses += 1
+            self._notify()
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self._notify()
+
+    def _notify(self):
+        # wake up all endpoints to reschedule their next request
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def _get_changed(self) -> asyncio.Event:
+        # create lazily to bind the event to the running event loop
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    async def _sleep_until(self, deadline: Callable[[], float]):
+        loop = asyncio.get_running_loop()
+        while True:
+            changed = self._get_changed()
+            if self.paused:
+                await changed.wait()
+                continue
+
+            delay = deadline() - loop.time()
+            if delay <= 0:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), delay)
+            except asyncio.TimeoutError:
+                return
+
+    def complete(self, metric: str, latency: float, failed: bool):
+        # the deferred result of a request, called from any thread
+        if self._loop is not None and metric in self.controls:
+            self._loop.call_soon_threadsafe(self._complete, metric, latency, failed)
+
+    def _complete(self, metric: str, latency: float, failed: bool):
+        # an open circuit skips the next requests of the endpoint
+        self.controls[metric].update(self._loop.time(), latency, failed)
+        self._plan(metric)
+
+    async def run(self, poll: PollFunction):
+        self._loop = asyncio.get_running_loop()
+        tasks = [
+            asyncio.ensure_future(self._poll_endpoint(idx, metric, url, poll))
+            for idx, (metric, url) in enumerate(self.endpoints.items())
+        ]
+        tasks.append(asyncio.ensure_future(self._report()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _poll_endpoint(self, idx: int, metric: str, url: str, poll: PollFunction):
+        loop = asyncio.get_running_loop()
+        stats = self.stats[metric]
+        control = self.controls.get(metric)
+        limiter = self._limiter(url)
+        jitter = self.jitter.labels(metric)
+        rate_limit_wait = self.rate_limit_wait.labels(metric)
+        last_start = None
+
+        # the next request is due one planned interval after the last scheduled one (evaluated lazily to follow
+        # interval changes while waiting), the first deadlines are staggered evenly over one interval
+        scheduled = loop.time() + stats.planned_interval * (idx / len(self.endpoints) - 1.0)
+        not_before = 0.0
+        backoff = None
+        while True:
+            pauses = self._pauses
+            await self._sleep_until(lambda: max(scheduled + stats.planned_interval, not_before))
+            if self._pauses != pauses or backoff:
+                # the interval after a pause or back-off is no sampling jitter
+                last_start = None
+
+            # keep a fixed cadence, but skip missed deadlines instead of bursting to catch up
+            now = loop.time()
+            scheduled += stats.planned_interval
+            if scheduled < now - stats.planned_interval:
+                scheduled = now
+
+            # an open circuit skips the request and keeps the slots of the rate limit free for the other endpoints
+            retry = control.allow(now) if control else None
+            if retry is not None:
+                not_before = now + retry
+                backoff = retry
+                continue
+
+            slot = await limiter.acquire()
+            rate_limit_wait.observe(slot[1] - now)
+            try:
+                backoff = await poll(metric, url)
+            finally:
+                limiter.release(slot)
+            stats.record(slot[1])
+            if last_start is not None:
+                jitter.observe(abs(slot[1] - last_start - stats.planned_interval))
+            last_start = slot[1]
+
+            now = loop.time()
+            if control and (backoff is not None or not self.deferred_results):
+                control.update(now, now - slot[1], backoff is not None)
+                self._plan(metric)
+                if control.breaker.state == OPEN:
+                    backoff = max(backoff or 0.0, control.breaker.open_until - now)
+            scheduled = max(scheduled, now - stats.planned_interval)
+            if backoff:
+                not_before = now + backoff
+
+    def _collect(self):
+        for metric, stats in self.stats.items():
+            self.planned.labels(metric).set(stats.planned_interval)
+        for metric, control in self.controls.items():
+            self.breaker_state.labels(metric).set(STATE_VALUES[control.breaker.state])
+            self.breaker_trips.labels(metric).set(control.breaker.trips)
+            if control.controller.latency is not None:
+                self.latency.labels(metric).set(control.controller.latency)
+        self.paused_gauge.labels().set(1 if self.paused else 0)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            for reporter in self.reporters:
+                for line in reporter():
+                    self.logger.info(line)
+            for stats in self.stats.values():
+                stats.reset()
+
+    def report(self) -> List[str]:
+        lines = []
+        for stats in self.stats.values():
+            achieved = stats.achieved_interval
+            achieved_str = f"{60.0 / achieved:.2f}/min" if achieved else "n/a"
+            if self.paused:
+                achieved_str += " (paused)"
+            control = self.controls.get(stats.metric)
+            lines.append(f"{stats.metric}: achieved {achieved_str} "
+                         f"(configured {60.0 / stats.target_interval:.2f}/min, "
+                         f"planned {60.0 / stats.planned_interval:.2f}/min, samples={stats.samples})"
+                         + (f", {control.report()}" if control else ""))
+        return lines
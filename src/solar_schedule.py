@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from astral import sun
+from astral.location import Location
+
+from scheduler import PollScheduler
+
+PHASES = ['night', 'twilight', 'day', 'midday']
+
+
+# Daily schedule of the polling phases of a location. The solar events are computed once per day and cached.
+#   night:    dusk .. dawn
+#   twilight: dawn .. sunrise, sunset .. dusk
+#   day:      sunrise .. sunset
+#   midday:   noon -/+ half of the midday window
+class SolarSchedule:
+    def __init__(self, location: Location, intervals: Dict[str, Optional[float]], midday_window: float = 14400.0,
+                 idle_interval: Optional[float] = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.location = location
+        self.tz = location.tzinfo
+        # polling interval per phase in seconds, None pauses polling
+        self.intervals = intervals
+        self.midday_window = datetime.timedelta(seconds=midday_window)
+        # polling interval during the day while the inverter does not produce any power
+        self.idle_interval = idle_interval
+
+        self._days: Dict[datetime.date, List[Tuple[datetime.datetime, str]]] = {}
+        self._idle = False
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _event(self, event, date: datetime.date) -> Optional[datetime.datetime]:
+        # the sun does not reach every elevation each day close to the poles
+        try:
+            return event(self.location.observer, date, tzinfo=self.tz)
+        except ValueError:
+            return None
+
+    def _compute(self, date: datetime.date) -> List[Tuple[datetime.datetime, str]]:
+        midnight = datetime.datetime.combine(date, datetime.time(), tzinfo=self.tz)
+        noon = sun.noon(self.location.observer, date, tzinfo=self.tz)
+        sunrise = self._event(sun.sunrise, date)
+        sunset = self._event(sun.sunset, date)
+
+        # polar day or polar night
+        if sunrise is None or sunset is None or sunset < sunrise:
+            daylight = sun.elevation(self.location.observer, noon) > 0.0
+            return [(midnight, 'day' if daylight else 'night')]
+
+        dawn = self._event(sun.dawn, date)
+        dusk = self._event(sun.dusk, date)
+        midday_start = max(noon - self.midday_window / 2, sunrise)
+        midday_end = min(noon + self.midday_window / 2, sunset)
+
+        transitions = [
+            (midnight, 'night' if dawn else 'twilight'),
+            (dawn, 'twilight'),
+            (sunrise, 'day'),
+            (midday_start, 'midday'),
+            (midday_end, 'day'),
+            (sunset, 'twilight'),
+            (dusk, 'night'),
+        ]
+        return [(time, phase) for time, phase in transitions if time is not None and time >= midnight]
+
+    def transitions(self, date: datetime.date) -> List[Tuple[datetime.datetime, str]]:
+        transitions = self._days.get(date)
+        if transitions is None:
+            transitions = self._days[date] = self._compute(date)
+            # keep today and tomorrow only
+            for cached in [cached for cached in self._days if cached < date - datetime.timedelta(days=1)]:
+                del self._days[cached]
+            self.logger.info(f"solar schedule for {date}: " +
+                             ", ".join(f"{phase} from {time:%H:%M:%S}" for time, phase in transitions))
+        return transitions
+
+    def periods(self, start: datetime.datetime, end: datetime.datetime,
+                phases: List[str]) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+        # the periods between start and end in one of the given phases, e.g. the nights of the last week
+        periods = []
+        date = start.astimezone(self.tz).date() - datetime.timedelta(days=1)
+        since = None
+        while True:
+            # past days are computed without the cache of today and tomorrow
+            for time, phase in self._compute(date):
+                if phase in phases and since is None:
+                    since = time
+                elif phase not in phases and since is not None:
+                    if time > start and since < end:
+                        periods.append((max(since, start), min(time, end)))
+                    since = None
+            if date > end.astimezone(self.tz).date():
+                break
+            date += datetime.timedelta(days=1)
+        if since is not None and since < end:
+            periods.append((max(since, start), end))
+        return periods
+
+    def paused_phases(self) -> List[str]:
+        return [phase for phase in PHASES if self.intervals.get(phase) is None]
+
+    def phase(self, now: Optional[datetime.datetime] = None) -> Tuple[str, datetime.datetime]:
+        # current phase and the time of the next transition
+        now = now or datetime.datetime.now(tz=self.tz)
+        today = now.astimezone(self.tz).date()
+
+        current = None
+        for time, phase in self.transitions(today):
+            if time > now:
+                if phase != current:
+                    return current, time
+                continue
+            current = phase
+
+        tomorrow = today + datetime.timedelta(days=1)
+        for time, phase in self.transitions(tomorrow):
+            if phase != current:
+                return current, time
+        return current, datetime.datetime.combine(tomorrow + datetime.timedelta(days=1), datetime.time(),
+                                                  tzinfo=self.tz)
+
+    def interval(self, phase: str) -> Optional[float]:
+        interval = self.intervals.get(phase)
+        if self._idle and interval and phase in ['day', 'midday']:
+            interval = max(interval, self.idle_interval)
+        return interval
+
+    def report_power(self, power: Optional[float]):
+        # called with the current AC power of the inverter, which is switched off (None) or idle at 0 W
+        idle = not power
+        if idle == self._idle or not self.idle_interval:
+            return
+        self._idle = idle
+        self.logger.info(f"inverter is {'idle' if idle else 'producing power'}")
+        if self._loop and self._wake:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def run(self, scheduler: PollScheduler):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+
+        while True:
+            self._wake.clear()
+            phase, next_transition = self.phase()
+            interval = self.interval(phase)
+            if interval is None:
+                scheduler.pause()
+                self.logger.info(f"{phase}: polling paused until {next_transition:%Y-%m-%d %H:%M:%S}")
+            else:
+                scheduler.set_target_interval(interval)
+                scheduler.resume()
+                self.logger.info(f"{phase}: polling every {interval:.1f} s until {next_transition:%Y-%m-%d %H:%M:%S}")
+
+            # sleep until the next transition, or until the inverter's power state changes
+            delay = (next_transition - datetime.datetime.now(tz=self.tz)).total_seconds()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(delay, 0.0) + 1.0)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,286 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+# record header: compressed payload length, number of lines, oldest timestamp in ns (0 if unknown)
+_HEADER = struct.Struct('<IIq')
+_SEGMENT_SUFFIX = '.spool'
+_CURSOR_FILE = 'cursor'
+
+FSYNC_POLICIES = ['always', 'segment', 'never']
+
+
+@dataclass
+class _Segment:
+    seq: int
+    path: str
+    size: int = 0
+    records: int = 0
+    points: int = 0
+
+
+def _oldest_timestamp(lines: List[bytes]) -> int:
+    oldest = 0
+    for line in lines:
+        try:
+            timestamp = int(line.rsplit(b' ', 1)[1])
+        except (IndexError, ValueError):
+            continue
+        if not oldest or timestamp < oldest:
+            oldest = timestamp
+    return oldest
+
+
+# Append-only, segmented on-disk queue of line protocol batches.
+# Every record is a header followed by the zlib compressed lines of one batch.
+class Spool:
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024, segment_bytes: int = 4 * 1024 * 1024,
+                 fsync: str = 'segment'):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"invalid fsync policy: {fsync}")
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        self._segments: List[_Segment] = []
+        self._writer = None
+        self._reader = None
+        self._read_seq = -1
+        self._read_offset = 0
+        self._next: Optional[Tuple[int, List[bytes], int]] = None
+
+        self.evicted = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{seq:012d}{_SEGMENT_SUFFIX}")
+
+    def _load(self):
+        seqs = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(_SEGMENT_SUFFIX))
+
+        cursor_seq, cursor_offset = -1, 0
+        try:
+            with open(os.path.join(self.directory, _CURSOR_FILE), 'r') as cursor:
+                cursor_seq, cursor_offset = map(int, cursor.read().split())
+        except (OSError, ValueError):
+            pass
+
+        for seq in seqs:
+            if seq < cursor_seq:
+                os.remove(self._segment_path(seq))
+                continue
+
+            segment = _Segment(seq, self._segment_path(seq))
+            offset = cursor_offset if seq == cursor_seq else 0
+            with open(segment.path, 'rb+') as f:
+                f.seek(offset)
+                end = offset
+                for _, count, _ in self._iter_headers(f):
+                    segment.records += 1
+                    segment.points += count
+                    end = f.tell()
+                if end < os.path.getsize(segment.path):
+                    # a torn record of an interrupted write, it would never become readable
+                    self.logger.warning(f"truncated a torn record at {end} of {segment.path}")
+                    f.truncate(end)
+            segment.size = os.path.getsize(segment.path) - offset
+            self._segments.append(segment)
+
+        if self._segments and self._segments[0].seq == cursor_seq:
+            self._read_seq, self._read_offset = cursor_seq, cursor_offset
+
+        if self._segments:
+            self.logger.info(f"loaded spool {self.directory}: {self.points} points in {len(self._segments)} segments")
+
+    @staticmethod
+    def _iter_headers(f):
+        # the complete records from the current position
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, count, oldest = _HEADER.unpack(header)
+            if f.tell() + length > size:
+                return
+            f.seek(length, os.SEEK_CUR)
+            yield length, count, oldest
+
+    def _roll(self):
+        if self._writer:
+            self._writer.flush()
+            if self.fsync != 'never':
+                os.fsync(self._writer.fileno())
+            self._writer.close()
+            self._writer = None
+
+        seq = self._segments[-1].seq + 1 if self._segments else 0
+        self._segments.append(_Segment(seq, self._segment_path(seq)))
+        self._writer = open(self._segments[-1].path, 'ab')
+
+    def append(self, lines: List[bytes]):
+        if not lines:
+            return
+
+        payload = zlib.compress(b'\n'.join(lines))
+        record = _HEADER.pack(len(payload), len(lines), _oldest_timestamp(lines)) + payload
+
+        with self._lock:
+            if self._writer is None or self._writer.tell() >= self.segment_bytes:
+                self._roll()
+
+            self._writer.write(record)
+            self._writer.flush()
+            if self.fsync == 'always':
+                os.fsync(self._writer.fileno())
+
+            segment = self._segments[-1]
+            segment.size += len(record)
+            segment.records += 1
+            segment.points += len(lines)
+
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._segments) > 1:
+            segment = self._segments.pop(0)
+            if segment.seq == self._read_seq:
+                self._close_reader()
+            self._next = None
+            os.remove(segment.path)
+            self.evicted += segment.points
+            self.logger.warning(f"spool is full, evicted {segment.points} points (total {self.evicted})")
+
+    def _close_reader(self):
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+        self._read_seq = -1
+        self._read_offset = 0
+
+    def peek(self) -> Optional[List[bytes]]:
+        with self._lock:
+            record = self._peek()
+            return record[1] if record else None
+
+    def _peek(self) -> Optional[Tuple[int, List[bytes], int]]:
+        while self._next is None and self._segments:
+            segment = self._segments[0]
+            if self._read_seq != segment.seq:
+                self._close_reader()
+                self._read_seq = segment.seq
+            if self._reader is None:
+                self._reader = open(segment.path, 'rb')
+                self._reader.seek(self._read_offset)
+
+            header = self._reader.read(_HEADER.size)
+            if len(header) == _HEADER.size:
+                length, count, oldest = _HEADER.unpack(header)
+                payload = self._reader.read(length)
+                if len(payload) == length:
+                    try:
+                        self._next = (_HEADER.size + length, zlib.decompress(payload).split(b'\n'), oldest)
+                        break
+                    except zlib.error as e:
+                        # e.g. bit rot, the framing is intact so only this record is lost
+                        self.logger.error(f"skipped a corrupt record of {count} points at {self._read_offset} of "
+                                          f"{segment.path}: {e}")
+                        self._skip(segment, _HEADER.size + length, count)
+                        continue
+
+            if header:
+                # a bad length or a torn record, appends are complete under the lock, so the rest of the segment
+                # can not be read anymore
+                self._quarantine(segment)
+                continue
+
+            # the end of the segment
+            self._reader.seek(self._read_offset)
+            if segment is self._segments[-1]:
+                return None
+            self._close_reader()
+            self._segments.pop(0)
+            os.remove(segment.path)
+
+        return self._next
+
+    def _skip(self, segment: _Segment, length: int, count: int):
+        self._read_offset += length
+        self._reader.seek(self._read_offset)
+        segment.size -= length
+        segment.records -= 1
+        segment.points -= count
+        self.evicted += count
+        self._save_cursor()
+
+    def _quarantine(self, segment: _Segment):
+        self.evicted += segment.points
+        self.logger.error(f"unreadable record at {self._read_offset} of {segment.path}, quarantined the segment "
+                          f"with {segment.points} points (total evicted {self.evicted})")
+        if segment is self._segments[-1]:
+            # new records go to the next segment
+            self._roll()
+        self._close_reader()
+        self._segments.pop(0)
+        os.replace(segment.path, segment.path + '.corrupt')
+
+    def commit(self):
+        with self._lock:
+            if self._next is None:
+                return
+            length, lines, _ = self._next
+            self._next = None
+
+            segment = self._segments[0]
+            self._read_offset += length
+            segment.size -= length
+            segment.records -= 1
+            segment.points -= len(lines)
+            self._save_cursor()
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, _CURSOR_FILE)
+        with open(path + '.tmp', 'w') as cursor:
+            cursor.write(f"{self._read_seq} {self._read_offset}")
+        os.replace(path + '.tmp', path)
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self._segments)
+
+    @property
+    def records(self) -> int:
+        return sum(segment.records for segment in self._segments)
+
+    @property
+    def points(self) -> int:
+        return sum(segment.points for segment in self._segments)
+
+    @property
+    def oldest_timestamp(self) -> Optional[int]:
+        # timestamp in ns of the oldest pending point
+        with self._lock:
+            record = self._peek()
+            return (record[2] or None) if record else None
+
+    def close(self):
+        with self._lock:
+            self._close_reader()
+            if self._writer:
+                self._writer.flush()
+                if self.fsync != 'never':
+                    os.fsync(self._writer.fileno())
+                self._writer.close()
+                self._writer = None
@@ -0,0 +1,71 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import aggregation  # noqa: E402
+from aggregation import WindowAggregator  # noqa: E402
+
+S = 10 ** 9
+
+
+def _point(seconds: float, value: float, device: str = '1') -> dict:
+    return {'measurement': 'm', 'tags': {'DeviceId': device}, 'time': int(seconds * S), 'fields': {'P': value}}
+
+
+def _aggregates(output: list) -> list:
+    return [(point['measurement'], point['tags']['DeviceId'], point['time'] // S, point['fields'])
+            for point in output if point['measurement'] != 'm']
+
+
+def test_windows_are_aligned_and_late_samples_counted():
+    aggregator = WindowAggregator([10], allowed_lateness=5)
+    output = aggregator.process([_point(62, 1.0), _point(65, 3.0), _point(71, 5.0)])
+    assert _aggregates(output) == []
+
+    # out of order within the allowed lateness of the window 60-70
+    output = aggregator.process([_point(69, 2.0), _point(75, 7.0)])
+    assert _aggregates(output) == [('m_10s', '1', 60, {'P_min': 1.0, 'P_max': 3.0, 'P_mean': 2.0, 'P_last': 2.0,
+                                                       'P_count': 3})]
+
+    # after the allowed lateness the window is closed
+    output = aggregator.process([_point(68, 4.0)])
+    assert _aggregates(output) == []
+    assert aggregator.late == 1
+
+    output = aggregator.flush()
+    assert _aggregates(output) == [('m_10s', '1', 70, {'P_min': 5.0, 'P_max': 7.0, 'P_mean': 6.0, 'P_last': 7.0,
+                                                       'P_count': 2})]
+
+
+def test_evicted_series_keeps_its_closed_windows():
+    aggregator = WindowAggregator([60], allowed_lateness=5, max_series=1)
+    aggregator.process([_point(10, 1.0, 'a')])
+
+    # the second series evicts the first one, which emits its open window
+    output = aggregator.process([_point(10, 1.0, 'b')])
+    assert [(device, start) for _, device, start, _ in _aggregates(output)] == [('a', 0)]
+
+    # a late sample of the returning series must not emit the window again
+    output = aggregator.process([_point(20, 2.0, 'a')])
+    assert [(device, start) for _, device, start, _ in _aggregates(output)] == [('b', 0)]
+    assert aggregator.late == 1
+    assert [(device, start) for _, device, start, _ in _aggregates(aggregator.flush())] == []
+
+
+def test_idle_series_is_closed(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(aggregation.time, 'monotonic', lambda: now[0])
+    aggregator = WindowAggregator([10, 60], allowed_lateness=5)
+    assert aggregator.idle_timeout == 65.0
+    aggregator.process([_point(5, 1.0, 'a'), _point(5, 2.0, 'b')])
+
+    # only b receives samples, a is closed after the longest window and the lateness
+    now[0] += 40.0
+    output = aggregator.process([_point(8, 3.0, 'b')])
+    assert _aggregates(output) == []
+    now[0] += 30.0
+    output = aggregator.process([_point(9, 4.0, 'b')])
+    assert sorted((window, device) for window, device, _, _ in _aggregates(output)) == [('m_10s', 'a'),
+                                                                                      ('m_60s', 'a')]
+    assert aggregator.report() == ["aggregation: 2 series, 2 open windows, samples=4, emitted=2, late=0"]
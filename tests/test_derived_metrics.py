@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from derived_metrics import DerivedMetrics  # noqa: E402
+
+S = 10 ** 9
+FORMULAS = {'m': {'E': 'integral(P)', 'P_mean': 'mean(P)', 'P_last': 'last(P)'}}
+
+
+def _point(seconds: float, fields: dict) -> dict:
+    return {'measurement': 'm', 'tags': {'DeviceId': '1'}, 'time': int(seconds * S), 'fields': fields}
+
+
+def _derived(output: list) -> list:
+    return [(point['time'] // S, point['fields']) for point in output if point['measurement'] == 'm_derived_60s']
+
+
+def test_gap_is_left_out_and_carry_bridges_the_window_boundary():
+    derived = DerivedMetrics(window=60, max_gap=30, formulas=FORMULAS)
+    output = derived.process([_point(t, {'P': 3600.0}) for t in (0, 10, 20, 55)])
+    assert _derived(output) == []
+
+    # the 35 s between 20 and 55 exceed the maximum gap
+    output = derived.process([_point(60, {'P': 7200.0}), _point(70, {'P': 7200.0})])
+    assert _derived(output) == [(0, {'E': pytest.approx(20.0), 'P_mean': 3600.0, 'P_last': 3600.0, 'samples': 4})]
+
+    # the last sample of the previous window starts the integral, but does not count for the mean
+    assert _derived(derived.flush()) == [(60, {'E': pytest.approx(27.5), 'P_mean': 7200.0, 'P_last': 7200.0,
+                                               'samples': 2})]
+
+
+def test_nan_fields_are_left_out():
+    derived = DerivedMetrics(window=60, max_gap=30, formulas=FORMULAS)
+    derived.process([_point(0, {'P': 3600.0}), _point(10, {'P': None}), _point(20, {'P': 'n/a'}),
+                     _point(30, {'P': 1800.0}), _point(40, {'P': 1800.0})])
+    assert _derived(derived.flush()) == [(0, {'E': pytest.approx(5.0), 'P_mean': 2400.0, 'P_last': 1800.0,
+                                              'samples': 5})]
+
+    # a window without any value has no mean or last value, and no energy
+    derived.process([_point(60, {'Q': 1.0})])
+    assert _derived(derived.flush()) == [(60, {'E': 0.0, 'samples': 1})]
+    assert derived.failed == 0
+
+
+def test_out_of_order_samples_are_sorted():
+    derived = DerivedMetrics(window=60, max_gap=30, formulas=FORMULAS)
+    derived.process([_point(10, {'P': 3600.0}), _point(0, {'P': 3600.0}), _point(20, {'P': 0.0})])
+    assert _derived(derived.flush()) == [(0, {'E': pytest.approx(15.0), 'P_mean': 2400.0, 'P_last': 0.0,
+                                              'samples': 3})]
+
+    # samples of an already closed window are late
+    derived.process([_point(70, {'P': 1.0}), _point(5, {'P': 1.0})])
+    assert derived.late == 1
@@ -0,0 +1,77 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from spool import _HEADER, Spool  # noqa: E402
+
+
+def test_truncated_last_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([b'm f=1 1000', b'm f=2 2000'])
+    spool.append([b'm f=3 3000'])
+    spool.close()
+
+    # a crash in the middle of the second record
+    path = os.path.join(str(tmp_path), sorted(name for name in os.listdir(str(tmp_path)))[0])
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    spool = Spool(str(tmp_path))
+    assert spool.records == 1
+    assert spool.points == 2
+    assert spool.peek() == [b'm f=1 1000', b'm f=2 2000']
+    spool.commit()
+    assert spool.records == 0
+    assert spool.peek() is None
+
+    # appending after the torn record keeps the spool readable
+    spool.append([b'm f=4 4000'])
+    assert spool.peek() == [b'm f=4 4000']
+    spool.close()
+
+
+def _segment_path(directory) -> str:
+    return os.path.join(str(directory), sorted(name for name in os.listdir(str(directory)))[0])
+
+
+def test_corrupt_record_is_skipped(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([b'm f=1 1000', b'm f=2 2000'])
+    spool.append([b'm f=3 3000'])
+    spool.close()
+
+    # bit rot in the compressed payload of the first record
+    path = _segment_path(tmp_path)
+    with open(path, 'r+b') as f:
+        f.seek(_HEADER.size + 2)
+        f.write(b'\xff\xff\xff\xff')
+
+    spool = Spool(str(tmp_path))
+    assert spool.peek() == [b'm f=3 3000']
+    assert spool.evicted == 2
+    assert spool.records == 1
+    spool.commit()
+    assert spool.peek() is None
+    spool.close()
+
+
+def test_bad_record_length_quarantines_the_segment(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append([b'm f=1 1000'])
+    spool.append([b'm f=2 2000'])
+
+    # a length beyond the end of the segment, the following records can not be found anymore
+    path = _segment_path(tmp_path)
+    with open(path, 'r+b') as f:
+        f.write(_HEADER.pack(1 << 20, 1, 1000))
+
+    assert spool.peek() is None
+    assert spool.evicted == 2
+    assert spool.records == 0
+    assert os.path.exists(path + '.corrupt')
+
+    # new records go to a new segment
+    spool.append([b'm f=3 3000'])
+    assert spool.peek() == [b'm f=3 3000']
+    spool.close()